@@ -0,0 +1,223 @@
+import logging
+from dataclasses import replace
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.crud import CRUD, DISPATCH_CANDIDATES, DISPATCH_CLAIM_ROUNDS
+from app.distance import BILLING, RANKING, Distances, distance_policy
+from app.driver_index import driver_index
+from app.driver_locations import driver_locations
+from app.identity import CUSTOMER, DRIVER, Identity, identity_resolver
+from app.metrics import driver_claims
+from app.quote_cache import quote_cache
+from app.models import Customer, Driver, Order, OrderAssignment
+from app.schema import CustomerCreate
+from app.water_sources import water_source_registry
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCRUD:
+    """AsyncSession versions of the CRUD operations on the webhook path.
+
+    Pure helpers (claim statements, links) are shared with CRUD and
+    distances come from the same distance_policy; only database I/O differs.
+    """
+
+    @staticmethod
+    async def create_customer(
+        db: AsyncSession,
+        customer: CustomerCreate,
+        before_commit: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> Identity:
+        """Insert the customer; before_commit, if given, is awaited inside the same transaction."""
+        db_customer = Customer(
+            phone=customer.phone,
+            location=customer.location,
+            latitude=customer.latitude,
+            longitude=customer.longitude,
+        )
+        db.add(db_customer)
+        if before_commit is not None:
+            await before_commit()
+        await db.commit()
+        return identity_resolver.remember(CUSTOMER, db_customer)
+
+    @staticmethod
+    async def set_customer_location(
+        db: AsyncSession,
+        customer: Identity,
+        latitude: float,
+        longitude: float,
+        address: str,
+        before_commit: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> Identity:
+        """Update a resolved customer by id, without loading the row."""
+        await db.execute(
+            update(Customer)
+            .where(Customer.id == customer.id)
+            .values(latitude=latitude, longitude=longitude, location=address)
+        )
+        if before_commit is not None:
+            await before_commit()
+        await db.commit()
+        return identity_resolver.remember(
+            CUSTOMER, replace(customer, latitude=latitude, longitude=longitude, location=address)
+        )
+
+    @staticmethod
+    async def set_driver_location(
+        db: AsyncSession, driver: Identity, latitude: float, longitude: float, address: str
+    ) -> Identity:
+        """Buffer the position in driver_locations; it reaches the drivers table on the next flush."""
+        driver_locations.record(driver.id, latitude, longitude, address)
+        return identity_resolver.remember(
+            DRIVER, replace(driver, latitude=latitude, longitude=longitude, location=address)
+        )
+
+    @staticmethod
+    async def get_order(db: AsyncSession, order_id: str):
+        return await db.get(Order, order_id)
+
+    @staticmethod
+    async def get_order_driver(db: AsyncSession, order_id: str) -> Optional[Driver]:
+        """Driver of the order's latest assignment, with any buffered position applied."""
+        driver = (
+            await db.scalars(
+                select(Driver)
+                .join(OrderAssignment, OrderAssignment.driver_id == Driver.id)
+                .where(OrderAssignment.order_id == order_id)
+                .order_by(OrderAssignment.id.desc())
+                .limit(1)
+            )
+        ).first()
+        if driver is not None:
+            driver_locations.overlay([driver])
+        return driver
+
+    @staticmethod
+    async def calculate_distances(
+        origin: Tuple[float, float],
+        destinations: List[Tuple[float, float]],
+        db: Optional[AsyncSession] = None,
+        purpose: str = BILLING,
+    ) -> Distances:
+        """CRUD.calculate_distances without blocking the event loop."""
+        return await distance_policy.adistances(origin, destinations, db=db, purpose=purpose)
+
+    @staticmethod
+    async def calculate_distance(
+        start_lat: float, start_lng: float, dest_lat: float, dest_lng: float,
+        db: Optional[AsyncSession] = None,
+    ) -> Optional[float]:
+        return (await AsyncCRUD.calculate_distances((start_lat, start_lng), [(dest_lat, dest_lng)], db=db))[0]
+
+    @staticmethod
+    async def closest_by_distance(
+        lat: float, lng: float, candidates: List, db: Optional[AsyncSession] = None, purpose: str = RANKING
+    ):
+        distances = await AsyncCRUD.calculate_distances(
+            (lat, lng), [(c.latitude, c.longitude) for c in candidates], db=db, purpose=purpose
+        )
+        closest = None
+        min_distance = float("inf")
+        for candidate, distance in zip(candidates, distances):
+            if distance is not None and distance < min_distance:
+                min_distance = distance
+                closest = candidate
+        return closest, min_distance
+
+    @staticmethod
+    async def rank_by_distance(
+        lat: float, lng: float, candidates: List, db: Optional[AsyncSession] = None
+    ) -> List:
+        distances = await AsyncCRUD.calculate_distances(
+            (lat, lng), [(c.latitude, c.longitude) for c in candidates], db=db, purpose=RANKING
+        )
+        ranked = sorted((distance, i) for i, distance in enumerate(distances) if distance is not None)
+        return [candidates[i] for _, i in ranked]
+
+    @staticmethod
+    async def nearest_water_source(db: AsyncSession, lat: float, lng: float) -> Optional[Tuple[str, float]]:
+        """CRUD.nearest_water_source on an AsyncSession."""
+        await water_source_registry.aensure_loaded(db)
+        if not len(water_source_registry):
+            raise ValueError("No water sources found")
+        sources_version = water_source_registry.version
+        cached = quote_cache.get(lat, lng)
+        if cached is not None:
+            return cached
+
+        candidates = water_source_registry.nearest(lat, lng)
+        distances = await AsyncCRUD.calculate_distances(
+            (lat, lng), [(c.latitude, c.longitude) for c in candidates], db=db, purpose=RANKING
+        )
+        reachable = [(distance, i) for i, distance in enumerate(distances) if distance is not None]
+        if not reachable:
+            return None
+        min_distance, i = min(reachable)
+        source = candidates[i]
+        estimated = i in distances.estimated
+        if distance_policy.separate_billing or estimated:
+            billed = await AsyncCRUD.calculate_distances((lat, lng), [(source.latitude, source.longitude)], db=db)
+            min_distance, estimated = billed[0], bool(billed.estimated)
+            if min_distance is None:
+                return None
+        # Fallback estimates may price this order, but must not outlive the outage in the cache
+        if not estimated:
+            quote_cache.set(lat, lng, source.id, min_distance, sources_version)
+        return source.id, min_distance
+
+    @staticmethod
+    async def nearest_water_source_distance(db: AsyncSession, lat: float, lng: float) -> Optional[float]:
+        nearest = await AsyncCRUD.nearest_water_source(db, lat, lng)
+        return None if nearest is None else nearest[1]
+
+    @staticmethod
+    async def _nearest_available_drivers(db: AsyncSession, lat: float, lng: float):
+        candidate_ids = [
+            driver_id for driver_id, _ in driver_index.nearest(lat, lng, DISPATCH_CANDIDATES)
+        ]
+        if not candidate_ids:
+            return []
+        drivers = (
+            await db.scalars(
+                select(Driver).where(Driver.id.in_(candidate_ids), Driver.is_available == True)
+            )
+        ).all()
+        current = {driver.id for driver in drivers}
+        for driver_id in candidate_ids:
+            if driver_id not in current:
+                driver_index.remove(driver_id)
+        driver_locations.overlay(drivers)
+        for driver in drivers:
+            driver_index.update(driver)
+        return drivers
+
+    @staticmethod
+    async def claim_driver(db: AsyncSession, driver_id: str) -> bool:
+        claimed = (await db.execute(CRUD._claim_driver_statement(db, driver_id))).rowcount == 1
+        driver_claims.inc("claimed" if claimed else "lost")
+        return claimed
+
+    @staticmethod
+    async def claim_nearest_available_driver(db: AsyncSession, lat: float, lng: float) -> Optional[Driver]:
+        """CRUD.claim_nearest_available_driver on an AsyncSession."""
+        await driver_index.aensure_fresh(db)
+        for attempt in range(DISPATCH_CLAIM_ROUNDS):
+            drivers = await AsyncCRUD._nearest_available_drivers(db, lat, lng)
+            if not drivers and attempt == 0:
+                await driver_index.arebuild(db)
+                drivers = await AsyncCRUD._nearest_available_drivers(db, lat, lng)
+            if not drivers:
+                return None
+            for driver in await AsyncCRUD.rank_by_distance(lat, lng, drivers, db):
+                if await AsyncCRUD.claim_driver(db, driver.id):
+                    return driver
+                driver_index.remove(driver.id)
+        return None
+
+
+async_crud = AsyncCRUD()
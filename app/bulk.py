@@ -0,0 +1,249 @@
+import codecs
+import json
+import os
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, List, Tuple
+
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.driver_index import driver_index
+from app.identity import identity_resolver
+from app.models import Driver, WaterSource, generate_ulid
+from app.schema import DriverCreate, WaterSourceCreate
+from app.water_sources import water_source_registry
+
+# Rows validated and written per transaction
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+# Per-row errors included in the response; the rest are only counted
+BULK_MAX_REPORTED_ERRORS = int(os.getenv("BULK_MAX_REPORTED_ERRORS", "1000"))
+# Largest single row accepted; stops a malformed upload from being buffered whole
+BULK_MAX_ROW_BYTES = int(os.getenv("BULK_MAX_ROW_BYTES", str(64 * 1024)))
+
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl", "application/json-lines")
+
+
+class BulkFormatError(Exception):
+    """The upload stopped being valid JSON; rows after this point were not read."""
+
+
+class BulkResult:
+    def __init__(self):
+        self.received = 0
+        self.inserted = 0
+        self.failed = 0
+        self.errors: List[Dict] = []
+        self.aborted = None
+
+    def error(self, row: int, detail: Any):
+        self.failed += 1
+        if len(self.errors) < BULK_MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row, "errors": detail})
+
+    def as_dict(self) -> Dict:
+        result = {
+            "received": self.received,
+            "inserted": self.inserted,
+            "failed": self.failed,
+            "errors": sorted(self.errors, key=lambda error: error["row"]),
+        }
+        if self.aborted:
+            result["aborted"] = self.aborted
+        return result
+
+
+async def _decoded(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    # Incremental, so a multi-byte character split across chunks decodes correctly
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    async for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+async def iter_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Any]]:
+    """(row number, value) per non-blank line; a line that is not JSON yields its JSONDecodeError."""
+    buffer = ""
+    row = 0
+
+    def parse(line: str):
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError as e:
+            return e
+
+    async for text in _decoded(chunks):
+        buffer += text
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            if line.strip():
+                row += 1
+                yield row, parse(line)
+        if len(buffer) > BULK_MAX_ROW_BYTES:
+            raise BulkFormatError(f"Row {row + 1} is longer than {BULK_MAX_ROW_BYTES} bytes")
+    if buffer.strip():
+        yield row + 1, parse(buffer)
+
+
+async def iter_json_array(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Any]]:
+    """(row number, value) per element of a top-level JSON array, decoded as the body arrives."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    row = 0
+    state = "start"  # start -> value -> separator -> value ... -> done
+
+    def skip_whitespace(text: str, index: int) -> int:
+        while index < len(text) and text[index] in " \t\r\n":
+            index += 1
+        return index
+
+    async for text in _decoded(chunks):
+        buffer = buffer[position:] + text
+        position = 0
+        while True:
+            position = skip_whitespace(buffer, position)
+            if position >= len(buffer) or state == "done":
+                break
+            char = buffer[position]
+            if state == "start":
+                if char != "[":
+                    raise BulkFormatError("Expected a JSON array or NDJSON")
+                position += 1
+                state = "first"
+            elif state == "separator":
+                if char not in ",]":
+                    raise BulkFormatError(f"Expected ',' or ']' after row {row}")
+                position += 1
+                state = "value" if char == "," else "done"
+            elif state == "first" and char == "]":
+                position += 1
+                state = "done"
+            else:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if len(buffer) - position > BULK_MAX_ROW_BYTES:
+                        raise BulkFormatError(f"Row {row + 1} is invalid or longer than {BULK_MAX_ROW_BYTES} bytes")
+                    break  # Incomplete value; wait for more of the body
+                if end == len(buffer):
+                    break  # A trailing number may still be growing
+                row += 1
+                yield row, value
+                position = end
+                state = "separator"
+    if state != "done" or buffer[position:].strip():
+        raise BulkFormatError(f"Upload ended inside the array after row {row}")
+
+
+def iter_upload(chunks: AsyncIterator[bytes], content_type: str) -> AsyncIterator[Tuple[int, Any]]:
+    if content_type.split(";")[0].strip().lower() in NDJSON_TYPES:
+        return iter_ndjson(chunks)
+    return iter_json_array(chunks)
+
+
+async def _insert_rows(db: AsyncSession, model, rows: List[Tuple[int, Dict]], result: BulkResult) -> List[Dict]:
+    """executemany the chunk; if a concurrent writer makes it conflict, fall back to row by row."""
+    if not rows:
+        return []
+    try:
+        await db.execute(insert(model), [values for _, values in rows])
+        await db.commit()
+        result.inserted += len(rows)
+        return [values for _, values in rows]
+    except IntegrityError:
+        await db.rollback()
+
+    written = []
+    for row, values in rows:
+        try:
+            await db.execute(insert(model), [values])
+            await db.commit()
+        except IntegrityError as e:
+            await db.rollback()
+            result.error(row, str(e.orig))
+            continue
+        result.inserted += 1
+        written.append(values)
+    return written
+
+
+async def _write_drivers(db: AsyncSession, chunk: List[Tuple[int, DriverCreate]], result: BulkResult):
+    phones = [driver.phone for _, driver in chunk]
+    vehicles = [driver.vehicle_number for _, driver in chunk]
+    taken_phones = set((await db.scalars(select(Driver.phone).where(Driver.phone.in_(phones)))).all())
+    taken_vehicles = set(
+        (await db.scalars(select(Driver.vehicle_number).where(Driver.vehicle_number.in_(vehicles)))).all()
+    )
+
+    rows = []
+    for row, driver in chunk:
+        if driver.phone in taken_phones:
+            result.error(row, f"Driver with phone {driver.phone} already exists")
+            continue
+        if driver.vehicle_number in taken_vehicles:
+            result.error(row, f"Driver with vehicle number {driver.vehicle_number} already exists")
+            continue
+        taken_phones.add(driver.phone)
+        taken_vehicles.add(driver.vehicle_number)
+        rows.append((row, {
+            "id": generate_ulid(),
+            "name": driver.name,
+            "phone": driver.phone,
+            "vehicle_number": driver.vehicle_number,
+            "is_available": driver.availability,
+            "location": driver.location,
+            "latitude": driver.latitude,
+            "longitude": driver.longitude,
+        }))
+
+    for values in await _insert_rows(db, Driver, rows, result):
+        identity_resolver.invalidate(values["phone"])
+        if values["is_available"] and values["latitude"] is not None and values["longitude"] is not None:
+            driver_index.upsert(values["id"], values["latitude"], values["longitude"])
+
+
+async def _write_water_sources(db: AsyncSession, chunk: List[Tuple[int, WaterSourceCreate]], result: BulkResult):
+    rows = [
+        (row, {"id": generate_ulid(), "address": source.address, "latitude": source.latitude, "longitude": source.longitude})
+        for row, source in chunk
+    ]
+    for values in await _insert_rows(db, WaterSource, rows, result):
+        water_source_registry.add(SimpleNamespace(**values))
+
+
+async def ingest(db: AsyncSession, rows: AsyncIterator[Tuple[int, Any]], schema: BaseModel, write) -> Dict:
+    """Validate and write streamed rows BULK_CHUNK_SIZE at a time; only one chunk is held in memory."""
+    result = BulkResult()
+    chunk = []
+    try:
+        async for row, value in rows:
+            result.received += 1
+            if isinstance(value, json.JSONDecodeError):
+                result.error(row, f"Invalid JSON: {value}")
+                continue
+            try:
+                chunk.append((row, schema.model_validate(value)))
+            except ValidationError as e:
+                result.error(row, e.errors(include_url=False, include_context=False))
+            if len(chunk) >= BULK_CHUNK_SIZE:
+                await write(db, chunk, result)
+                chunk = []
+    except BulkFormatError as e:
+        result.aborted = str(e)
+    if chunk:
+        await write(db, chunk, result)
+    return result.as_dict()
+
+
+async def ingest_drivers(db: AsyncSession, chunks: AsyncIterator[bytes], content_type: str) -> Dict:
+    return await ingest(db, iter_upload(chunks, content_type), DriverCreate, _write_drivers)
+
+
+async def ingest_water_sources(db: AsyncSession, chunks: AsyncIterator[bytes], content_type: str) -> Dict:
+    return await ingest(db, iter_upload(chunks, content_type), WaterSourceCreate, _write_water_sources)
@@ -10,25 +10,32 @@ from app.schema import (
     WaterSourceCreate,
 )
 from sqlalchemy.orm import Session
+from sqlalchemy import and_, select, update
 from sqlalchemy.exc import IntegrityError
 from math import radians, sin, cos, sqrt, atan2
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Tuple
 from app.models import Customer, Order, OrderAssignment, Price, Driver, WaterSource, OrderStatus  # Adjust import based on your structure
 
+from app.distance import BILLING, RANKING, Distances, distance_policy
+from app.driver_index import driver_index
+from app.driver_locations import driver_locations
+from app.identity import CUSTOMER, DRIVER, identity_resolver
+from app.metrics import driver_claims
+from app.quote_cache import quote_cache
+from app.water_sources import water_source_registry
 import os
-from dotenv import load_dotenv
-import requests
 import json
 import logging
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-
-GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")
-WATER_SOURCES = json.loads(os.getenv("WATER_SOURCES", "[]"))
+# Nearest drivers by great-circle distance that get a road-distance check
+DISPATCH_CANDIDATES = int(os.getenv("DISPATCH_CANDIDATES", "5"))
+# Candidate lists to try when concurrent orders keep taking the drivers we pick
+DISPATCH_CLAIM_ROUNDS = int(os.getenv("DISPATCH_CLAIM_ROUNDS", "2"))
 
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "100"))
+LIST_MAX_PAGE_SIZE = int(os.getenv("LIST_MAX_PAGE_SIZE", "1000"))
 
 class CRUD:
 
@@ -43,6 +50,7 @@ class CRUD:
         db.add(db_customer)
         db.commit()
         db.refresh(db_customer)
+        identity_resolver.remember(CUSTOMER, db_customer)
         return db_customer
 
     @staticmethod
@@ -55,33 +63,108 @@ class CRUD:
     ):
         db_customer = CRUD.get_customer_by_phone(db, phone)
         if db_customer:
-            db_customer.latitude = latitude
-            db_customer.longitude = longitude
-            db_customer.location = address
-            db.commit()
-            db.refresh(db_customer)
-            return db_customer
+            return CRUD.set_customer_location(db, db_customer, latitude, longitude, address)
         return None
 
+    @staticmethod
+    def set_customer_location(
+        db: Session, db_customer: Customer, latitude: float, longitude: float, address: str
+    ):
+        db_customer.latitude = latitude
+        db_customer.longitude = longitude
+        db_customer.location = address
+        db.commit()
+        db.refresh(db_customer)
+        identity_resolver.remember(CUSTOMER, db_customer)
+        return db_customer
+
     @staticmethod
     def calculate_distance(
-        start_lat: float, start_lng: float, dest_lat: float, dest_lng: float
+        start_lat: float, start_lng: float, dest_lat: float, dest_lng: float,
+        db: Optional[Session] = None,
     ):
-        """Calculate driving distance using Google Maps Distance Matrix API."""
-        url = f"https://maps.googleapis.com/maps/api/distancematrix/json?origins={start_lat},{start_lng}&destinations={dest_lat},{dest_lng}&mode=driving&key={GOOGLE_MAPS_API_KEY}"
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            data = response.json()
-            if data["status"] != "OK" or not data["rows"]:
-                logger.error(f"Distance Matrix API error: {data}")
-                return None
-            distance_meters = data["rows"][0]["elements"][0]["distance"]["value"]
-            distance_km = distance_meters / 1000
-            return distance_km
-        except Exception as e:
-            logger.error(f"Error calculating distance: {str(e)}")
+        """Road distance in km for billing, see calculate_distances."""
+        return CRUD.calculate_distances(
+            (start_lat, start_lng), [(dest_lat, dest_lng)], db=db
+        )[0]
+
+    @staticmethod
+    def calculate_distances(
+        origin: Tuple[float, float],
+        destinations: List[Tuple[float, float]],
+        db: Optional[Session] = None,
+        purpose: str = BILLING,
+    ) -> Distances:
+        """Road distances in km from origin to each destination, in order.
+
+        The provider is chosen by distance_policy for the purpose; entries
+        are None where the destination has no coordinates or no provider
+        had an answer, and the result's estimated set marks fallback answers.
+        """
+        return distance_policy.distances(origin, destinations, db=db, purpose=purpose)
+
+    @staticmethod
+    def closest_by_distance(
+        lat: float, lng: float, candidates: List, db: Optional[Session] = None, purpose: str = RANKING
+    ):
+        """Return (candidate, distance_km) for the candidate nearest by road, or (None, inf)."""
+        distances = CRUD.calculate_distances(
+            (lat, lng), [(c.latitude, c.longitude) for c in candidates], db=db, purpose=purpose
+        )
+        closest = None
+        min_distance = float("inf")
+        for candidate, distance in zip(candidates, distances):
+            if distance is not None and distance < min_distance:
+                min_distance = distance
+                closest = candidate
+        return closest, min_distance
+
+    @staticmethod
+    def rank_by_distance(lat: float, lng: float, candidates: List, db: Optional[Session] = None) -> List:
+        """Candidates nearest first by road distance; those without a distance are dropped."""
+        distances = CRUD.calculate_distances(
+            (lat, lng), [(c.latitude, c.longitude) for c in candidates], db=db, purpose=RANKING
+        )
+        ranked = sorted((distance, i) for i, distance in enumerate(distances) if distance is not None)
+        return [candidates[i] for _, i in ranked]
+
+    @staticmethod
+    def nearest_water_source(db: Session, lat: float, lng: float) -> Optional[Tuple[str, float]]:
+        """(water source id, road distance in km) for the closest source, None if none can be reached."""
+        water_source_registry.ensure_loaded(db)
+        if not len(water_source_registry):
+            raise ValueError("No water sources found")
+        sources_version = water_source_registry.version
+        cached = quote_cache.get(lat, lng)
+        if cached is not None:
+            return cached
+
+        # Only the few nearest by great-circle distance get a road-distance lookup
+        candidates = water_source_registry.nearest(lat, lng)
+        distances = CRUD.calculate_distances(
+            (lat, lng), [(c.latitude, c.longitude) for c in candidates], db=db, purpose=RANKING
+        )
+        reachable = [(distance, i) for i, distance in enumerate(distances) if distance is not None]
+        if not reachable:
             return None
+        min_distance, i = min(reachable)
+        source = candidates[i]
+        estimated = i in distances.estimated
+        if distance_policy.separate_billing or estimated:
+            billed = CRUD.calculate_distances((lat, lng), [(source.latitude, source.longitude)], db=db)
+            min_distance, estimated = billed[0], bool(billed.estimated)
+            if min_distance is None:
+                return None
+        # Fallback estimates may price this order, but must not outlive the outage in the cache
+        if not estimated:
+            quote_cache.set(lat, lng, source.id, min_distance, sources_version)
+        return source.id, min_distance
+
+    @staticmethod
+    def nearest_water_source_distance(db: Session, lat: float, lng: float) -> Optional[float]:
+        """Road distance in km to the closest water source, None if none can be reached."""
+        nearest = CRUD.nearest_water_source(db, lat, lng)
+        return None if nearest is None else nearest[1]
 
     @staticmethod
     def calculate_order_price(db: Session, price: PriceCreate) -> Optional[float]:
@@ -99,20 +182,8 @@ class CRUD:
             return None  
 
         # Find the nearest water source
-        water_sources = db.query(WaterSource).all()
-        if not water_sources:
-            raise ValueError("No water sources found")
-
-        min_distance = float('inf')
-        for source in water_sources:
-            if source.latitude is None or source.longitude is None:
-                continue  # Skip water sources without valid coordinates
-            distance = CRUD.calculate_distance(
-                customer.latitude, customer.longitude, source.latitude, source.longitude
-            )
-            min_distance = min(min_distance, distance)
-
-        if min_distance == float('inf'):
+        min_distance = CRUD.nearest_water_source_distance(db, customer.latitude, customer.longitude)
+        if min_distance is None:
             return None  # No valid water sources with coordinates
 
         # Calculate total price
@@ -152,7 +223,7 @@ class CRUD:
             name=driver.name,
             phone=driver.phone,
             vehicle_number=driver.vehicle_number,
-            availability=driver.availability,
+            is_available=driver.availability,
             location=driver.location,
             latitude=driver.latitude,
             longitude=driver.longitude,
@@ -160,6 +231,9 @@ class CRUD:
         db.add(db_driver)
         db.commit()
         db.refresh(db_driver)
+        driver_index.update(db_driver)
+        # The phone may also be a customer, which takes precedence; let the resolver decide
+        identity_resolver.invalidate(db_driver.phone)
         return db_driver
 
     @staticmethod
@@ -168,15 +242,22 @@ class CRUD:
     ):
         db_driver = db.query(Driver).filter(Driver.phone == driver_phone).first()
         if db_driver:
-            db_driver.latitude = latitude
-            db_driver.longitude = longitude
-            db_driver.location = address
-            db_driver.availability = True
-            db.commit()
-            db.refresh(db_driver)
-            return db_driver
+            return CRUD.set_driver_location(db, db_driver, latitude, longitude, address)
         return None
 
+    @staticmethod
+    def set_driver_location(
+        db: Session, db_driver: Driver, latitude: float, longitude: float, address: str
+    ):
+        db_driver.latitude = latitude
+        db_driver.longitude = longitude
+        db_driver.location = address
+        db.commit()
+        db.refresh(db_driver)
+        driver_index.update(db_driver)
+        identity_resolver.invalidate(db_driver.phone)
+        return db_driver
+
     @staticmethod
     def get_available_driver(db: Session, order_id: str):
         order = db.query(Order).filter(Order.id == order_id).first()
@@ -190,48 +271,103 @@ class CRUD:
         if customer.latitude is None or customer.longitude is None:
             raise ValueError(f"Customer with ID {order.customer_id} is missing coordinates")
 
-        drivers = db.query(Driver).filter(Driver.is_available == True).all()
+        return CRUD.find_nearest_available_driver(db, customer.latitude, customer.longitude)
+
+    @staticmethod
+    def find_nearest_available_driver(db: Session, lat: float, lng: float):
+        driver_index.ensure_fresh(db)
+        drivers = CRUD._nearest_available_drivers(db, lat, lng)
+        if not drivers:
+            # Another worker may have changed availability since our last refresh
+            driver_index.rebuild(db)
+            drivers = CRUD._nearest_available_drivers(db, lat, lng)
         if not drivers:
             raise ValueError("No available drivers found")
 
-        min_distance = float('inf')
-        closest_driver = None
-
-        for driver in drivers:
-            if driver.latitude is None or driver.longitude is None:
-                print(f"Skipping driver ID {driver.id} due to missing coordinates")
-                continue
-            try:
-                distance = CRUD.calculate_distance(
-                    customer.latitude, customer.longitude, driver.latitude, driver.longitude
-                )
-                if distance is None:
-                    print(f"Distance calculation failed for driver ID {driver.id}")
-                    continue
-                if distance < min_distance:
-                    min_distance = distance
-                    closest_driver = driver
-            except Exception as e:
-                print(f"Error calculating distance for driver ID {driver.id}: {str(e)}")
-                continue
+        closest_driver, _ = CRUD.closest_by_distance(lat, lng, drivers, db)
 
         if closest_driver is None:
             raise ValueError("No drivers with valid coordinates found")
 
         return closest_driver
 
+    @staticmethod
+    def _claim_driver_statement(db, driver_id: str):
+        """UPDATE that takes a driver only if still available; it matches no row once another order has."""
+        condition = and_(Driver.id == driver_id, Driver.is_available == True)
+        if db.get_bind().dialect.name == "postgresql":
+            # Skip a driver another transaction is claiming instead of queueing on its row lock
+            condition = Driver.id == (
+                select(Driver.id).where(condition).with_for_update(skip_locked=True).scalar_subquery()
+            )
+        return update(Driver).where(condition).values(is_available=False)
+
+    @staticmethod
+    def claim_driver(db: Session, driver_id: str) -> bool:
+        """Mark a driver unavailable in the caller's transaction; False if someone else got them first."""
+        claimed = db.execute(CRUD._claim_driver_statement(db, driver_id)).rowcount == 1
+        driver_claims.inc("claimed" if claimed else "lost")
+        return claimed
+
+    @staticmethod
+    def claim_nearest_available_driver(db: Session, lat: float, lng: float) -> Optional[Driver]:
+        """Claim the nearest available driver by road distance, or None if nobody could be claimed.
+
+        Candidates lost to a concurrent order are dropped from the index and
+        the next nearest is tried, so simultaneous orders spread over nearby
+        drivers rather than double-booking one. The claim is only final once
+        the caller commits.
+        """
+        driver_index.ensure_fresh(db)
+        for attempt in range(DISPATCH_CLAIM_ROUNDS):
+            drivers = CRUD._nearest_available_drivers(db, lat, lng)
+            if not drivers and attempt == 0:
+                driver_index.rebuild(db)
+                drivers = CRUD._nearest_available_drivers(db, lat, lng)
+            if not drivers:
+                return None
+            for driver in CRUD.rank_by_distance(lat, lng, drivers, db):
+                if CRUD.claim_driver(db, driver.id):
+                    return driver
+                driver_index.remove(driver.id)
+        return None
+
+    @staticmethod
+    def _nearest_available_drivers(db: Session, lat: float, lng: float):
+        """Load the DISPATCH_CANDIDATES drivers nearest by great-circle distance that are still available."""
+        candidate_ids = [
+            driver_id for driver_id, _ in driver_index.nearest(lat, lng, DISPATCH_CANDIDATES)
+        ]
+        if not candidate_ids:
+            return []
+        drivers = (
+            db.query(Driver)
+            .filter(Driver.id.in_(candidate_ids), Driver.is_available == True)
+            .all()
+        )
+        # Drop candidates that another worker has since taken or moved
+        current = {driver.id for driver in drivers}
+        for driver_id in candidate_ids:
+            if driver_id not in current:
+                driver_index.remove(driver_id)
+        driver_locations.overlay(drivers)
+        for driver in drivers:
+            driver_index.update(driver)
+        return drivers
+
     @staticmethod
     def create_order_assignment(db: Session, assignment: OrderAssignmentCreate):
+        # Claim and assign in one commit so two orders cannot book the same driver
+        if not CRUD.claim_driver(db, assignment.driver_id):
+            db.rollback()
+            raise ValueError(f"Driver with ID {assignment.driver_id} is not available")
         db_assignment = OrderAssignment(
             order_id=assignment.order_id, driver_id=assignment.driver_id
         )
         db.add(db_assignment)
         db.commit()
         db.refresh(db_assignment)
-        driver = db.query(Driver).filter(Driver.id == assignment.driver_id).first()
-        if driver:
-            driver.availability = False
-            db.commit()
+        driver_index.remove(assignment.driver_id)
         return db_assignment
 
     @staticmethod
@@ -260,6 +396,7 @@ class CRUD:
         db.add(db_source)
         db.commit()
         db.refresh(db_source)
+        water_source_registry.add(db_source)
         return db_source
 
     @staticmethod
@@ -269,6 +406,7 @@ class CRUD:
             db_driver.is_available = is_available
             db.commit()
             db.refresh(db_driver)
+            driver_index.update(db_driver)
             return db_driver
         return None
 
@@ -276,20 +414,77 @@ class CRUD:
     def get_water_sources(db: Session):
         return db.query(WaterSource).all()
 
+    @staticmethod
+    def orders_query(
+        status: Optional[OrderStatus] = None,
+        customer_id: Optional[str] = None,
+        driver_id: Optional[str] = None,
+    ):
+        """Order rows with their latest assigned driver, for listing and export."""
+        assigned_driver = (
+            select(OrderAssignment.driver_id)
+            .where(OrderAssignment.order_id == Order.id)
+            .order_by(OrderAssignment.id.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+        query = select(
+            Order.id, Order.quantity, Order.status, Order.customer_id, Order.total_price,
+            assigned_driver.label("driver_id"),
+        )
+        if status is not None:
+            query = query.where(Order.status == status)
+        if customer_id is not None:
+            query = query.where(Order.customer_id == customer_id)
+        if driver_id is not None:
+            query = query.where(
+                Order.id.in_(select(OrderAssignment.order_id).where(OrderAssignment.driver_id == driver_id))
+            )
+        return query
+
+    @staticmethod
+    def drivers_query(is_available: Optional[bool] = None):
+        query = select(
+            Driver.id, Driver.name, Driver.phone, Driver.vehicle_number, Driver.is_available,
+            Driver.location, Driver.latitude, Driver.longitude,
+        )
+        if is_available is not None:
+            query = query.where(Driver.is_available == is_available)
+        return query
+
+    @staticmethod
+    def customers_query():
+        return select(Customer.id, Customer.phone, Customer.location, Customer.latitude, Customer.longitude)
+
+    @staticmethod
+    def keyset_page(
+        db: Session, query, after: Optional[str] = None, limit: int = LIST_PAGE_SIZE, descending: bool = False
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """One page of a *_query, ordered by its ULID id (so by creation time) and starting after the given id.
+
+        Returns the rows and the id to pass as after for the next page, or None on the last page.
+        """
+        key = query.selected_columns.id
+        if after is not None:
+            query = query.where(key < after if descending else key > after)
+        query = query.order_by(key.desc() if descending else key).limit(limit + 1)
+        rows = [dict(row) for row in db.execute(query).mappings()]
+        next_after = rows[limit - 1]["id"] if len(rows) > limit else None
+        return rows[:limit], next_after
+
+    @staticmethod
+    def stream_rows(db: Session, query, batch_size: int = 1000):
+        """Every row of a *_query in id order, fetched batch_size at a time over a server-side cursor."""
+        result = db.execute(query.order_by(query.selected_columns.id).execution_options(yield_per=batch_size))
+        for row in result.mappings():
+            yield dict(row)
+
 
     @staticmethod
     def find_closest_water_source(driver_lat: float, driver_lng: float, db: Session):
-        sources = CRUD.get_water_sources(db)
-        closest_source = None
-        min_distance = float("inf")
-        for source in sources:
-            distance = CRUD.calculate_distance(
-                driver_lat, driver_lng, source.latitude, source.longitude
-            )
-            if distance is not None and distance < min_distance:
-                min_distance = distance
-                closest_source = source
-        return closest_source, min_distance
+        water_source_registry.ensure_loaded(db)
+        sources = water_source_registry.nearest(driver_lat, driver_lng)
+        return CRUD.closest_by_distance(driver_lat, driver_lng, sources, db)
 
     @staticmethod
     def create_customer_order_assignment_price(
@@ -329,11 +524,16 @@ class CRUD:
                 )
                 db.add(order)
 
-                # Find an available driver and dis
-                driver = db.query(Driver).filter(Driver.availability == True).first() 
+                # Find an available driver and claim them atomically
+                driver = None
+                candidates = db.query(Driver.id).filter(Driver.is_available == True).limit(DISPATCH_CANDIDATES).all()
+                for (driver_id,) in candidates:
+                    if CRUD.claim_driver(db, driver_id):
+                        driver = db.get(Driver, driver_id)
+                        break
                 if not driver:
                     raise ValueError("No available drivers found")
-                
+
 
                 # Create OrderAssignment
                 order_assignment = OrderAssignment(
@@ -346,20 +546,11 @@ class CRUD:
                 # Calculate price based on distance to nearest water source
                 total_price = None
                 if customer.latitude is not None and customer.longitude is not None:
-                    water_sources = db.query(WaterSource).all()
-                    if not water_sources:
-                        raise ValueError("No water sources found")
-
-                    min_distance = float('inf')
-                    for source in water_sources:
-                        if source.latitude is None or source.longitude is None:
-                            continue
-                        distance = crud.calculate_distance(
-                            customer.latitude, customer.longitude, source.latitude, source.longitude
-                        )
-                        min_distance = min(min_distance, distance)
-
-                    if min_distance != float('inf'):
+                    min_distance = CRUD.nearest_water_source_distance(
+                        db, customer.latitude, customer.longitude
+                    )
+
+                    if min_distance is not None:
                         total_price = base_price + (min_distance * price_per_km) + tax
 
                 # Create Price
@@ -0,0 +1,72 @@
+"""Bring a database's schema in line with the models: `python -m app.database.migrate`.
+
+The app no longer creates tables when it is imported, so this is how a
+new database gets its schema: missing tables are created first. Then
+indexes are reconciled. create_all only builds indexes for the tables it
+creates, so databases created before the index overhaul keep the
+redundant unique ix_<table>_id index next to each primary key and lack
+the lookup indexes added since. This drops the former and creates the
+latter. It is safe to run again.
+"""
+import logging
+from typing import Dict, List
+
+from sqlalchemy import Index, MetaData, inspect
+
+from app.settings import load_settings
+
+if __name__ == "__main__":
+    # Run as a script: load .env before the modules below read their settings
+    load_settings()
+
+from app.database.setup import Base, get_engine
+import app.models  # noqa: F401  (registers the tables on Base.metadata)
+
+logger = logging.getLogger(__name__)
+
+
+def create_tables(bind=None) -> List[str]:
+    bind = bind if bind is not None else get_engine()
+    existing = set(inspect(bind).get_table_names())
+    Base.metadata.create_all(bind=bind)
+    return [table.name for table in Base.metadata.sorted_tables if table.name not in existing]
+
+
+def upgrade_indexes(bind=None) -> Dict[str, List[str]]:
+    bind = bind if bind is not None else get_engine()
+    inspector = inspect(bind)
+    # Detached copies of the tables, so dropped indexes never join the live metadata
+    detached = MetaData()
+    dropped: List[str] = []
+    created: List[str] = []
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+
+            redundant = f"ix_{table.name}_id"
+            if redundant in existing and "id" in table.c and table.c.id.primary_key:
+                Index(redundant, table.to_metadata(detached).c.id).drop(connection)
+                dropped.append(redundant)
+
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(connection)
+                    created.append(index.name)
+    return {"dropped": dropped, "created": created}
+
+
+def upgrade(bind=None) -> Dict[str, List[str]]:
+    tables = create_tables(bind)
+    changes = upgrade_indexes(bind)
+    logger.info(
+        f"Created tables {tables or 'none'}; dropped indexes {changes['dropped'] or 'none'}; "
+        f"created indexes {changes['created'] or 'none'}"
+    )
+    return {"tables": tables, **changes}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    upgrade()
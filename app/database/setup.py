@@ -1,19 +1,55 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
+from app.database.pool import PoolStats, engine_options, pool_status
 
 # Get the database URL from the .env file
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
 
-# Create SQLAlchemy engine
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# Async driver used for each sync backend when ASYNC_DATABASE_URL is not set
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+# Checkout wait statistics, one per engine
+sync_pool_stats = PoolStats()
+async_pool_stats = PoolStats()
+
+_engine = None
+
+
+def get_engine():
+    # Created on first use so importing the app never touches the database driver
+    global _engine
+    if _engine is None:
+        if not SQLALCHEMY_DATABASE_URL:
+            raise RuntimeError("DATABASE_URL is not set")
+        _engine = create_engine(
+            SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL, sync_pool_stats)
+        )
+    return _engine
+
+
+def __getattr__(name):
+    # `from app.database.setup import engine` keeps working, creating the engine at that point
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class LazySession(Session):
+    """Session bound to the sync engine when it is opened rather than when the factory is built."""
+
+    def __init__(self, bind=None, **kwargs):
+        super().__init__(bind=bind if bind is not None else get_engine(), **kwargs)
+
 
 # Create a configured "Session" class
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = sessionmaker(class_=LazySession, autocommit=False, autoflush=False)
 
 # Create a Base class for our models
 Base = declarative_base()
@@ -24,4 +60,66 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+def async_database_url() -> str:
+    """ASYNC_DATABASE_URL, or DATABASE_URL switched to its async driver."""
+    url = os.getenv("ASYNC_DATABASE_URL")
+    if url:
+        return url
+    sync_url = make_url(SQLALCHEMY_DATABASE_URL)
+    backend = sync_url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f"No async driver configured for {backend}; set ASYNC_DATABASE_URL")
+    return sync_url.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+
+_async_engine = None
+_async_session_factory = None
+
+
+def get_async_engine():
+    # Created on first use so the async driver is only required by code that needs it
+    global _async_engine
+    if _async_engine is None:
+        url = async_database_url()
+        _async_engine = create_async_engine(url, **engine_options(url, async_pool_stats, async_=True))
+    return _async_engine
+
+
+def async_session_factory() -> async_sessionmaker:
+    global _async_session_factory
+    if _async_session_factory is None:
+        _async_session_factory = async_sessionmaker(
+            get_async_engine(), class_=AsyncSession, autoflush=False, expire_on_commit=False
+        )
+    return _async_session_factory
+
+
+# Dependency to get async DB session
+async def get_async_db():
+    async with async_session_factory()() as db:
+        yield db
+
+
+def pool_stats():
+    """Live pool usage for each engine that has been created."""
+    stats = {}
+    if _engine is not None:
+        stats["sync"] = pool_status(_engine.pool, sync_pool_stats)
+    if _async_engine is not None:
+        stats["async"] = pool_status(_async_engine.sync_engine.pool, async_pool_stats)
+    return stats
+
+
+async def dispose_engines():
+    """Close every pooled connection; the engines are recreated if used again."""
+    global _engine, _async_engine, _async_session_factory
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+        _async_session_factory = None
+    if _engine is not None:
+        _engine.dispose()
+        _engine = None
@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.async_crud import async_crud
+from app.database.setup import async_session_factory
+from app.driver_index import driver_index
+from app.driver_locations import driver_locations
+from app.geo import haversine_matrix
+from app.models import Customer, Driver, Order, OrderAssignment, OrderStatus
+from app.order_service import order_service
+from app.whatsapp import outbox_worker
+
+logger = logging.getLogger(__name__)
+
+# How long orders are collected before they are matched together
+DISPATCH_WINDOW_SECONDS = float(os.getenv("DISPATCH_WINDOW_SECONDS", "5"))
+# Oldest pending orders considered per window; the rest carry over
+DISPATCH_BATCH_SIZE = int(os.getenv("DISPATCH_BATCH_SIZE", "200"))
+# Nearest drivers per order that enter the cost matrix
+DISPATCH_BATCH_CANDIDATES = int(os.getenv("DISPATCH_BATCH_CANDIDATES", "10"))
+# Pairs further apart than this are never matched
+DISPATCH_MAX_KM = float(os.getenv("DISPATCH_MAX_KM", "30"))
+DISPATCH_SOLVER_BUDGET_MS = float(os.getenv("DISPATCH_SOLVER_BUDGET_MS", "200"))
+
+
+def _complete_greedily(cost: np.ndarray, row_of: np.ndarray):
+    """Give every unmatched row its cheapest free column, cheapest rows first."""
+    free = row_of < 0
+    matched = np.zeros(cost.shape[0], dtype=bool)
+    matched[row_of[row_of >= 0]] = True
+    rows = np.flatnonzero(~matched)
+    for i in rows[np.argsort(cost[rows].min(axis=1))]:
+        if not free.any():
+            break
+        j = int(np.argmin(np.where(free, cost[i], np.inf)))
+        row_of[j] = i
+        free[j] = False
+
+
+def solve_assignment(
+    cost: np.ndarray, budget_seconds: float, max_cost: float = np.inf
+) -> Tuple[List[Tuple[int, int]], bool]:
+    """Minimum total cost matching of rows to columns.
+
+    Hungarian algorithm in its shortest augmenting path form, adding one row
+    at a time with the column scan vectorized. Pairs costing more than
+    max_cost are never returned. If budget_seconds runs out, the rows not
+    yet added are matched greedily. Returns the (row, column) pairs and
+    whether the budget was hit.
+    """
+    n, m = cost.shape
+    if n == 0 or m == 0:
+        return [], False
+    if n > m:
+        pairs, timed_out = solve_assignment(cost.T, budget_seconds, max_cost)
+        return [(i, j) for j, i in pairs], timed_out
+
+    feasible = cost <= max_cost
+    if not feasible.any():
+        return [], False
+    # Infeasible pairs cost more than any set of feasible ones, so they are only used when unavoidable
+    penalty = (float(cost[feasible].max()) + 1.0) * (n + 1)
+    cost = np.where(feasible, cost, penalty)
+
+    deadline = time.perf_counter() + budget_seconds
+    # Potentials and matching, 1-based with column 0 as the augmenting path root
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    row_of = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+    timed_out = False
+    for i in range(1, n + 1):
+        if time.perf_counter() > deadline:
+            timed_out = True
+            break
+        row_of[0] = i
+        column = 0
+        min_slack = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[column] = True
+            row = row_of[column]
+            free = ~used[1:]
+            slack = cost[row - 1] - u[row] - v[1:]
+            better = free & (slack < min_slack[1:])
+            min_slack[1:][better] = slack[better]
+            way[1:][better] = column
+            candidates = np.where(free, min_slack[1:], np.inf)
+            next_column = int(np.argmin(candidates)) + 1
+            delta = candidates[next_column - 1]
+            u[row_of[used]] += delta
+            v[used] -= delta
+            min_slack[1:][free] -= delta
+            column = next_column
+            if row_of[column] == 0:
+                break
+        while column:
+            previous = way[column]
+            row_of[column] = row_of[previous]
+            column = previous
+
+    row_of = row_of[1:] - 1
+    if timed_out:
+        _complete_greedily(cost, row_of)
+    pairs = sorted((int(i), j) for j, i in enumerate(row_of) if i >= 0 and feasible[i, j])
+    return pairs, timed_out
+
+
+class BatchDispatcher:
+    """Matches pending orders to drivers in windows instead of one message at a time.
+
+    Every DISPATCH_WINDOW_SECONDS the oldest unassigned orders and their
+    nearby available drivers are loaded, a great-circle cost matrix is built
+    and the whole window is solved at once, so a driver who is second best
+    for one order can go to the order they suit best. Orders that get no
+    driver, or lose one to a concurrent claim, stay pending for the next
+    window. Used when DISPATCH_MODE=batch.
+    """
+
+    def __init__(self, session_factory=None):
+        self.session_factory = session_factory
+        self._task: Optional[asyncio.Task] = None
+        self.windows = 0
+        self.assigned = 0
+        self.carried_over = 0
+        self.solver_timeouts = 0
+        self.last_solve_ms = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @staticmethod
+    async def _pending_orders(db: AsyncSession):
+        result = await db.execute(
+            select(Order, Customer)
+            .join(Customer, Order.customer_id == Customer.id)
+            .outerjoin(OrderAssignment, OrderAssignment.order_id == Order.id)
+            .where(
+                Order.status == OrderStatus.PENDING,
+                OrderAssignment.id.is_(None),
+                Customer.latitude.is_not(None),
+                Customer.longitude.is_not(None),
+            )
+            .order_by(Order.id)
+            .limit(DISPATCH_BATCH_SIZE)
+        )
+        return result.all()
+
+    @staticmethod
+    async def _candidate_drivers(db: AsyncSession, customers: List[Customer]) -> List[Driver]:
+        await driver_index.aensure_fresh(db)
+        candidate_ids = {
+            driver_id
+            for customer in customers
+            for driver_id, _ in driver_index.nearest(
+                customer.latitude, customer.longitude, DISPATCH_BATCH_CANDIDATES
+            )
+        }
+        if not candidate_ids:
+            return []
+        drivers = (
+            await db.scalars(
+                select(Driver).where(Driver.id.in_(candidate_ids), Driver.is_available == True)
+            )
+        ).all()
+        current = {driver.id for driver in drivers}
+        for driver_id in candidate_ids - current:
+            driver_index.remove(driver_id)
+        driver_locations.overlay(drivers)
+        return list(drivers)
+
+    @staticmethod
+    async def _claim_order(db: AsyncSession, order_id: str) -> bool:
+        result = await db.execute(
+            update(Order)
+            .where(Order.id == order_id, Order.status == OrderStatus.PENDING)
+            .values(status=OrderStatus.CONFIRMED)
+        )
+        return result.rowcount == 1
+
+    async def dispatch_once(self) -> int:
+        """Match one window of pending orders; returns how many were assigned."""
+        session_factory = self.session_factory or async_session_factory()
+        async with session_factory() as db:
+            pending = await self._pending_orders(db)
+            if not pending:
+                return 0
+            self.windows += 1
+            customers = [customer for _, customer in pending]
+            drivers = await self._candidate_drivers(db, customers)
+
+            cost = haversine_matrix(
+                [c.latitude for c in customers], [c.longitude for c in customers],
+                [d.latitude for d in drivers], [d.longitude for d in drivers],
+            )
+            started = time.perf_counter()
+            pairs, timed_out = solve_assignment(cost, DISPATCH_SOLVER_BUDGET_MS / 1000, DISPATCH_MAX_KM)
+            self.last_solve_ms = (time.perf_counter() - started) * 1000
+            if timed_out:
+                self.solver_timeouts += 1
+                logger.warning(
+                    f"Dispatch solver hit its {DISPATCH_SOLVER_BUDGET_MS}ms budget on "
+                    f"{len(customers)}x{len(drivers)}; finished greedily"
+                )
+
+            claimed = []
+            for i, j in pairs:
+                order, customer = pending[i]
+                driver = drivers[j]
+                # Another dispatcher, or an admin, may have touched the order or driver since we loaded them
+                if not await self._claim_order(db, order.id):
+                    continue
+                if not await async_crud.claim_driver(db, driver.id):
+                    await db.execute(
+                        update(Order).where(Order.id == order.id).values(status=OrderStatus.PENDING)
+                    )
+                    driver_index.remove(driver.id)
+                    continue
+                order_service.stage_assignment(
+                    db, order.id, order.quantity, order.total_price, customer, driver
+                )
+                claimed.append(driver.id)
+            await db.commit()
+
+        for driver_id in claimed:
+            driver_index.remove(driver_id)
+        if claimed:
+            outbox_worker.notify()
+        self.assigned += len(claimed)
+        self.carried_over = len(pending) - len(claimed)
+        return len(claimed)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(DISPATCH_WINDOW_SECONDS)
+            try:
+                await self.dispatch_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Batch dispatcher error: {str(e)}")
+
+    def stats(self) -> Dict:
+        return {
+            "window_seconds": DISPATCH_WINDOW_SECONDS,
+            "windows": self.windows,
+            "assigned": self.assigned,
+            "carried_over": self.carried_over,
+            "solver_timeouts": self.solver_timeouts,
+            "last_solve_ms": round(self.last_solve_ms, 3),
+        }
+
+
+batch_dispatcher = BatchDispatcher()
@@ -0,0 +1,573 @@
+import asyncio
+import contextvars
+import gzip
+import heapq
+import logging
+import math
+import os
+import statistics
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.settings import load_settings
+
+if __name__ == "__main__":
+    # Run as a script: load .env before the modules below read their settings
+    load_settings()
+
+from app.distance_cache import distance_cache
+from app.geo import geohash_center, haversine_km, haversine_matrix
+from app.metrics import distance_lookups, distance_matrix_requests, span
+from app.models import CachedDistance
+from app.outbound import Upstream, UpstreamUnavailable
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")
+
+# Overridable so load tests can point at benchmarks.stubs instead of Google
+DISTANCE_MATRIX_URL = os.getenv(
+    "DISTANCE_MATRIX_URL", "https://maps.googleapis.com/maps/api/distancematrix/json"
+)
+# Google caps a single Distance Matrix request at 25 destinations
+DISTANCE_MATRIX_MAX_DESTINATIONS = 25
+DISTANCE_MATRIX_WORKERS = int(os.getenv("DISTANCE_MATRIX_WORKERS", "4"))
+DISTANCE_MATRIX_TIMEOUT_SECONDS = float(os.getenv("DISTANCE_MATRIX_TIMEOUT_SECONDS", "5"))
+# Send a second copy of a Distance Matrix request still unanswered after this long; 0 disables
+DISTANCE_MATRIX_HEDGE_MS = float(os.getenv("DISTANCE_MATRIX_HEDGE_MS", "0"))
+
+# Road km per great-circle km for the offline provider; `python -m app.distance` fits it to cached Google results
+DISTANCE_CIRCUITY_FACTOR = float(os.getenv("DISTANCE_CIRCUITY_FACTOR", "1.3"))
+# OSM XML extract (.osm or .osm.gz) for the road_graph provider
+DISTANCE_ROAD_GRAPH_PATH = os.getenv("DISTANCE_ROAD_GRAPH_PATH", "")
+# Points further than this from any road node get no road_graph distance
+DISTANCE_ROAD_GRAPH_SNAP_KM = float(os.getenv("DISTANCE_ROAD_GRAPH_SNAP_KM", "0.5"))
+DISTANCE_ROAD_GRAPH_MAX_KM = float(os.getenv("DISTANCE_ROAD_GRAPH_MAX_KM", "100"))
+
+# "google", "offline" or "road_graph". Ranking orders candidates (drivers, nearest
+# water sources); billing is the distance the customer pays for.
+_DEFAULT_PROVIDER = "google" if GOOGLE_MAPS_API_KEY else "offline"
+DISTANCE_RANKING_PROVIDER = os.getenv("DISTANCE_RANKING_PROVIDER", _DEFAULT_PROVIDER)
+DISTANCE_BILLING_PROVIDER = os.getenv("DISTANCE_BILLING_PROVIDER", _DEFAULT_PROVIDER)
+# Answers whatever the chosen provider could not (API errors, off-graph points); empty disables
+DISTANCE_FALLBACK_PROVIDER = os.getenv("DISTANCE_FALLBACK_PROVIDER", "offline")
+# Also bill on fallback estimates; off, an order whose billing distance is unanswered is not priced
+DISTANCE_BILLING_FALLBACK = os.getenv("DISTANCE_BILLING_FALLBACK", "false").lower() in ("1", "true", "yes")
+
+RANKING = "ranking"
+BILLING = "billing"
+
+Point = Tuple[float, float]
+
+_distance_executor = ThreadPoolExecutor(
+    max_workers=DISTANCE_MATRIX_WORKERS, thread_name_prefix="distance-matrix"
+)
+distance_upstream = Upstream(
+    "distance_matrix",
+    timeout=DISTANCE_MATRIX_TIMEOUT_SECONDS,
+    hedge_after_seconds=DISTANCE_MATRIX_HEDGE_MS / 1000,
+)
+
+
+class Distances(list):
+    """Distances in km, one per destination; estimated holds the indexes the fallback provider answered."""
+
+    def __init__(self, distances=(), estimated=()):
+        super().__init__(distances)
+        self.estimated = frozenset(estimated)
+
+
+def _with_coordinates(destinations: Sequence[Point]) -> List[int]:
+    return [i for i, (lat, lng) in enumerate(destinations) if lat is not None and lng is not None]
+
+
+class DistanceProvider:
+    """Road distances in km from one origin to many destinations.
+
+    Entries are None where the destination has no coordinates or the
+    provider has no answer. db is only used by providers with a database
+    tier (a Session for distances(), an AsyncSession for adistances()).
+    """
+
+    name = ""
+
+    def distances(self, origin: Point, destinations: Sequence[Point], db=None) -> List[Optional[float]]:
+        raise NotImplementedError
+
+    async def adistances(self, origin: Point, destinations: Sequence[Point], db=None) -> List[Optional[float]]:
+        return self.distances(origin, destinations)
+
+
+class OfflineDistanceProvider(DistanceProvider):
+    """Great-circle distance times a road circuity factor; long destination lists take one NumPy call."""
+
+    name = "offline"
+    # Below this many destinations the NumPy call overhead outweighs the loop it replaces
+    VECTOR_MIN = 16
+
+    def __init__(self, circuity: float = DISTANCE_CIRCUITY_FACTOR):
+        self.circuity = circuity
+
+    def distances(self, origin: Point, destinations: Sequence[Point], db=None) -> List[Optional[float]]:
+        result: List[Optional[float]] = [None] * len(destinations)
+        index = _with_coordinates(destinations)
+        if not index:
+            return result
+        if len(index) < self.VECTOR_MIN:
+            for i in index:
+                result[i] = haversine_km(origin[0], origin[1], *destinations[i]) * self.circuity
+        else:
+            km = haversine_matrix(
+                [origin[0]], [origin[1]], [destinations[i][0] for i in index], [destinations[i][1] for i in index]
+            )[0] * self.circuity
+            for i, distance in zip(index, km.tolist()):
+                result[i] = distance
+        distance_lookups.inc(self.name, amount=len(index))
+        return result
+
+
+class GoogleDistanceProvider(DistanceProvider):
+    """Google Distance Matrix behind the two-tier distance cache.
+
+    Cache misses are packed into as few requests as the API allows and the
+    chunks are fetched concurrently. Failed lookups are None and are not cached.
+    """
+
+    name = "google"
+
+    def distances(self, origin: Point, destinations: Sequence[Point], db: Optional[Session] = None):
+        distances: List[Optional[float]] = [None] * len(destinations)
+        keys = self._keys(origin, destinations)
+        if not keys:
+            return distances
+
+        cached = distance_cache.get_many(list(set(keys.values())), db)
+        pending = self._fill_cached(distances, keys, cached)
+        if not pending:
+            return distances
+
+        chunks = self._chunks(pending)
+        if len(chunks) == 1:
+            results = [self._fetch_chunk(origin, [destinations[i] for i in chunks[0]])]
+        else:
+            # Each thread gets a copy of the context so the caller's deadline applies
+            results = list(_distance_executor.map(
+                lambda chunk, context: context.run(self._fetch_chunk, origin, [destinations[i] for i in chunk]),
+                chunks,
+                [contextvars.copy_context() for _ in chunks],
+            ))
+
+        fresh = self._fill_fetched(distances, keys, chunks, results)
+        distance_cache.set_many(fresh, db)
+        return distances
+
+    async def adistances(self, origin: Point, destinations: Sequence[Point], db=None):
+        distances: List[Optional[float]] = [None] * len(destinations)
+        keys = self._keys(origin, destinations)
+        if not keys:
+            return distances
+
+        cached = await distance_cache.aget_many(list(set(keys.values())), db)
+        pending = self._fill_cached(distances, keys, cached)
+        if not pending:
+            return distances
+
+        chunks = self._chunks(pending)
+        results = await asyncio.gather(*(
+            self._afetch_chunk(origin, [destinations[i] for i in chunk]) for chunk in chunks
+        ))
+
+        fresh = self._fill_fetched(distances, keys, chunks, results)
+        await distance_cache.aset_many(fresh, db)
+        return distances
+
+    def _fetch_chunk(self, origin: Point, destinations: List[Point]) -> List[Optional[float]]:
+        """Fetch one Distance Matrix row for up to DISTANCE_MATRIX_MAX_DESTINATIONS destinations."""
+        try:
+            with span("distance_matrix_request"):
+                response = distance_upstream.request_sync(
+                    "GET", DISTANCE_MATRIX_URL, params=self._params(origin, destinations)
+                )
+                response.raise_for_status()
+                row = self._parse_row(response.json(), len(destinations))
+            distance_matrix_requests.inc("ok")
+            return row
+        except UpstreamUnavailable:
+            # Not attempted; the fallback provider answers instead
+            distance_matrix_requests.inc("skipped")
+            return [None] * len(destinations)
+        except Exception as e:
+            distance_matrix_requests.inc("error")
+            logger.error(f"Error calculating distance: {str(e)}")
+            return [None] * len(destinations)
+
+    async def _afetch_chunk(self, origin: Point, destinations: List[Point]) -> List[Optional[float]]:
+        try:
+            with span("distance_matrix_request"):
+                # Lookups are idempotent, so a slow one may be hedged
+                response = await distance_upstream.request(
+                    "GET", DISTANCE_MATRIX_URL, hedge=True, params=self._params(origin, destinations)
+                )
+                response.raise_for_status()
+                row = self._parse_row(response.json(), len(destinations))
+            distance_matrix_requests.inc("ok")
+            return row
+        except UpstreamUnavailable:
+            distance_matrix_requests.inc("skipped")
+            return [None] * len(destinations)
+        except Exception as e:
+            distance_matrix_requests.inc("error")
+            logger.error(f"Error calculating distance: {str(e)}")
+            return [None] * len(destinations)
+
+    @staticmethod
+    def _params(origin: Point, destinations: List[Point]) -> Dict:
+        return {
+            "origins": f"{origin[0]},{origin[1]}",
+            "destinations": "|".join(f"{lat},{lng}" for lat, lng in destinations),
+            "mode": "driving",
+            "key": GOOGLE_MAPS_API_KEY,
+        }
+
+    @staticmethod
+    def _parse_row(data: Dict, count: int) -> List[Optional[float]]:
+        """Distances in km from a one-origin Distance Matrix response."""
+        if data["status"] != "OK" or not data["rows"]:
+            logger.error(f"Distance Matrix API error: {data}")
+            return [None] * count
+        distances = []
+        for element in data["rows"][0]["elements"]:
+            if element.get("status") != "OK":
+                distances.append(None)
+                continue
+            distances.append(element["distance"]["value"] / 1000)
+        return distances
+
+    @staticmethod
+    def _keys(origin: Point, destinations: Sequence[Point]) -> Dict[int, Tuple[str, str]]:
+        """Cache key per destination index, for destinations that have coordinates."""
+        return {i: distance_cache.key(origin, destinations[i]) for i in _with_coordinates(destinations)}
+
+    @staticmethod
+    def _fill_cached(distances: List, keys: Dict, cached: Dict) -> List[int]:
+        """Copy cache hits into distances and return the indexes still to fetch."""
+        pending = []
+        for i, key in keys.items():
+            if key in cached:
+                distances[i] = cached[key]
+            else:
+                pending.append(i)
+        distance_lookups.inc("cache", amount=len(keys) - len(pending))
+        distance_lookups.inc("api", amount=len(pending))
+        return pending
+
+    @staticmethod
+    def _chunks(pending: List[int]) -> List[List[int]]:
+        return [
+            pending[i:i + DISTANCE_MATRIX_MAX_DESTINATIONS]
+            for i in range(0, len(pending), DISTANCE_MATRIX_MAX_DESTINATIONS)
+        ]
+
+    @staticmethod
+    def _fill_fetched(distances: List, keys: Dict, chunks: List, results: List) -> Dict:
+        """Copy fetched chunk results into distances and return the new cache entries."""
+        fresh = {}
+        for chunk, chunk_distances in zip(chunks, results):
+            for i, distance in zip(chunk, chunk_distances):
+                distances[i] = distance
+                if distance is not None:
+                    fresh[keys[i]] = distance
+        return fresh
+
+
+# highway=* values a water truck can drive on
+DRIVABLE_HIGHWAYS = {
+    "motorway", "motorway_link", "trunk", "trunk_link", "primary", "primary_link",
+    "secondary", "secondary_link", "tertiary", "tertiary_link", "unclassified",
+    "residential", "living_street", "service", "road", "track",
+}
+
+
+class RoadGraphDistanceProvider(DistanceProvider):
+    """Shortest paths over a road graph built from an exported OpenStreetMap extract.
+
+    The extract is OSM XML (e.g. `osmium cat city.osm.pbf -o city.osm`),
+    optionally gzipped, and is loaded on first use. Points are snapped to
+    the nearest road node within DISTANCE_ROAD_GRAPH_SNAP_KM; one Dijkstra
+    run from the origin answers every destination. Oneway tags are honoured.
+    """
+
+    name = "road_graph"
+    # Snapping grid cell in degrees (~1.1 km)
+    CELL_DEG = 0.01
+
+    def __init__(
+        self,
+        path: str,
+        snap_km: float = DISTANCE_ROAD_GRAPH_SNAP_KM,
+        max_km: float = DISTANCE_ROAD_GRAPH_MAX_KM,
+    ):
+        self.path = path
+        self.snap_km = snap_km
+        self.max_km = max_km
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._lats: List[float] = []
+        self._lngs: List[float] = []
+        self._edges: List[List[Tuple[int, float]]] = []
+        self._cells: Dict[Tuple[int, int], List[int]] = {}
+
+    def load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            started = time.perf_counter()
+            coordinates, ways = self._parse(self.path)
+            index: Dict[str, int] = {}
+            for refs, _ in ways:
+                for ref in refs:
+                    if ref not in index and ref in coordinates:
+                        index[ref] = len(index)
+                        lat, lng = coordinates[ref]
+                        self._lats.append(lat)
+                        self._lngs.append(lng)
+                        self._edges.append([])
+                        self._cells.setdefault(self._cell(lat, lng), []).append(index[ref])
+            for refs, direction in ways:
+                nodes = [index[ref] for ref in refs if ref in index]
+                for a, b in zip(nodes, nodes[1:]):
+                    km = haversine_km(self._lats[a], self._lngs[a], self._lats[b], self._lngs[b])
+                    if direction >= 0:
+                        self._edges[a].append((b, km))
+                    if direction <= 0:
+                        self._edges[b].append((a, km))
+            self._loaded = True
+            logger.info(
+                f"Loaded road graph {self.path}: {len(self._lats)} nodes, {len(ways)} ways "
+                f"in {time.perf_counter() - started:.1f}s"
+            )
+
+    @staticmethod
+    def _parse(path: str):
+        if path.endswith(".pbf"):
+            raise ValueError(f"{path}: convert the extract to OSM XML first, e.g. `osmium cat {path} -o extract.osm`")
+        coordinates: Dict[str, Point] = {}
+        ways: List[Tuple[List[str], int]] = []
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as f:
+            for _, element in ET.iterparse(f, events=("end",)):
+                if element.tag == "node":
+                    coordinates[element.get("id")] = (float(element.get("lat")), float(element.get("lon")))
+                    element.clear()
+                elif element.tag == "way":
+                    tags = {tag.get("k"): tag.get("v") for tag in element.iter("tag")}
+                    if tags.get("highway") in DRIVABLE_HIGHWAYS:
+                        refs = [nd.get("ref") for nd in element.iter("nd")]
+                        ways.append((refs, RoadGraphDistanceProvider._direction(tags)))
+                    element.clear()
+        return coordinates, ways
+
+    @staticmethod
+    def _direction(tags: Dict[str, str]) -> int:
+        """1 for along the way only, -1 for against it only, 0 for both."""
+        oneway = tags.get("oneway")
+        if oneway in ("yes", "true", "1"):
+            return 1
+        if oneway == "-1":
+            return -1
+        if oneway == "no":
+            return 0
+        if tags.get("junction") in ("roundabout", "circular") or tags.get("highway") == "motorway":
+            return 1
+        return 0
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return int(math.floor(lat / self.CELL_DEG)), int(math.floor(lng / self.CELL_DEG))
+
+    def snap(self, lat: float, lng: float) -> Optional[Tuple[int, float]]:
+        """(node, km to it) of the closest road node within snap_km."""
+        row, col = self._cell(lat, lng)
+        lat_cells = math.ceil(self.snap_km / (110.57 * self.CELL_DEG))
+        lng_cells = math.ceil(self.snap_km / (111.32 * self.CELL_DEG * max(math.cos(math.radians(lat)), 0.01)))
+        best = None
+        for r in range(row - lat_cells, row + lat_cells + 1):
+            for c in range(col - lng_cells, col + lng_cells + 1):
+                for node in self._cells.get((r, c), ()):
+                    km = haversine_km(lat, lng, self._lats[node], self._lngs[node])
+                    if km <= self.snap_km and (best is None or km < best[1]):
+                        best = (node, km)
+        return best
+
+    def _shortest(self, source: int, targets: set) -> Dict[int, float]:
+        """Dijkstra from source, stopping once every target is settled or max_km is exceeded."""
+        settled: Dict[int, float] = {}
+        best = {source: 0.0}
+        heap = [(0.0, source)]
+        remaining = set(targets)
+        while heap and remaining:
+            km, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            if km > self.max_km:
+                break
+            settled[node] = km
+            remaining.discard(node)
+            for neighbour, length in self._edges[node]:
+                candidate = km + length
+                if candidate < best.get(neighbour, math.inf):
+                    best[neighbour] = candidate
+                    heapq.heappush(heap, (candidate, neighbour))
+        return settled
+
+    def distances(self, origin: Point, destinations: Sequence[Point], db=None) -> List[Optional[float]]:
+        self.load()
+        result: List[Optional[float]] = [None] * len(destinations)
+        index = _with_coordinates(destinations)
+        start = self.snap(*origin)
+        if start is None or not index:
+            return result
+        snapped = {i: self.snap(*destinations[i]) for i in index}
+        settled = self._shortest(start[0], {s[0] for s in snapped.values() if s is not None})
+        for i, end in snapped.items():
+            if end is not None and end[0] in settled:
+                result[i] = start[1] + settled[end[0]] + end[1]
+        distance_lookups.inc(self.name, amount=len(index))
+        return result
+
+    async def adistances(self, origin: Point, destinations: Sequence[Point], db=None) -> List[Optional[float]]:
+        # Loading and path search are CPU-bound; keep them off the event loop
+        return await asyncio.to_thread(self.distances, origin, destinations)
+
+
+class DistancePolicy:
+    """Picks the provider per purpose and fills gaps from the fallback provider.
+
+    Ranking decides which candidate is nearest and may be approximate;
+    billing is the distance an order is priced on, and is only filled
+    from the fallback when billing_fallback allows it. Results say which
+    entries are fallback estimates, so callers can avoid caching them.
+    """
+
+    def __init__(
+        self,
+        ranking: DistanceProvider,
+        billing: DistanceProvider,
+        fallback: Optional[DistanceProvider] = None,
+        billing_fallback: bool = DISTANCE_BILLING_FALLBACK,
+    ):
+        self.ranking = ranking
+        self.billing = billing
+        self.fallback = fallback
+        self.billing_fallback = billing_fallback
+
+    @classmethod
+    def from_env(cls) -> "DistancePolicy":
+        providers: Dict[str, DistanceProvider] = {}
+
+        def named(name: str) -> Optional[DistanceProvider]:
+            if not name:
+                return None
+            if name not in providers:
+                if name == "google":
+                    providers[name] = GoogleDistanceProvider()
+                elif name == "offline":
+                    providers[name] = OfflineDistanceProvider()
+                elif name == "road_graph":
+                    if not DISTANCE_ROAD_GRAPH_PATH:
+                        raise ValueError("DISTANCE_ROAD_GRAPH_PATH must be set to use the road_graph provider")
+                    providers[name] = RoadGraphDistanceProvider(DISTANCE_ROAD_GRAPH_PATH)
+                else:
+                    raise ValueError(f"Unknown distance provider {name!r}")
+            return providers[name]
+
+        return cls(
+            named(DISTANCE_RANKING_PROVIDER), named(DISTANCE_BILLING_PROVIDER), named(DISTANCE_FALLBACK_PROVIDER)
+        )
+
+    def provider(self, purpose: str) -> DistanceProvider:
+        return self.ranking if purpose == RANKING else self.billing
+
+    @property
+    def separate_billing(self) -> bool:
+        """Whether a ranked winner needs its distance looked up again for billing."""
+        return self.ranking is not self.billing
+
+    def distances(
+        self, origin: Point, destinations: Sequence[Point], db: Optional[Session] = None, purpose: str = BILLING
+    ) -> Distances:
+        with span("distance_lookup"):
+            provider = self.provider(purpose)
+            distances = provider.distances(origin, destinations, db)
+            missing = self._missing(provider, destinations, distances, purpose)
+            if not missing:
+                return Distances(distances)
+            filled = self.fallback.distances(origin, [destinations[i] for i in missing])
+            return self._fill(distances, missing, filled)
+
+    async def adistances(
+        self, origin: Point, destinations: Sequence[Point], db=None, purpose: str = BILLING
+    ) -> Distances:
+        with span("distance_lookup"):
+            provider = self.provider(purpose)
+            distances = await provider.adistances(origin, destinations, db)
+            missing = self._missing(provider, destinations, distances, purpose)
+            if not missing:
+                return Distances(distances)
+            filled = await self.fallback.adistances(origin, [destinations[i] for i in missing])
+            return self._fill(distances, missing, filled)
+
+    def _missing(
+        self, provider: DistanceProvider, destinations: Sequence[Point], distances: List, purpose: str
+    ) -> List[int]:
+        if self.fallback is None or self.fallback is provider:
+            return []
+        if purpose == BILLING and not self.billing_fallback:
+            return []
+        return [i for i in _with_coordinates(destinations) if distances[i] is None]
+
+    @staticmethod
+    def _fill(distances: List, missing: List[int], filled: List[Optional[float]]) -> Distances:
+        estimated = []
+        for i, distance in zip(missing, filled):
+            distances[i] = distance
+            if distance is not None:
+                estimated.append(i)
+        distance_lookups.inc("fallback", amount=len(estimated))
+        return Distances(distances, estimated)
+
+
+def calibrate_circuity(db: Session, min_km: float = 1.0, limit: int = 50000) -> Optional[float]:
+    """Median ratio of cached Google road distances to great-circle distance between the same cells.
+
+    Pairs closer than min_km are skipped, since snapping to cache cells
+    distorts short distances the most.
+    """
+    rows = db.execute(
+        select(CachedDistance.origin_cell, CachedDistance.destination_cell, CachedDistance.distance_km).limit(limit)
+    ).all()
+    ratios = []
+    for origin_cell, destination_cell, road_km in rows:
+        straight_km = haversine_km(*geohash_center(origin_cell), *geohash_center(destination_cell))
+        if straight_km >= min_km and road_km > 0:
+            ratios.append(road_km / straight_km)
+    return statistics.median(ratios) if ratios else None
+
+
+distance_policy = DistancePolicy.from_env()
+
+
+if __name__ == "__main__":
+    from app.database.setup import SessionLocal
+
+    with SessionLocal() as db:
+        factor = calibrate_circuity(db)
+    if factor is None:
+        print("No cached Google distances of at least 1 km to calibrate from")
+    else:
+        print(f"DISTANCE_CIRCUITY_FACTOR={factor:.3f}  (currently {DISTANCE_CIRCUITY_FACTOR})")
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import os
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.cache import TTLCache
+from app.geo import geohash
+from app.models import CachedDistance, utcnow
+
+logger = logging.getLogger(__name__)
+
+# Geohash length used to snap origins and destinations (7 ~ 150m cells)
+DISTANCE_CACHE_PRECISION = int(os.getenv("DISTANCE_CACHE_PRECISION", "7"))
+DISTANCE_CACHE_SIZE = int(os.getenv("DISTANCE_CACHE_SIZE", "50000"))
+DISTANCE_CACHE_TTL_SECONDS = float(os.getenv("DISTANCE_CACHE_TTL_SECONDS", "86400"))
+DISTANCE_CACHE_DB_TTL_SECONDS = float(os.getenv("DISTANCE_CACHE_DB_TTL_SECONDS", str(30 * 86400)))
+
+CellKey = Tuple[str, str]
+
+# Session.info key of the distances waiting for the session's transaction to end
+_QUEUED = "distance_cache_queued"
+
+
+class DistanceCache:
+    """Two-tier road distance cache: an in-process LRU in front of the distance_cache table.
+
+    Keys are origin/destination geohash cells, so nearby repeat lookups share an entry.
+    Database reads run on the caller's session inside a SAVEPOINT, so a failed
+    read rolls back only the savepoint. Writes are queued on the session and
+    made once its transaction has ended and its connection is back in the
+    pool, so the cache never holds a second connection or row locks while
+    the caller's transaction is open. A road distance does not depend on the
+    caller's outcome, so rows are written after a rollback too.
+    """
+
+    def __init__(
+        self,
+        precision: int = DISTANCE_CACHE_PRECISION,
+        maxsize: int = DISTANCE_CACHE_SIZE,
+        ttl: float = DISTANCE_CACHE_TTL_SECONDS,
+        db_ttl: float = DISTANCE_CACHE_DB_TTL_SECONDS,
+    ):
+        self.precision = precision
+        self.db_ttl = db_ttl
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.db_hits = 0
+        self.db_misses = 0
+        self.db_errors = 0
+        self._writes = set()
+
+    def key(self, origin: Tuple[float, float], destination: Tuple[float, float]) -> CellKey:
+        return (
+            geohash(origin[0], origin[1], self.precision),
+            geohash(destination[0], destination[1], self.precision),
+        )
+
+    def _memory_lookup(self, keys: List[CellKey]) -> Tuple[Dict[CellKey, float], List[CellKey]]:
+        found: Dict[CellKey, float] = {}
+        missing = []
+        for key in keys:
+            distance = self.memory.get(key)
+            if distance is None:
+                missing.append(key)
+            else:
+                found[key] = distance
+        return found, missing
+
+    def _select_rows(self, missing: List[CellKey]):
+        """One SELECT per origin cell for the keys memory missed."""
+        by_origin: Dict[str, List[str]] = {}
+        for origin_cell, destination_cell in missing:
+            by_origin.setdefault(origin_cell, []).append(destination_cell)
+        cutoff = utcnow() - timedelta(seconds=self.db_ttl)
+        for origin_cell, destination_cells in by_origin.items():
+            yield select(CachedDistance).where(
+                CachedDistance.origin_cell == origin_cell,
+                CachedDistance.destination_cell.in_(destination_cells),
+                CachedDistance.created_at >= cutoff,
+            )
+
+    def _record_rows(self, rows, missing: List[CellKey], found: Dict[CellKey, float]):
+        for row in rows:
+            key = (row.origin_cell, row.destination_cell)
+            found[key] = row.distance_km
+            self.memory.set(key, row.distance_km)
+        db_found = sum(1 for key in missing if key in found)
+        self.db_hits += db_found
+        self.db_misses += len(missing) - db_found
+
+    @staticmethod
+    def _rows_to_store(distances: Dict[CellKey, float]) -> List[CachedDistance]:
+        now = utcnow()
+        return [
+            CachedDistance(
+                origin_cell=origin_cell,
+                destination_cell=destination_cell,
+                distance_km=distance,
+                created_at=now,
+            )
+            for (origin_cell, destination_cell), distance in distances.items()
+        ]
+
+    def get_many(self, keys: List[CellKey], db: Optional[Session] = None) -> Dict[CellKey, float]:
+        """Look keys up in memory, then in the database for whatever memory missed."""
+        found, missing = self._memory_lookup(keys)
+        if not missing or db is None:
+            return found
+
+        rows = []
+        try:
+            with db.begin_nested():
+                for statement in self._select_rows(missing):
+                    rows.extend(db.scalars(statement).all())
+        except SQLAlchemyError as e:
+            self.db_errors += 1
+            logger.warning(f"Distance cache read failed: {str(e)}")
+        self._record_rows(rows, missing, found)
+        return found
+
+    async def aget_many(self, keys: List[CellKey], db: Optional[AsyncSession] = None) -> Dict[CellKey, float]:
+        """get_many for async callers."""
+        found, missing = self._memory_lookup(keys)
+        if not missing or db is None:
+            return found
+
+        rows = []
+        try:
+            async with db.begin_nested():
+                for statement in self._select_rows(missing):
+                    rows.extend((await db.scalars(statement)).all())
+        except SQLAlchemyError as e:
+            self.db_errors += 1
+            logger.warning(f"Distance cache read failed: {str(e)}")
+        self._record_rows(rows, missing, found)
+        return found
+
+    def set_many(self, distances: Dict[CellKey, float], db: Optional[Session] = None):
+        """Store fresh distances in memory and, when a session is given, queue them for the database."""
+        for key, distance in distances.items():
+            self.memory.set(key, distance)
+
+        if distances and db is not None:
+            bind = db.get_bind()
+            self._queue(db, distances, lambda rows: self._write(bind, rows))
+
+    async def aset_many(self, distances: Dict[CellKey, float], db: Optional[AsyncSession] = None):
+        """set_many for async callers; the queued rows are written by a task once the transaction ends."""
+        for key, distance in distances.items():
+            self.memory.set(key, distance)
+
+        if distances and db is not None:
+            bind = db.bind
+            self._queue(db.sync_session, distances, lambda rows: self._spawn(self._awrite(bind, rows)))
+
+    @staticmethod
+    def _queue(session: Session, distances: Dict[CellKey, float], write):
+        queued = session.info.setdefault(_QUEUED, (write, {}))[1]
+        queued.update(distances)
+
+    def _write(self, bind, distances: Dict[CellKey, float]):
+        try:
+            with Session(bind) as cache_db:
+                # merge() replaces an expired row for the same cells, if any
+                for row in self._rows_to_store(distances):
+                    cache_db.merge(row)
+                cache_db.commit()
+        except SQLAlchemyError as e:
+            # Usually a concurrent worker cached the same cells first
+            self.db_errors += 1
+            logger.warning(f"Distance cache write failed: {str(e)}")
+
+    async def _awrite(self, bind, distances: Dict[CellKey, float]):
+        try:
+            async with AsyncSession(bind) as cache_db:
+                for row in self._rows_to_store(distances):
+                    await cache_db.merge(row)
+                await cache_db.commit()
+        except SQLAlchemyError as e:
+            self.db_errors += 1
+            logger.warning(f"Distance cache write failed: {str(e)}")
+
+    def _spawn(self, coroutine):
+        # Keep a reference so the write is not garbage collected before it runs
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    def stats(self) -> Dict:
+        return {
+            "precision": self.precision,
+            "memory": self.memory.stats(),
+            "database": {
+                "ttl_seconds": self.db_ttl,
+                "hits": self.db_hits,
+                "misses": self.db_misses,
+                "errors": self.db_errors,
+                "writes_in_flight": len(self._writes),
+            },
+        }
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _write_queued(session: Session, transaction):
+    if transaction.parent is not None:
+        return
+    queued = session.info.pop(_QUEUED, None)
+    if queued is not None:
+        write, distances = queued
+        write(distances)
+
+
+distance_cache = DistanceCache()
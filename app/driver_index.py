@@ -0,0 +1,176 @@
+import os
+import threading
+import time
+from math import cos, radians
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.geo import haversine_km
+from app.models import Driver
+
+# Grid cell edge in degrees (0.05 ~ 5.5km of latitude)
+DRIVER_INDEX_CELL_DEG = float(os.getenv("DRIVER_INDEX_CELL_DEG", "0.05"))
+# Rebuild from the database this often, to pick up changes made by other workers
+DRIVER_INDEX_REFRESH_SECONDS = float(os.getenv("DRIVER_INDEX_REFRESH_SECONDS", "60"))
+
+KM_PER_DEG_LAT = 111.32
+
+Cell = Tuple[int, int]
+
+
+class DriverIndex:
+    """Grid-bucketed index of available drivers for great-circle nearest-k queries."""
+
+    def __init__(
+        self,
+        cell_deg: float = DRIVER_INDEX_CELL_DEG,
+        refresh_seconds: float = DRIVER_INDEX_REFRESH_SECONDS,
+    ):
+        self.cell_deg = cell_deg
+        self.refresh_seconds = refresh_seconds
+        self._cells: Dict[Cell, Dict[str, Tuple[float, float]]] = {}
+        self._drivers: Dict[str, Cell] = {}
+        self._lock = threading.Lock()
+        self._loaded_at: Optional[float] = None
+
+    def _cell(self, lat: float, lng: float) -> Cell:
+        return int(lat // self.cell_deg), int(lng // self.cell_deg)
+
+    def __len__(self) -> int:
+        return len(self._drivers)
+
+    def is_stale(self) -> bool:
+        return (
+            self._loaded_at is None
+            or time.monotonic() - self._loaded_at > self.refresh_seconds
+        )
+
+    @staticmethod
+    def _available_drivers_query():
+        return select(Driver.id, Driver.latitude, Driver.longitude).where(
+            Driver.is_available == True,
+            Driver.latitude.isnot(None),
+            Driver.longitude.isnot(None),
+        )
+
+    def rebuild(self, db: Session):
+        self._replace(db.execute(self._available_drivers_query()).all())
+
+    async def arebuild(self, db: AsyncSession):
+        self._replace((await db.execute(self._available_drivers_query())).all())
+
+    def _replace(self, rows):
+        cells: Dict[Cell, Dict[str, Tuple[float, float]]] = {}
+        drivers: Dict[str, Cell] = {}
+        for driver_id, lat, lng in rows:
+            cell = self._cell(lat, lng)
+            cells.setdefault(cell, {})[driver_id] = (lat, lng)
+            drivers[driver_id] = cell
+        with self._lock:
+            self._cells = cells
+            self._drivers = drivers
+            self._loaded_at = time.monotonic()
+
+    def ensure_fresh(self, db: Session):
+        if self.is_stale():
+            self.rebuild(db)
+
+    async def aensure_fresh(self, db: AsyncSession):
+        if self.is_stale():
+            await self.arebuild(db)
+
+    def _remove_locked(self, driver_id: str):
+        cell = self._drivers.pop(driver_id, None)
+        if cell is None:
+            return
+        bucket = self._cells.get(cell)
+        if bucket is not None:
+            bucket.pop(driver_id, None)
+            if not bucket:
+                del self._cells[cell]
+
+    def upsert(self, driver_id: str, lat: float, lng: float):
+        cell = self._cell(lat, lng)
+        with self._lock:
+            self._remove_locked(driver_id)
+            self._cells.setdefault(cell, {})[driver_id] = (lat, lng)
+            self._drivers[driver_id] = cell
+
+    def move(self, driver_id: str, lat: float, lng: float) -> bool:
+        """Update the position of an indexed driver; False if the driver is not indexed."""
+        cell = self._cell(lat, lng)
+        with self._lock:
+            if driver_id not in self._drivers:
+                return False
+            self._remove_locked(driver_id)
+            self._cells.setdefault(cell, {})[driver_id] = (lat, lng)
+            self._drivers[driver_id] = cell
+            return True
+
+    def remove(self, driver_id: str):
+        with self._lock:
+            self._remove_locked(driver_id)
+
+    def update(self, driver: Driver):
+        """Index the driver if available with coordinates, drop it otherwise."""
+        if driver.is_available and driver.latitude is not None and driver.longitude is not None:
+            self.upsert(driver.id, driver.latitude, driver.longitude)
+        else:
+            self.remove(driver.id)
+
+    def nearest(self, lat: float, lng: float, k: int) -> List[Tuple[str, float]]:
+        """Up to k (driver_id, km) pairs ordered by great-circle distance.
+
+        Searches rings of grid cells outwards and stops once no unvisited cell
+        can hold anything closer than the current k-th candidate.
+        """
+        center_lat, center_lng = self._cell(lat, lng)
+        # Smallest ground distance covered by one ring step at this latitude
+        ring_km = self.cell_deg * KM_PER_DEG_LAT * max(cos(radians(min(abs(lat) + self.cell_deg, 89.0))), 0.01)
+
+        with self._lock:
+            total = len(self._drivers)
+            found: List[Tuple[float, str]] = []
+            seen = 0
+            ring = 0
+            while seen < total:
+                if (2 * ring + 1) ** 2 > len(self._cells):
+                    # The ring now spans more cells than are occupied: scan the rest directly
+                    found = [
+                        (haversine_km(lat, lng, d_lat, d_lng), driver_id)
+                        for bucket in self._cells.values()
+                        for driver_id, (d_lat, d_lng) in bucket.items()
+                    ]
+                    break
+                if ring == 0:
+                    cells = [(center_lat, center_lng)]
+                else:
+                    cells = [
+                        (center_lat + dlat, center_lng + dlng)
+                        for dlat in range(-ring, ring + 1)
+                        for dlng in range(-ring, ring + 1)
+                        if max(abs(dlat), abs(dlng)) == ring
+                    ]
+                for cell in cells:
+                    bucket = self._cells.get(cell)
+                    if not bucket:
+                        continue
+                    for driver_id, (d_lat, d_lng) in bucket.items():
+                        found.append((haversine_km(lat, lng, d_lat, d_lng), driver_id))
+                    seen += len(bucket)
+                if len(found) >= k:
+                    found.sort()
+                    found = found[:k]
+                    # Anything outside this ring is at least ring * ring_km away
+                    if found[-1][0] <= ring * ring_km:
+                        break
+                ring += 1
+
+        found.sort()
+        return [(driver_id, distance) for distance, driver_id in found[:k]]
+
+
+driver_index = DriverIndex()
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, NamedTuple, Optional
+
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app.database.setup import async_session_factory
+from app.driver_index import driver_index
+from app.models import Driver
+from app.tracking import tracking_hub
+
+logger = logging.getLogger(__name__)
+
+# How often buffered positions are written to the drivers table
+DRIVER_LOCATION_FLUSH_SECONDS = float(os.getenv("DRIVER_LOCATION_FLUSH_SECONDS", "2"))
+# Flush early once this many drivers have unwritten positions
+DRIVER_LOCATION_FLUSH_SIZE = int(os.getenv("DRIVER_LOCATION_FLUSH_SIZE", "1000"))
+
+
+class Location(NamedTuple):
+    latitude: float
+    longitude: float
+    location: str
+    at: float  # time.time() when it was received
+
+
+class DriverLocationBuffer:
+    """Write-behind store for driver positions.
+
+    record() keeps only the latest position per driver and moves the driver
+    in driver_index straight away; a background task writes whatever
+    changed since the last flush as one batched UPDATE every
+    DRIVER_LOCATION_FLUSH_SECONDS. Until then, readers that load drivers
+    from the database call overlay() to see the buffered position. Drivers
+    that were not in the index (no coordinates yet) are looked up once per
+    flush and indexed if available.
+    """
+
+    def __init__(self, session_factory=None):
+        self.session_factory = session_factory
+        self._latest: Dict[str, Location] = {}
+        self._pending: Dict[str, Location] = {}
+        self._flushing: Dict[str, Location] = {}
+        self._unindexed: set = set()
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.received = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.written = 0
+        self.flush_errors = 0
+        self.last_flush_ms = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Don't lose the last interval's positions on shutdown
+        await self.flush()
+
+    def record(self, driver_id: str, latitude: float, longitude: float, location: str) -> Location:
+        entry = Location(latitude, longitude, location, time.time())
+        with self._lock:
+            self.received += 1
+            if driver_id in self._pending:
+                self.coalesced += 1
+            self._pending[driver_id] = entry
+            self._latest[driver_id] = entry
+            pending = len(self._pending)
+        if not driver_index.move(driver_id, latitude, longitude):
+            with self._lock:
+                self._unindexed.add(driver_id)
+        tracking_hub.publish(driver_id, latitude, longitude, location, entry.at)
+        if self._wakeup is not None and pending >= DRIVER_LOCATION_FLUSH_SIZE:
+            self._wakeup.set()
+        return entry
+
+    def position(self, driver_id: str) -> Optional[Location]:
+        """Latest position received by this process, flushed or not."""
+        return self._latest.get(driver_id)
+
+    def unflushed(self) -> set:
+        """Drivers whose latest position received here is not committed to the database yet."""
+        with self._lock:
+            return set(self._pending) | set(self._flushing)
+
+    def overlay(self, drivers: Iterable[Driver]):
+        """Give loaded Driver rows their unwritten buffered position without marking them dirty."""
+        for driver in drivers:
+            entry = self._pending.get(driver.id) or self._flushing.get(driver.id)
+            if entry is None:
+                continue
+            set_committed_value(driver, "latitude", entry.latitude)
+            set_committed_value(driver, "longitude", entry.longitude)
+            set_committed_value(driver, "location", entry.location)
+
+    async def flush(self) -> int:
+        """Write every pending position; returns how many drivers were updated."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            unindexed, self._unindexed = self._unindexed, set()
+            self._flushing = pending
+        if not pending:
+            return 0
+
+        started = time.perf_counter()
+        session_factory = self.session_factory or async_session_factory()
+        try:
+            async with session_factory() as db:
+                # Core executemany: a driver deleted meanwhile just matches no row
+                await db.execute(
+                    update(Driver.__table__)
+                    .where(Driver.__table__.c.id == bindparam("driver_id"))
+                    .values(
+                        latitude=bindparam("new_latitude"),
+                        longitude=bindparam("new_longitude"),
+                        location=bindparam("new_location"),
+                    ),
+                    [
+                        {
+                            "driver_id": driver_id,
+                            "new_latitude": e.latitude,
+                            "new_longitude": e.longitude,
+                            "new_location": e.location,
+                        }
+                        for driver_id, e in pending.items()
+                    ],
+                )
+                await db.commit()
+                if unindexed:
+                    available = (
+                        await db.scalars(
+                            select(Driver.id).where(Driver.id.in_(unindexed), Driver.is_available == True)
+                        )
+                    ).all()
+                    for driver_id in available:
+                        entry = self._latest[driver_id]
+                        driver_index.upsert(driver_id, entry.latitude, entry.longitude)
+        except Exception as e:
+            self.flush_errors += 1
+            logger.error(f"Driver location flush failed for {len(pending)} drivers: {str(e)}")
+            with self._lock:
+                # Put back whatever has not been superseded since, for the next flush
+                for driver_id, entry in pending.items():
+                    self._pending.setdefault(driver_id, entry)
+                self._unindexed |= unindexed
+            return 0
+        finally:
+            self._flushing = {}
+
+        self.flushes += 1
+        self.written += len(pending)
+        self.last_flush_ms = (time.perf_counter() - started) * 1000
+        return len(pending)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=DRIVER_LOCATION_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Driver location flusher error: {str(e)}")
+
+    def stats(self) -> Dict:
+        return {
+            "flush_seconds": DRIVER_LOCATION_FLUSH_SECONDS,
+            "tracked": len(self._latest),
+            "pending": len(self._pending),
+            "received": self.received,
+            "coalesced": self.coalesced,
+            "flushes": self.flushes,
+            "written": self.written,
+            "flush_errors": self.flush_errors,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+        }
+
+
+driver_locations = DriverLocationBuffer()
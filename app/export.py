@@ -0,0 +1,68 @@
+import csv
+import enum
+import io
+import json
+import os
+from typing import Dict, Iterator, List
+
+from fastapi.responses import StreamingResponse
+
+from app.crud import crud
+from app.database.setup import SessionLocal
+
+# Rows fetched per round trip and written per response chunk
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def _plain(value):
+    return value.value if isinstance(value, enum.Enum) else value
+
+
+def _rows(query) -> Iterator[Dict]:
+    # The response outlives the request's dependencies, so the export owns its session
+    with SessionLocal() as db:
+        yield from crud.stream_rows(db, query, EXPORT_BATCH_SIZE)
+
+
+def _batched(lines: Iterator[str]) -> Iterator[str]:
+    batch: List[str] = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield "".join(batch)
+            batch = []
+    if batch:
+        yield "".join(batch)
+
+
+def ndjson_lines(rows: Iterator[Dict]) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps({key: _plain(value) for key, value in row.items()}) + "\n"
+
+
+def csv_lines(rows: Iterator[Dict], columns: List[str]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_plain(row[column]) for column in columns])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_response(query, name: str, format: str) -> StreamingResponse:
+    """Stream every row of a crud *_query as NDJSON or CSV without holding the result in memory."""
+    if format == "csv":
+        columns = [column.name for column in query.selected_columns]
+        lines = csv_lines(_rows(query), columns)
+    else:
+        lines = ndjson_lines(_rows(query))
+    return StreamingResponse(
+        _batched(lines),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{format}"'},
+    )
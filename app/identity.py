@@ -0,0 +1,134 @@
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import literal, select, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.cache import TTLCache
+from app.models import Customer, Driver
+
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "50000"))
+# Other processes can change a phone's identity, so entries only live this long
+IDENTITY_CACHE_TTL_SECONDS = float(os.getenv("IDENTITY_CACHE_TTL_SECONDS", "300"))
+# Unknown phones are cached for less time, since they usually register soon after
+IDENTITY_CACHE_UNKNOWN_TTL_SECONDS = float(os.getenv("IDENTITY_CACHE_UNKNOWN_TTL_SECONDS", "30"))
+
+CUSTOMER = "customer"
+DRIVER = "driver"
+
+
+@dataclass(frozen=True)
+class Identity:
+    """Detached snapshot of who a WhatsApp phone belongs to."""
+
+    phone: str
+    kind: Optional[str] = None  # CUSTOMER, DRIVER or None when unknown
+    id: Optional[str] = None
+    location: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+
+    @property
+    def is_customer(self) -> bool:
+        return self.kind == CUSTOMER
+
+    @property
+    def is_driver(self) -> bool:
+        return self.kind == DRIVER
+
+    @classmethod
+    def of(cls, kind: str, row) -> "Identity":
+        return cls(
+            phone=row.phone,
+            kind=kind,
+            id=row.id,
+            location=row.location,
+            latitude=row.latitude,
+            longitude=row.longitude,
+        )
+
+
+class IdentityResolver:
+    """Maps sender phones to customers, drivers or unknown.
+
+    Misses are resolved with one UNION query over customers and drivers for
+    the whole batch; results sit in a TTL cache that CRUD writes keep
+    current, so repeat senders need no database round trip. A phone that is
+    both a customer and a driver resolves to the customer, as before.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = IDENTITY_CACHE_SIZE,
+        ttl: float = IDENTITY_CACHE_TTL_SECONDS,
+        unknown_ttl: float = IDENTITY_CACHE_UNKNOWN_TTL_SECONDS,
+    ):
+        self.unknown_ttl = unknown_ttl
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.queries = 0
+
+    @staticmethod
+    def _select(kind: str, model, phones: List[str]):
+        return select(
+            literal(kind).label("kind"),
+            model.id, model.phone, model.location, model.latitude, model.longitude,
+        ).where(model.phone.in_(phones))
+
+    @staticmethod
+    def _query(phones: List[str]):
+        return union_all(
+            IdentityResolver._select(CUSTOMER, Customer, phones),
+            IdentityResolver._select(DRIVER, Driver, phones),
+        )
+
+    def _cached(self, phones: List[str]) -> Tuple[Dict[str, Identity], List[str]]:
+        found: Dict[str, Identity] = {}
+        missing = []
+        for phone in dict.fromkeys(phones):
+            identity = self.cache.get(phone)
+            if identity is None:
+                missing.append(phone)
+            else:
+                found[phone] = identity
+        return found, missing
+
+    def _store(self, missing: List[str], rows) -> Dict[str, Identity]:
+        self.queries += 1
+        resolved: Dict[str, Identity] = {}
+        for row in rows:
+            if row.kind == CUSTOMER or row.phone not in resolved:
+                resolved[row.phone] = Identity.of(row.kind, row)
+        for phone in missing:
+            identity = resolved.setdefault(phone, Identity(phone=phone))
+            self.cache.set(phone, identity, ttl=None if identity.kind else self.unknown_ttl)
+        return resolved
+
+    def resolve(self, db: Session, phones: List[str]) -> Dict[str, Identity]:
+        found, missing = self._cached(phones)
+        if missing:
+            found.update(self._store(missing, db.execute(self._query(missing)).all()))
+        return found
+
+    async def aresolve(self, db: AsyncSession, phones: List[str]) -> Dict[str, Identity]:
+        """resolve on an AsyncSession."""
+        found, missing = self._cached(phones)
+        if missing:
+            found.update(self._store(missing, (await db.execute(self._query(missing))).all()))
+        return found
+
+    def remember(self, kind: str, row) -> Identity:
+        """Cache a customer or driver that was just committed."""
+        identity = Identity.of(kind, row)
+        self.cache.set(identity.phone, identity)
+        return identity
+
+    def invalidate(self, phone: str):
+        self.cache.pop(phone)
+
+    def stats(self) -> Dict:
+        return {**self.cache.stats(), "queries": self.queries}
+
+
+identity_resolver = IdentityResolver()
@@ -1,8 +1,22 @@
+import logging
+import os
 import random
 import time
-from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
+from fastapi import APIRouter, FastAPI, Depends, HTTPException, Query, Request, Response, WebSocket
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from app.database.setup import Base, engine, get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database.setup import (
+    async_session_factory,
+    dispose_engines,
+    get_async_db,
+    get_db,
+    get_engine,
+    pool_stats,
+)
 from app.schema import (
     CustomerCreate,
     Customer,
@@ -15,48 +29,40 @@ from app.schema import (
     Driver,
     OrderAssignmentCreate,
     OrderAssignment,
+    Quote,
 )
-from app.crud import crud
-import requests
-import os
-from dotenv import load_dotenv
-import re
-import json
-
-load_dotenv()
-
-app = FastAPI()
-
-# WhatsApp Business API config
-WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
-WHATSAPP_ACCESS_TOKEN = os.getenv("WHATSAPP_ACCESS_TOKEN")
-WHATSAPP_VERIFY_TOKEN = os.getenv("WHATSAPP_VERIFY_TOKEN")
-WHATSAPP_API_URL = (
-    f"https://graph.facebook.com/v20.0/{WHATSAPP_PHONE_NUMBER_ID}/messages"
+from app.crud import LIST_MAX_PAGE_SIZE, LIST_PAGE_SIZE, crud
+from app.bulk import ingest_drivers, ingest_water_sources
+from app.async_crud import async_crud
+from app.distance import distance_upstream
+from app.models import InboundMessage, OrderStatus
+from app.export import export_response
+from app.distance_cache import distance_cache
+from app.driver_locations import driver_locations
+from app.identity import identity_resolver
+from app.metrics import registry, span
+from app.water_sources import water_source_registry
+from app.whatsapp import WHATSAPP_VERIFY_TOKEN, outbox_worker, whatsapp_sender
+from app.order_service import DISPATCH_MODE, order_service
+from app.outbound import close_upstreams, upstream_stats
+from app.quote_cache import quote_cache
+from app.tracking import TrackingFull, sse_events, tracking_hub, websocket_events
+from app.webhook import WEBHOOK_PROCESSING, store_event, webhook_pool
+
+router = APIRouter()
+
+registry.gauge("webhook_queue_depth", "Inbound messages queued in this process.", lambda: webhook_pool.depth)
+registry.gauge(
+    "driver_locations_pending", "Driver positions not yet written.", lambda: driver_locations.stats()["pending"]
+)
+registry.gauge(
+    "tracking_subscribers", "Connected order tracking viewers.", lambda: tracking_hub.stats()["subscribers"]
 )
-
-# Create database tables
-Base.metadata.create_all(bind=engine)
-
-
-def send_whatsapp_message(to_phone: str, text: str):
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_ACCESS_TOKEN}",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to_phone,
-        "type": "text",
-        "text": {"body": text},
-    }
-    response = requests.post(WHATSAPP_API_URL, headers=headers, json=payload)
-    response.raise_for_status()
 
 
-@app.get("/whatsapp")
+@router.get("/whatsapp")
 async def verify_webhook(request: Request):
-    query = requests.query_params
+    query = request.query_params
     mode = query.get("hub.mode")
     token = query.get("hub.verify_token")
     challenge = query.get("hub.challenge")
@@ -65,177 +71,209 @@ async def verify_webhook(request: Request):
     raise HTTPException(status_code=403, detail="Verification failed")
 
 
-@app.post("/whatsapp")
-async def whatsapp_webhook(request: Request, db: Session = Depends(get_db)):
-    data = await request.json()
-    print(data)  # Debug: Inspect payload
+@router.post("/whatsapp")
+async def whatsapp_webhook(request: Request, db: AsyncSession = Depends(get_async_db)):
+    with span("payload_parse"):
+        data = await request.json()
 
     # Parse webhook payload
     if not (data.get("object") == "whatsapp_business_account" and data.get("entry")):
         return {"status": "ignored"}
 
-    entry = data["entry"][0]
-    changes = entry.get("changes", [])
-    if not changes:
-        return {"status": "no changes"}
+    # Persist and acknowledge; the worker pool does the actual processing
+    with span("event_store"):
+        messages = await store_event(db, data)
+    outcomes = []
+    event_id = None
+    for message, stored in messages:
+        if stored is None:
+            status = "duplicate"
+        else:
+            event_id = stored.event_id
+            if WEBHOOK_PROCESSING != "local":
+                # Stored for app.worker, which claims it from the table
+                status = "queued"
+            else:
+                # Deferred: held back behind a full queue or an earlier deferred message from the phone
+                status = "queued" if webhook_pool.submit(stored.id, stored.phone) else "deferred"
+        outcomes.append({
+            "id": message.get("id"),
+            "from": message["from"],
+            "type": message.get("type"),
+            "status": status,
+        })
+    if not outcomes:
+        return {"status": "no messages"}
+    return {"status": "accepted", "event_id": event_id, "messages": outcomes}
 
-    value = changes[0]["value"]
-    messages = value.get("messages", [])
+
+@router.get("/internal/webhook-events/{event_id}")
+def webhook_event_outcomes(event_id: str, db: Session = Depends(get_db)):
+    messages = (
+        db.query(InboundMessage)
+        .filter(InboundMessage.event_id == event_id)
+        .order_by(InboundMessage.position)
+        .all()
+    )
     if not messages:
-        return {"status": "no messages"}
+        raise HTTPException(status_code=404, detail="Webhook event not found")
+    return {
+        "event_id": event_id,
+        "messages": [
+            {
+                "id": message.wa_message_id,
+                "from": message.phone,
+                "type": message.type,
+                "status": message.status,
+                "result": message.result,
+                "error": message.error,
+            }
+            for message in messages
+        ],
+    }
 
-    message = messages[0]
-    from_phone = message["from"]  # e.g., '1234567890'
-
-    # Handle location message
-    if message["type"] == "location":
-        location = message["location"]
-        latitude = location["latitude"]
-        longitude = location["longitude"]
-        address = location.get("address", "Unknown")
-
-        # Check if sender is customer or driver
-        db_customer = crud.get_customer_by_phone(db, from_phone)
-        if db_customer:
-            crud.update_customer_location(db, from_phone, latitude, longitude, address)
-            send_whatsapp_message(
-                from_phone,
-                "Location updated! Send order in this format: 'I want <quantity> litres of water'",
-            )
-            return {"status": "customer location updated"}
-
-        db_driver = db.query(Driver).filter(Driver.phone == from_phone).first()
-        if db_driver:
-            crud.update_driver_location(db, from_phone, latitude, longitude, address)
-            send_whatsapp_message(
-                from_phone, "Your location updated. Ready for assignments!"
-            )
-            return {"status": "driver location updated"}
-
-        # New user
-        customer_create = CustomerCreate(
-            phone=from_phone, location=address, latitude=latitude, longitude=longitude
-        )
-        crud.create_customer(db, customer_create)
-        send_whatsapp_message(
-            from_phone,
-            "Location saved! \n Send your order in this format: 'I want <quantity> litres of water'",
-        )
-        return {"status": "new customer created"}
-
-    # Handle text message (order)
-    if message["type"] == "text":
-        body = message["text"]["body"].strip().lower()
-        pattern = r"(\d+)\s*(litre|litres|liter|liters|gallon|gallons)\b"
-
-        # match = re.match(r"\s+(\d+)", body)
-        match = re.search(pattern, body)
-        if not match:
-            send_whatsapp_message(
-                from_phone,
-                "Invalid format. Share location, then: 'I want <quantity> litres of water'",
-            )
-            return {"status": "invalid format"}
-
-        quantity_str, unit = match.groups()
-        quantity = int(quantity_str)
-        # total_price: Price = float(price_str)
-
-        # Check customer and location
-        db_customer = crud.get_customer_by_phone(db, from_phone)
-        if not db_customer:
-            customer_create = CustomerCreate(phone=from_phone, location=address)
-            db_customer = crud.create_customer(db, customer_create)
-            send_whatsapp_message(
-                from_phone, "Please share your location first (attachment > Location)."
-            )
-            return {"status": "location required"}
-
-        if not db_customer.latitude:
-            send_whatsapp_message(
-                from_phone, "Please share your location first (attachment > Location)."
-            )
-            return {"status": "location required"}
-
-        try:
-            # Create order
-            order_create = OrderCreate(
-                quantity=quantity,
-                customer_id=db_customer.id,
-            )
-            db_order = crud.create_order(db, order_create)
-
-            price_create = PriceCreate(
-                order_id=db_order.id,
-                base_price=20.0,  # Example base price calculation
-                price_per_km=0.5,  # Example price per km (adjust as needed)
-                tax=2.0,  # Example tax (adjust as needed)
-            )
-            try:
-                total_price = crud.calculate_order_price(db, price_create)
-            except ValueError as e:
-                raise ValueError(f"Failed to calculate order price: {str(e)}")
-
-            if db_order.total_price is None:
-                db_order.total_price = total_price
-                db.commit()
-                db.refresh(db_order)
-            else:
-                print(
-                    f"Order already has total_price: {db_order.total_price}, updating to {total_price}"
-                )
-                db_order.total_price = total_price
-                db.commit()
-                db.refresh(db_order)
-
-        except ValueError as e:
-            print(f"Error processing order: {str(e)}")
-            raise
-        except Exception as e:
-            print(f"Unexpected error: {str(e)}")
-            raise
-
-            # Assign driver
-        db_driver = crud.get_available_driver(db, db_order.id)
-        print(db_driver)  # Debug: Check driver assignment
-        if db_driver and db_driver.latitude:
-            assignment_create = OrderAssignmentCreate(
-                order_id=db_order.id, driver_id=db_driver.id
-            )
-            crud.create_order_assignment(db, assignment_create)
-            tracking_link = crud.generate_tracking_link(
-                db_customer.latitude,
-                db_customer.longitude,
-                db_driver.latitude,
-                db_driver.longitude,
-            )
-            customer_msg = f"Order confirmed! {quantity} litres for N{total_price}. Track driver: {tracking_link}"
-            send_whatsapp_message(from_phone, customer_msg)
-            send_whatsapp_message(
-                db_driver.phone,
-                f"New order: {quantity} litres to {db_customer.location}. Share location if needed.",
-            )
-        else:
-            send_whatsapp_message(
-                from_phone,
-                f"Order received! {quantity} litres for N{total_price}. No drivers available yet.",
-            )
-        return {"status": "order processed"}
 
-    return {"status": "ignored"}
+@router.get("/quote", response_model=Quote)
+async def quote(
+    latitude: float = Query(ge=-90, le=90),
+    longitude: float = Query(ge=-180, le=180),
+    quantity: int = Query(ge=1),
+    db: AsyncSession = Depends(get_async_db),
+):
+    try:
+        result = await order_service.aquote(db, latitude, longitude, quantity)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if result is None:
+        raise HTTPException(status_code=404, detail="No water source reachable from this location")
+    return result
 
 
-@app.post("/drivers/", response_model=Driver)
+@router.post("/drivers/", response_model=Driver)
 def create_driver(driver: DriverCreate, db: Session = Depends(get_db)):
     return crud.create_driver(db, driver)
 
 
-@app.post("/water_sources/")
+@router.post("/water_sources/")
 def create_water_source(water_source: WaterSourceCreate, db: Session = Depends(get_db)):
     return crud.create_water_source(db, water_source)
 
 
-@app.patch("/drivers/{driver_id}/availability", response_model=Driver)
+@router.post("/drivers/bulk")
+async def bulk_create_drivers(request: Request, db: AsyncSession = Depends(get_async_db)):
+    """JSON array or NDJSON (Content-Type: application/x-ndjson) of DriverCreate rows, streamed."""
+    return await ingest_drivers(db, request.stream(), request.headers.get("content-type", ""))
+
+
+@router.post("/water_sources/bulk")
+async def bulk_create_water_sources(request: Request, db: AsyncSession = Depends(get_async_db)):
+    """JSON array or NDJSON (Content-Type: application/x-ndjson) of WaterSourceCreate rows, streamed."""
+    return await ingest_water_sources(db, request.stream(), request.headers.get("content-type", ""))
+
+
+@router.get("/orders/")
+def list_orders(
+    status: Optional[OrderStatus] = None,
+    customer_id: Optional[str] = None,
+    driver_id: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_MAX_PAGE_SIZE),
+    order: Literal["asc", "desc"] = "asc",
+    db: Session = Depends(get_db),
+):
+    query = crud.orders_query(status, customer_id, driver_id)
+    items, next_after = crud.keyset_page(db, query, after, limit, order == "desc")
+    return {"items": items, "next_after": next_after}
+
+
+@router.get("/orders/export")
+def export_orders(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    status: Optional[OrderStatus] = None,
+    customer_id: Optional[str] = None,
+    driver_id: Optional[str] = None,
+):
+    return export_response(crud.orders_query(status, customer_id, driver_id), "orders", format)
+
+
+async def _track(order_id: str):
+    """The order's driver id and current position, if any; raises if it cannot be tracked now."""
+    async with async_session_factory()() as db:
+        if await async_crud.get_order(db, order_id) is None:
+            raise HTTPException(status_code=404, detail="Order not found")
+        driver = await async_crud.get_order_driver(db, order_id)
+    if driver is None:
+        raise HTTPException(status_code=404, detail="No driver assigned to this order yet")
+    try:
+        tracking_hub.check_capacity()
+    except TrackingFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    first = None
+    if driver.latitude is not None and driver.longitude is not None:
+        position = driver_locations.position(driver.id)
+        first = tracking_hub.payload(
+            driver.id, driver.latitude, driver.longitude, driver.location,
+            position.at if position else time.time(),
+        )
+    return driver.id, first
+
+
+@router.get("/orders/{order_id}/track")
+async def track_order(order_id: str):
+    """Server-sent events with the assigned driver's position as it changes."""
+    driver_id, first = await _track(order_id)
+    return StreamingResponse(
+        sse_events(driver_id, first),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/orders/{order_id}/track/ws")
+async def track_order_ws(websocket: WebSocket, order_id: str):
+    """The same positions as /orders/{order_id}/track, as WebSocket text frames."""
+    try:
+        driver_id, first = await _track(order_id)
+    except HTTPException as e:
+        await websocket.close(code=4000 + e.status_code, reason=e.detail)
+        return
+    await websocket_events(websocket, driver_id, first)
+
+
+@router.get("/drivers/")
+def list_drivers(
+    is_available: Optional[bool] = None,
+    after: Optional[str] = None,
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_MAX_PAGE_SIZE),
+    order: Literal["asc", "desc"] = "asc",
+    db: Session = Depends(get_db),
+):
+    items, next_after = crud.keyset_page(db, crud.drivers_query(is_available), after, limit, order == "desc")
+    return {"items": items, "next_after": next_after}
+
+
+@router.get("/drivers/export")
+def export_drivers(format: Literal["ndjson", "csv"] = "ndjson", is_available: Optional[bool] = None):
+    return export_response(crud.drivers_query(is_available), "drivers", format)
+
+
+@router.get("/customers/")
+def list_customers(
+    after: Optional[str] = None,
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_MAX_PAGE_SIZE),
+    order: Literal["asc", "desc"] = "asc",
+    db: Session = Depends(get_db),
+):
+    items, next_after = crud.keyset_page(db, crud.customers_query(), after, limit, order == "desc")
+    return {"items": items, "next_after": next_after}
+
+
+@router.get("/customers/export")
+def export_customers(format: Literal["ndjson", "csv"] = "ndjson"):
+    return export_response(crud.customers_query(), "customers", format)
+
+
+@router.patch("/drivers/{driver_id}/availability", response_model=Driver)
 def update_driver_availability(
     driver_id: str, availability: bool, db: Session = Depends(get_db)
 ):
@@ -243,3 +281,122 @@ def update_driver_availability(
     if not db_driver:
         raise HTTPException(status_code=404, detail="Driver not found")
     return db_driver
+
+
+@router.get("/internal/distance-cache/stats")
+def distance_cache_stats():
+    return distance_cache.stats()
+
+
+@router.get("/internal/identity-cache/stats")
+def identity_cache_stats():
+    return identity_resolver.stats()
+
+
+@router.get("/internal/quote-cache/stats")
+def quote_cache_stats():
+    return quote_cache.stats()
+
+
+@router.get("/internal/water-sources/stats")
+def water_source_stats():
+    return water_source_registry.stats()
+
+
+@router.get("/internal/dispatcher/stats")
+def dispatcher_stats():
+    if DISPATCH_MODE != "batch":
+        return {"mode": DISPATCH_MODE}
+    from app.dispatcher import batch_dispatcher
+
+    return {"mode": DISPATCH_MODE, **batch_dispatcher.stats()}
+
+
+@router.get("/internal/driver-locations/stats")
+def driver_location_stats():
+    return driver_locations.stats()
+
+
+@router.get("/internal/tracking/stats")
+def tracking_stats():
+    return tracking_hub.stats()
+
+
+@router.get("/internal/upstreams/stats")
+def upstreams_stats():
+    return upstream_stats()
+
+
+@router.get("/metrics")
+def metrics():
+    return Response(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@router.get("/internal/db-pool/stats")
+def db_pool_stats():
+    return pool_stats()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create missing tables and indexes on startup; meant for local SQLite, run app.database.migrate elsewhere
+    if os.getenv("DB_AUTO_MIGRATE", "false").lower() in ("1", "true", "yes"):
+        from app.database.migrate import upgrade
+
+        await run_in_threadpool(upgrade)
+    # Built here rather than at import so that importing the app does no I/O
+    get_engine()
+    distance_upstream.client
+    whatsapp_sender.client
+    batch_dispatcher = None
+    outbox_worker.start()
+    # Always polls too: other workers or processes may ingest the locations of a driver watched here
+    tracking_hub.start()
+    if WEBHOOK_PROCESSING == "local":
+        driver_locations.start()
+        webhook_pool.start()
+        if DISPATCH_MODE == "batch":
+            # Imported only when used: the solver pulls in NumPy
+            from app.dispatcher import batch_dispatcher
+
+            batch_dispatcher.start()
+    try:
+        yield
+    finally:
+        if batch_dispatcher is not None:
+            await batch_dispatcher.stop()
+        await tracking_hub.stop()
+        await webhook_pool.stop()
+        await driver_locations.stop()
+        await outbox_worker.stop()
+        await close_upstreams()
+        await dispose_engines()
+
+
+def create_app() -> FastAPI:
+    """Build the API: `uvicorn --factory app.main:create_app --env-file .env`.
+
+    Importing this module builds nothing; `app.main:app` still works and
+    builds the app on first access. Settings come from the environment,
+    which uvicorn fills from --env-file before the app modules are
+    imported. Nothing here connects to the database or creates tables:
+    the engine and HTTP clients are built by the lifespan handler, and the
+    schema is managed with `python -m app.database.migrate`.
+    """
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(router)
+    return app
+
+
+_app: Optional[FastAPI] = None
+
+
+def __getattr__(name):
+    # `uvicorn app.main:app` and gunicorn `app.main:app` keep working, building the app on first access
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
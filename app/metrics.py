@@ -0,0 +1,199 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# A traced message slower than this is logged with its per-stage breakdown
+METRICS_SLOW_TRACE_MS = float(os.getenv("METRICS_SLOW_TRACE_MS", "2000"))
+
+PREFIX = "gbammiri_"
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a bisect and three additions."""
+
+    def __init__(
+        self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        self.name = PREFIX + name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: [per-bucket counts (last is +Inf), sum, count]
+        self._series: Dict[Labels, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, (list(s[0]), s[1], s[2])) for labels, s in self._series.items())
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Gauge:
+    """Read by calling collect() at scrape time, so keeping it current costs nothing."""
+
+    def __init__(self, name: str, help: str, collect: Callable[[], float]):
+        self.name = PREFIX + name
+        self.help = help
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        try:
+            value = self.collect()
+        except Exception as e:
+            logger.warning(f"Gauge {self.name} failed: {str(e)}")
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {_number(value)}"]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name: str, help: str, collect: Callable[[], float]) -> Gauge:
+        return self._register(Gauge(name, help, collect))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    "stage_seconds", "Time spent in each stage of the webhook and order pipeline.", ["stage"]
+)
+webhook_messages = registry.counter(
+    "webhook_messages_total", "Inbound WhatsApp messages processed, by type and outcome.", ["type", "outcome"]
+)
+distance_lookups = registry.counter(
+    "distance_lookups_total", "Road distances looked up, by where they were answered from.", ["source"]
+)
+distance_matrix_requests = registry.counter(
+    "distance_matrix_requests_total", "Distance Matrix API requests, by outcome.", ["outcome"]
+)
+whatsapp_sends = registry.counter("whatsapp_sends_total", "WhatsApp send attempts, by outcome.", ["outcome"])
+orders = registry.counter("orders_total", "Orders placed, by whether a driver was assigned at once.", ["outcome"])
+driver_claims = registry.counter(
+    "driver_claims_total", "Driver claim attempts, by whether the driver was still free or lost to another order.",
+    ["outcome"],
+)
+
+_trace: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("metrics_trace", default=None)
+
+
+@contextmanager
+def span(stage: str):
+    """Time a block into stage_seconds and, inside trace(), into that trace's breakdown."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage)
+        spans = _trace.get()
+        if spans is not None:
+            spans.append((stage, elapsed))
+
+
+@contextmanager
+def trace(name: str):
+    """Collect the spans of one unit of work; logged with their timings when it is slow."""
+    spans: List[Tuple[str, float]] = []
+    token = _trace.set(spans)
+    started = time.perf_counter()
+    try:
+        yield spans
+    finally:
+        _trace.reset(token)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if elapsed_ms >= METRICS_SLOW_TRACE_MS:
+            breakdown = " ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in spans)
+            logger.warning(f"Slow {name}: {elapsed_ms:.1f}ms {breakdown}")
@@ -1,11 +1,32 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Enum, Boolean
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Enum, Boolean, DateTime, JSON, Index
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator
 from app.database.setup import Base  # Adjust import if needed
 import enum
+import os
+import uuid
+from datetime import datetime, timezone
 
 from ulid import ULID
 
 
+# Define Outbox Status Enum
+class OutboxStatus(str, enum.Enum):
+    PENDING = "pending"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+
+
+# Define Inbound Message Status Enum
+class MessageStatus(str, enum.Enum):
+    RECEIVED = "received"
+    PROCESSING = "processing"
+    PROCESSED = "processed"
+    FAILED = "failed"
+
+
 # Define Order Status Enum
 class OrderStatus(str, enum.Enum):
     PENDING = "pending"
@@ -19,12 +40,46 @@ def generate_ulid():
     return str(ULID())
 
 
+# Store ULID keys as native 16-byte UUIDs on PostgreSQL instead of 26-char text.
+# Only for new databases: existing text keys are not converted.
+ULID_AS_UUID = os.getenv("ULID_AS_UUID", "false").lower() in ("1", "true", "yes")
+
+
+class ULIDType(TypeDecorator):
+    """ULID string in Python; String(26) in the database, or UUID on PostgreSQL with ULID_AS_UUID."""
+
+    impl = String(26)
+    cache_ok = True
+
+    @staticmethod
+    def _native(dialect) -> bool:
+        return ULID_AS_UUID and dialect.name == "postgresql"
+
+    def load_dialect_impl(self, dialect):
+        if self._native(dialect):
+            return dialect.type_descriptor(postgresql.UUID(as_uuid=False))
+        return dialect.type_descriptor(String(26))
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not self._native(dialect):
+            return value
+        return str(ULID.from_str(value).to_uuid())
+
+    def process_result_value(self, value, dialect):
+        if value is None or not self._native(dialect):
+            return value
+        return str(ULID.from_uuid(uuid.UUID(str(value))))
+
+
+def utcnow():
+    """Naive UTC timestamp, comparable across SQLite and PostgreSQL"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 class Customer(Base):
     __tablename__ = "customers"
 
-    id = Column(
-        String(26), primary_key=True, default=generate_ulid, unique=True, index=True
-    )
+    id = Column(ULIDType, primary_key=True, default=generate_ulid)
     phone = Column(
         String, unique=True, nullable=False
     )  # WhatsApp number (e.g., 'whatsapp:+1234567890')
@@ -38,12 +93,10 @@ class Customer(Base):
 class Order(Base):
     __tablename__ = "orders"
 
-    id = Column(
-        String(26), primary_key=True, default=generate_ulid, unique=True, index=True
-    )
+    id = Column(ULIDType, primary_key=True, default=generate_ulid)
     quantity = Column(Integer, nullable=False, default=1000)  
-    status = Column(Enum(OrderStatus), default=OrderStatus.PENDING, nullable=False)
-    customer_id = Column(String(26), ForeignKey("customers.id"), nullable=False)
+    status = Column(Enum(OrderStatus), default=OrderStatus.PENDING, nullable=False, index=True)
+    customer_id = Column(ULIDType, ForeignKey("customers.id"), nullable=False, index=True)
     total_price = Column(Float, nullable=True, default=0.0)  # New field for total price
 
     customer = relationship("Customer", back_populates="orders")
@@ -53,9 +106,7 @@ class Order(Base):
 class Driver(Base):
     __tablename__ = "drivers"
 
-    id = Column(
-        String(26), primary_key=True, default=generate_ulid, unique=True, index=True
-    )
+    id = Column(ULIDType, primary_key=True, default=generate_ulid)
     name = Column(String, nullable=False)
     phone = Column(String, unique=True, nullable=False)
     vehicle_number = Column(String, unique=True, nullable=False)
@@ -66,15 +117,22 @@ class Driver(Base):
 
     orders = relationship("OrderAssignment", back_populates="driver")
 
+    __table_args__ = (
+        # Dispatch only ever looks for available drivers, so busy ones stay out of the index
+        Index(
+            "ix_drivers_available", "id", "latitude", "longitude",
+            postgresql_where=is_available == True,
+            sqlite_where=is_available == True,
+        ),
+    )
+
 
 class OrderAssignment(Base):
     __tablename__ = "order_assignments"
 
-    id = Column(
-        String(26), primary_key=True, default=generate_ulid, unique=True, index=True
-    )
-    order_id = Column(String(26), ForeignKey("orders.id"), nullable=False)
-    driver_id = Column(String(26), ForeignKey("drivers.id"), nullable=False)
+    id = Column(ULIDType, primary_key=True, default=generate_ulid)
+    order_id = Column(ULIDType, ForeignKey("orders.id"), nullable=False, index=True)
+    driver_id = Column(ULIDType, ForeignKey("drivers.id"), nullable=False, index=True)
 
     order = relationship("Order")
     driver = relationship("Driver", back_populates="orders")
@@ -83,9 +141,7 @@ class OrderAssignment(Base):
 class WaterSource(Base):
     __tablename__ = "water_sources"
 
-    id = Column(
-        String(26), primary_key=True, default=generate_ulid, unique=True, index=True
-    )
+    id = Column(ULIDType, primary_key=True, default=generate_ulid)
     address = Column(String, nullable=False)
     latitude = Column(Float, nullable=True)
     longitude = Column(Float, nullable=True)
@@ -94,10 +150,8 @@ class WaterSource(Base):
 class Price(Base):
     __tablename__ = "prices"
 
-    id = Column(
-        String(26), primary_key=True, default=generate_ulid, unique=True, index=True
-    )
-    order_id = Column(String(26), ForeignKey("orders.id"), nullable=False, unique=True)
+    id = Column(ULIDType, primary_key=True, default=generate_ulid)
+    order_id = Column(ULIDType, ForeignKey("orders.id"), nullable=False, unique=True)
     base_price = Column(Float, nullable=False, default=15)
     tax = Column(Float, nullable=False, default=0)
     price_per_km = Column(Float, nullable=False, default=10)
@@ -107,3 +161,61 @@ class Price(Base):
     order = relationship("Order", back_populates="price")
 
 
+class CachedDistance(Base):
+    __tablename__ = "distance_cache"
+
+    # Geohash cells of the snapped origin and destination
+    origin_cell = Column(String(12), primary_key=True)
+    destination_cell = Column(String(12), primary_key=True)
+    distance_km = Column(Float, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=utcnow)
+
+
+class OutboxMessage(Base):
+    __tablename__ = "whatsapp_outbox"
+
+    id = Column(ULIDType, primary_key=True, default=generate_ulid)
+    to_phone = Column(String, nullable=False)
+    body = Column(String, nullable=False)
+    status = Column(Enum(OutboxStatus), default=OutboxStatus.PENDING, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    # Earliest time of the next send attempt; doubles as the lease while SENDING
+    next_attempt_at = Column(DateTime, nullable=False, default=utcnow, index=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+
+class WebhookEvent(Base):
+    __tablename__ = "webhook_events"
+
+    id = Column(ULIDType, primary_key=True, default=generate_ulid)
+    payload = Column(JSON, nullable=False)  # Raw body as delivered by Meta
+    message_count = Column(Integer, nullable=False, default=0)
+    received_at = Column(DateTime, nullable=False, default=utcnow)
+
+    messages = relationship("InboundMessage", back_populates="event")
+
+
+class InboundMessage(Base):
+    __tablename__ = "inbound_messages"
+
+    id = Column(ULIDType, primary_key=True, default=generate_ulid)
+    event_id = Column(ULIDType, ForeignKey("webhook_events.id"), nullable=False, index=True)
+    position = Column(Integer, nullable=False, default=0)  # Order within the event
+    # WhatsApp message id ("wamid..."); unique so redeliveries are stored once
+    wa_message_id = Column(String, nullable=True, unique=True)
+    phone = Column(String, nullable=False)
+    type = Column(String, nullable=True)
+    payload = Column(JSON, nullable=False)
+    status = Column(
+        Enum(MessageStatus), default=MessageStatus.RECEIVED, nullable=False, index=True
+    )
+    result = Column(JSON, nullable=True)
+    error = Column(String, nullable=True)
+    received_at = Column(DateTime, nullable=False, default=utcnow)
+    # Lease on PROCESSING messages; an expired lease means the worker died
+    claimed_until = Column(DateTime, nullable=True)
+    processed_at = Column(DateTime, nullable=True)
+
+    event = relationship("WebhookEvent", back_populates="messages")
@@ -0,0 +1,235 @@
+import os
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.async_crud import async_crud
+from app.crud import crud
+from app.driver_index import driver_index
+from app.metrics import orders, span
+from app.models import Customer, Driver, Order, OrderAssignment, OrderStatus, Price, generate_ulid
+from app.schema import Quote
+from app.tracking import tracking_url
+from app.whatsapp import outbox_worker, stage_whatsapp_message
+
+# "greedy" claims the nearest driver while handling the message; "batch" leaves
+# the order pending for app.dispatcher to assign with the rest of its window
+DISPATCH_MODE = os.getenv("DISPATCH_MODE", "greedy")
+
+
+@dataclass(frozen=True)
+class Tariff:
+    base_price: float  # Per unit of quantity
+    price_per_km: float
+    tax: float
+
+    def total(self, quantity: int, distance_km: float) -> float:
+        return (self.base_price * quantity) + (distance_km * self.price_per_km) + self.tax
+
+
+DEFAULT_TARIFF = Tariff(
+    base_price=float(os.getenv("ORDER_BASE_PRICE", "20.0")),
+    price_per_km=float(os.getenv("ORDER_PRICE_PER_KM", "0.5")),
+    tax=float(os.getenv("ORDER_TAX", "2.0")),
+)
+
+
+@dataclass(frozen=True)
+class PlacedOrder:
+    order_id: str
+    price_id: str
+    total_price: float
+    distance_km: float
+    assignment_id: Optional[str] = None
+    driver_id: Optional[str] = None
+    driver_phone: Optional[str] = None
+    driver_latitude: Optional[float] = None
+    driver_longitude: Optional[float] = None
+
+
+class OrderService:
+    """Places a WhatsApp order as one unit of work.
+
+    Lookups (nearest water source, driver candidates) run first, then the
+    nearest driver is claimed with a conditional UPDATE and the order,
+    price, assignment and outbound notifications are committed with the
+    claim. Ids are generated client-side, so nothing has to be refreshed
+    from the database afterwards. before_commit, if given, is called with
+    the staged order just before the commit and can abort it by raising.
+    place_order and aplace_order differ only in session type.
+    """
+
+    @staticmethod
+    def stage_assignment(
+        db, order_id: str, quantity: int, total_price: float, customer, driver: Driver
+    ) -> OrderAssignment:
+        """Add the assignment of an already claimed driver and both notifications to the session."""
+        with span("assignment"):
+            assignment = OrderAssignment(id=generate_ulid(), order_id=order_id, driver_id=driver.id)
+            db.add(assignment)
+            tracking_link = tracking_url(order_id) or crud.generate_tracking_link(
+                customer.latitude, customer.longitude, driver.latitude, driver.longitude
+            )
+            stage_whatsapp_message(
+                db, customer.phone,
+                f"Order confirmed! {quantity} litres for N{total_price}. Track driver: {tracking_link}",
+            )
+            stage_whatsapp_message(
+                db, driver.phone,
+                f"New order: {quantity} litres to {customer.location}. Share location if needed.",
+            )
+        return assignment
+
+    @staticmethod
+    def _stage(
+        db, customer: Customer, quantity: int, tariff: Tariff,
+        distance_km: float, driver: Optional[Driver],
+    ) -> PlacedOrder:
+        """Add every row of the order to the session without any I/O."""
+        total_price = tariff.total(quantity, distance_km)
+        order = Order(
+            id=generate_ulid(),
+            quantity=quantity,
+            status=OrderStatus.PENDING if driver is None else OrderStatus.CONFIRMED,
+            customer_id=customer.id,
+            total_price=total_price,
+        )
+        price = Price(
+            id=generate_ulid(),
+            order_id=order.id,
+            base_price=tariff.base_price,
+            tax=tariff.tax,
+            price_per_km=tariff.price_per_km,
+            distance_km=distance_km,
+            total_price=total_price,
+        )
+        db.add_all([order, price])
+
+        if driver is None:
+            if DISPATCH_MODE == "batch":
+                text = f"Order received! {quantity} litres for N{total_price}. Finding you a driver now."
+            else:
+                text = f"Order received! {quantity} litres for N{total_price}. No drivers available yet."
+            stage_whatsapp_message(db, customer.phone, text)
+            return PlacedOrder(
+                order_id=order.id,
+                price_id=price.id,
+                total_price=total_price,
+                distance_km=distance_km,
+            )
+
+        assignment = OrderService.stage_assignment(
+            db, order.id, quantity, total_price, customer, driver
+        )
+        return PlacedOrder(
+            order_id=order.id,
+            price_id=price.id,
+            total_price=total_price,
+            distance_km=distance_km,
+            assignment_id=assignment.id,
+            driver_id=driver.id,
+            driver_phone=driver.phone,
+            driver_latitude=driver.latitude,
+            driver_longitude=driver.longitude,
+        )
+
+    @staticmethod
+    async def aquote(
+        db: AsyncSession, lat: float, lng: float, quantity: int, tariff: Tariff = DEFAULT_TARIFF
+    ) -> Optional[Quote]:
+        """Price an order without placing it; None if no water source can be reached."""
+        nearest = await async_crud.nearest_water_source(db, lat, lng)
+        if nearest is None:
+            return None
+        water_source_id, distance_km = nearest
+        return Quote(
+            latitude=lat,
+            longitude=lng,
+            quantity=quantity,
+            water_source_id=water_source_id,
+            distance_km=distance_km,
+            base_price=tariff.base_price,
+            price_per_km=tariff.price_per_km,
+            tax=tariff.tax,
+            total_price=tariff.total(quantity, distance_km),
+        )
+
+    @staticmethod
+    def _check_customer(customer: Customer):
+        if customer.latitude is None or customer.longitude is None:
+            raise ValueError(f"Customer with ID {customer.id} is missing coordinates")
+
+    @staticmethod
+    def _after_commit(placed: PlacedOrder):
+        if placed.driver_id is not None:
+            driver_index.remove(placed.driver_id)
+        orders.inc("pending" if placed.driver_id is None else "assigned")
+        outbox_worker.notify()
+
+    @staticmethod
+    def place_order(
+        db: Session,
+        customer: Customer,
+        quantity: int,
+        tariff: Tariff = DEFAULT_TARIFF,
+        before_commit: Optional[Callable[[PlacedOrder], None]] = None,
+    ) -> PlacedOrder:
+        OrderService._check_customer(customer)
+        with span("price_calculation"):
+            distance_km = crud.nearest_water_source_distance(db, customer.latitude, customer.longitude)
+        if distance_km is None:
+            raise ValueError("No water source reachable from the customer")
+        try:
+            driver = None
+            if DISPATCH_MODE != "batch":
+                with span("driver_selection"):
+                    driver = crud.claim_nearest_available_driver(db, customer.latitude, customer.longitude)
+            with span("order_insert"):
+                placed = OrderService._stage(db, customer, quantity, tariff, distance_km, driver)
+                if before_commit is not None:
+                    before_commit(placed)
+                db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        OrderService._after_commit(placed)
+        return placed
+
+    @staticmethod
+    async def aplace_order(
+        db: AsyncSession,
+        customer: Customer,
+        quantity: int,
+        tariff: Tariff = DEFAULT_TARIFF,
+        before_commit: Optional[Callable[[PlacedOrder], Awaitable[None]]] = None,
+    ) -> PlacedOrder:
+        """place_order on an AsyncSession; customer may be a cached Identity rather than a row."""
+        OrderService._check_customer(customer)
+        with span("price_calculation"):
+            distance_km = await async_crud.nearest_water_source_distance(
+                db, customer.latitude, customer.longitude
+            )
+        if distance_km is None:
+            raise ValueError("No water source reachable from the customer")
+        try:
+            driver = None
+            if DISPATCH_MODE != "batch":
+                with span("driver_selection"):
+                    driver = await async_crud.claim_nearest_available_driver(
+                        db, customer.latitude, customer.longitude
+                    )
+            with span("order_insert"):
+                placed = OrderService._stage(db, customer, quantity, tariff, distance_km, driver)
+                if before_commit is not None:
+                    await before_commit(placed)
+                await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        OrderService._after_commit(placed)
+        return placed
+
+
+order_service = OrderService()
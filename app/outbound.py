@@ -0,0 +1,294 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+import httpx
+
+from app.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Consecutive failures that open an upstream's circuit
+UPSTREAM_FAILURE_THRESHOLD = int(os.getenv("UPSTREAM_FAILURE_THRESHOLD", "5"))
+# How long an open circuit fails fast before one trial request is let through
+UPSTREAM_OPEN_SECONDS = float(os.getenv("UPSTREAM_OPEN_SECONDS", "30"))
+# Below this much of the deadline left, a call is not started at all
+UPSTREAM_MIN_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_MIN_TIMEOUT_SECONDS", "0.05"))
+
+upstream_requests = registry.counter(
+    "upstream_requests_total", "Outbound HTTP requests, by upstream and outcome.", ["upstream", "outcome"]
+)
+upstream_hedges = registry.counter(
+    "upstream_hedges_total", "Hedged second requests sent, and how many answered first.", ["upstream", "outcome"]
+)
+
+
+class UpstreamUnavailable(Exception):
+    """The call was not made: the upstream's circuit is open or the deadline has passed."""
+
+
+class CircuitOpen(UpstreamUnavailable):
+    pass
+
+
+class DeadlineExceeded(UpstreamUnavailable):
+    pass
+
+
+_deadline: ContextVar[Optional[float]] = ContextVar("outbound_deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds: float):
+    """Bound every outbound call made inside the block by one time budget; nesting only tightens it."""
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(at, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left on the current deadline, None outside one."""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def call_timeout(default: float) -> float:
+    """The timeout for the next call: its own default, cut to what is left of the deadline."""
+    left = remaining()
+    if left is None:
+        return default
+    if left < UPSTREAM_MIN_TIMEOUT_SECONDS:
+        raise DeadlineExceeded("Request deadline exceeded")
+    return min(default, left)
+
+
+class CircuitBreaker:
+    """Closed until failure_threshold consecutive failures, then open for open_seconds.
+
+    After that one trial request is let through (half-open); its outcome
+    closes the circuit again or reopens it. Safe to use from threads.
+    """
+
+    def __init__(self, failure_threshold: int = UPSTREAM_FAILURE_THRESHOLD, open_seconds: float = UPSTREAM_OPEN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.opens = 0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.open_seconds:
+            return "half_open"
+        return "open"
+
+    def allows(self) -> bool:
+        """Whether a request would be let through now, without reserving the half-open trial."""
+        return self.state != "open" and not self._trial
+
+    def before(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "open" or self._trial:
+                raise CircuitOpen("Circuit open")
+            self._trial = True
+
+    def cancel(self):
+        """Give back a half-open trial whose request was cancelled before it finished."""
+        with self._lock:
+            self._trial = False
+
+    def record(self, ok: bool):
+        with self._lock:
+            self._trial = False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    self.opens += 1
+                self.opened_at = time.monotonic()
+
+
+def _failed(response: Optional[httpx.Response]) -> bool:
+    # Overload and server errors count against the upstream; other 4xx are the caller's problem
+    return response is None or response.status_code >= 500 or response.status_code == 429
+
+
+class Upstream:
+    """One external HTTP dependency: pooled clients, a circuit breaker and deadline-bound timeouts.
+
+    request() and request_sync() share the breaker, so the async webhook
+    path and sync callers in the threadpool see the same health. A timeout
+    only counts as a failure when the call had its full timeout; one cut
+    short by the caller's deadline is reported as deadline_timeout.
+    hedge_after_seconds, for idempotent calls only, sends a second copy of
+    a request that has not answered by then and takes whichever responds
+    first.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        timeout: float,
+        max_connections: int = 20,
+        headers: Optional[Dict[str, str]] = None,
+        http2: bool = False,
+        hedge_after_seconds: float = 0,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.headers = headers or {}
+        self.http2 = http2
+        self.hedge_after_seconds = hedge_after_seconds
+        self.breaker = breaker or CircuitBreaker()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._sync_client: Optional[httpx.Client] = None
+        self._lock = threading.Lock()
+        upstreams.append(self)
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=self.http2, timeout=self.timeout, limits=self._limits(), headers=self.headers
+            )
+        return self._client
+
+    @property
+    def sync_client(self) -> httpx.Client:
+        with self._lock:
+            if self._sync_client is None:
+                self._sync_client = httpx.Client(timeout=self.timeout, limits=self._limits(), headers=self.headers)
+        return self._sync_client
+
+    def _start(self) -> float:
+        try:
+            timeout = call_timeout(self.timeout)
+            self.breaker.before()
+        except DeadlineExceeded:
+            upstream_requests.inc(self.name, "deadline")
+            raise
+        except CircuitOpen:
+            upstream_requests.inc(self.name, "circuit_open")
+            raise CircuitOpen(f"{self.name} circuit open") from None
+        return timeout
+
+    def _finish(self, response: Optional[httpx.Response], error: Optional[Exception] = None, timeout: float = 0):
+        if isinstance(error, httpx.TimeoutException) and timeout < self.timeout:
+            # Cut short by the caller's deadline: says nothing about the upstream's health
+            self.breaker.cancel()
+            upstream_requests.inc(self.name, "deadline_timeout")
+            return
+        self.breaker.record(not _failed(response))
+        if isinstance(error, httpx.TimeoutException):
+            outcome = "timeout"
+        elif _failed(response):
+            outcome = "error"
+        else:
+            outcome = "ok"
+        upstream_requests.inc(self.name, outcome)
+
+    def request_sync(self, method: str, url: str, **kwargs) -> httpx.Response:
+        timeout = self._start()
+        try:
+            response = self.sync_client.request(method, url, timeout=timeout, **kwargs)
+        except Exception as e:
+            self._finish(None, e, timeout)
+            raise
+        self._finish(response)
+        return response
+
+    async def request(self, method: str, url: str, hedge: bool = False, **kwargs) -> httpx.Response:
+        timeout = self._start()
+        try:
+            if hedge and self.hedge_after_seconds and self.hedge_after_seconds < timeout:
+                response = await self._hedged(method, url, timeout, **kwargs)
+            else:
+                response = await self.client.request(method, url, timeout=timeout, **kwargs)
+        except asyncio.CancelledError:
+            self.breaker.cancel()
+            raise
+        except Exception as e:
+            self._finish(None, e, timeout)
+            raise
+        self._finish(response)
+        return response
+
+    async def _hedged(self, method: str, url: str, timeout: float, **kwargs) -> httpx.Response:
+        started = time.monotonic()
+        first = asyncio.ensure_future(self.client.request(method, url, timeout=timeout, **kwargs))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_after_seconds)
+        if done or not self.breaker.allows():
+            return await first
+
+        upstream_hedges.inc(self.name, "sent")
+        second = asyncio.ensure_future(
+            self.client.request(method, url, timeout=max(timeout - (time.monotonic() - started), 0.001), **kwargs)
+        )
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and not _failed(task.result()):
+                        if task is second:
+                            upstream_hedges.inc(self.name, "won")
+                        return task.result()
+            # Both failed: report the original request's outcome
+            return await first
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        with self._lock:
+            if self._sync_client is not None:
+                self._sync_client.close()
+                self._sync_client = None
+
+    def stats(self) -> Dict:
+        return {
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "opens": self.breaker.opens,
+            "timeout_seconds": self.timeout,
+            "hedge_after_seconds": self.hedge_after_seconds,
+        }
+
+
+upstreams: List[Upstream] = []
+
+
+async def close_upstreams():
+    for upstream in upstreams:
+        await upstream.aclose()
+
+
+def upstream_stats() -> Dict:
+    return {upstream.name: upstream.stats() for upstream in upstreams}
@@ -0,0 +1,85 @@
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+from app.cache import TTLCache
+from app.distance_cache import DISTANCE_CACHE_PRECISION
+from app.geo import geohash
+from app.water_sources import water_source_registry
+
+QUOTE_CACHE_SIZE = int(os.getenv("QUOTE_CACHE_SIZE", "100000"))
+QUOTE_CACHE_TTL_SECONDS = float(os.getenv("QUOTE_CACHE_TTL_SECONDS", "3600"))
+
+# (water source id, road distance in km)
+SourceDistance = Tuple[str, float]
+
+
+class QuoteCache:
+    """Distance component of a price for each customer geohash cell.
+
+    An entry holds the water source that serves the cell and the road
+    distance to it, so a quote for any quantity or tariff is arithmetic on
+    a cached pair and needs no Distance Matrix call. Tariffs are applied
+    when the quote is made, never stored, so changing them cannot serve a
+    stale price. Entries are dropped whenever water_source_registry sees
+    the set of sources change, and set() refuses a quote worked out
+    against an older set than the current one.
+    """
+
+    def __init__(
+        self,
+        precision: int = DISTANCE_CACHE_PRECISION,
+        maxsize: int = QUOTE_CACHE_SIZE,
+        ttl: float = QUOTE_CACHE_TTL_SECONDS,
+    ):
+        self.precision = precision
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._sources_version = water_source_registry.version
+        self._lock = threading.Lock()
+        self.invalidations = 0
+        self.stale_sets = 0
+
+    def key(self, lat: float, lng: float) -> str:
+        return geohash(lat, lng, self.precision)
+
+    def _check_sources(self):
+        # Caller holds self._lock, so a set() cannot slip in between the compare and the clear
+        version = water_source_registry.version
+        if version != self._sources_version:
+            self._sources_version = version
+            self._invalidate()
+
+    def get(self, lat: float, lng: float) -> Optional[SourceDistance]:
+        with self._lock:
+            self._check_sources()
+        return self.cache.get(self.key(lat, lng))
+
+    def set(self, lat: float, lng: float, source_id: str, distance_km: float, sources_version: int):
+        """Cache a quote; sources_version is water_source_registry.version read before the lookup."""
+        with self._lock:
+            self._check_sources()
+            if sources_version != self._sources_version:
+                # The sources changed while this quote was being worked out
+                self.stale_sets += 1
+                return
+            self.cache.set(self.key(lat, lng), (source_id, distance_km))
+
+    def invalidate(self):
+        with self._lock:
+            self._invalidate()
+
+    def _invalidate(self):
+        self.cache.clear()
+        self.invalidations += 1
+
+    def stats(self) -> Dict:
+        return {
+            "precision": self.precision,
+            "sources_version": self._sources_version,
+            "invalidations": self.invalidations,
+            "stale_sets": self.stale_sets,
+            **self.cache.stats(),
+        }
+
+
+quote_cache = QuoteCache()
@@ -115,4 +115,16 @@ class Price(BaseModel):
     total_price: float
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+
+class Quote(BaseModel):
+    latitude: float
+    longitude: float
+    quantity: int
+    water_source_id: str
+    distance_km: float
+    base_price: float
+    price_per_km: float
+    tax: float
+    total_price: float
@@ -0,0 +1,18 @@
+"""Environment loading for the command-line entry points.
+
+Module-level settings are read with os.getenv when each module is
+imported, so .env has to be loaded before any of them. Importing the
+package loads nothing: the API server gets it from uvicorn's --env-file,
+and `python -m` entry points call load_settings() before importing the
+rest of the app. Later calls are no-ops.
+"""
+from dotenv import load_dotenv
+
+_loaded = False
+
+
+def load_settings():
+    global _loaded
+    if not _loaded:
+        load_dotenv()
+        _loaded = True
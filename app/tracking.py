@@ -0,0 +1,280 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from typing import AsyncIterator, Dict, Optional, Set, Tuple
+
+from sqlalchemy import select
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from app.database.setup import async_session_factory
+from app.models import Driver
+
+logger = logging.getLogger(__name__)
+
+# Public URL of this API; when set, customers get a live tracking link instead of a static map
+TRACKING_BASE_URL = os.getenv("TRACKING_BASE_URL", "").rstrip("/")
+# Positions held for a subscriber that is not reading; older ones are dropped first
+TRACKING_QUEUE_SIZE = int(os.getenv("TRACKING_QUEUE_SIZE", "8"))
+TRACKING_MAX_SUBSCRIBERS = int(os.getenv("TRACKING_MAX_SUBSCRIBERS", "10000"))
+TRACKING_KEEPALIVE_SECONDS = float(os.getenv("TRACKING_KEEPALIVE_SECONDS", "15"))
+TRACKING_MAX_SECONDS = float(os.getenv("TRACKING_MAX_SECONDS", "3600"))
+# How often subscribed drivers are read from the database, for positions ingested by other processes
+TRACKING_POLL_SECONDS = float(os.getenv("TRACKING_POLL_SECONDS", "3"))
+
+Position = Tuple[float, float, str]  # latitude, longitude, location
+
+
+class TrackingFull(Exception):
+    """TRACKING_MAX_SUBSCRIBERS viewers are already connected to this process."""
+
+
+def tracking_url(order_id: str) -> Optional[str]:
+    if not TRACKING_BASE_URL:
+        return None
+    return f"{TRACKING_BASE_URL}/orders/{order_id}/track"
+
+
+class Subscription:
+    def __init__(self, driver_id: str, maxsize: int = TRACKING_QUEUE_SIZE):
+        self.driver_id = driver_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def offer(self, payload: str):
+        # Only the newest positions matter, so a slow reader loses the oldest ones
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(payload)
+
+
+class TrackingHub:
+    """In-process pub/sub of driver positions for order tracking viewers.
+
+    Viewers subscribe to the driver of their order; each position is
+    serialized once and offered to every subscriber's bounded queue, so a
+    publish costs a dict lookup when nobody is watching and a slow client
+    holds at most TRACKING_QUEUE_SIZE payloads. Positions received by this
+    process are published by driver_locations as messages arrive. Any other
+    process (another uvicorn worker, a webhook worker) may ingest the same
+    driver's locations, so the hub also reads the subscribed drivers from
+    the database in one query every TRACKING_POLL_SECONDS; rows this process
+    has newer positions for than it has flushed are skipped, so the poll
+    never sends a viewer back to an older position.
+    """
+
+    def __init__(self, max_subscribers: int = TRACKING_MAX_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        self._last: Dict[str, Position] = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        if self._task is None:
+            self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def check_capacity(self):
+        """Raise TrackingFull if a new viewer would be turned away, so a route can refuse before streaming."""
+        if self._count >= self.max_subscribers:
+            raise TrackingFull(f"{self._count} tracking viewers already connected")
+
+    def subscribe(self, driver_id: str) -> Subscription:
+        subscription = Subscription(driver_id)
+        with self._lock:
+            self.check_capacity()
+            self._subscribers.setdefault(driver_id, set()).add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.driver_id)
+            if subscribers is None or subscription not in subscribers:
+                return
+            subscribers.discard(subscription)
+            self._count -= 1
+            self.dropped += subscription.dropped
+            if not subscribers:
+                del self._subscribers[subscription.driver_id]
+                self._last.pop(subscription.driver_id, None)
+
+    @staticmethod
+    def payload(driver_id: str, latitude: float, longitude: float, location: str, at: float) -> str:
+        return json.dumps({
+            "driver_id": driver_id,
+            "latitude": latitude,
+            "longitude": longitude,
+            "location": location,
+            "at": at,
+        })
+
+    def publish(self, driver_id: str, latitude: float, longitude: float, location: str, at: Optional[float] = None):
+        """Fan a position out to the driver's viewers; safe to call from any thread."""
+        if driver_id not in self._subscribers:
+            return
+        self._last[driver_id] = (latitude, longitude, location)
+        payload = self.payload(driver_id, latitude, longitude, location, time.time() if at is None else at)
+        if self._loop is None or self._loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._fanout(driver_id, payload)
+        else:
+            self._loop.call_soon_threadsafe(self._fanout, driver_id, payload)
+
+    def _fanout(self, driver_id: str, payload: str):
+        subscribers = list(self._subscribers.get(driver_id, ()))
+        for subscription in subscribers:
+            subscription.offer(payload)
+        self.published += 1
+        self.delivered += len(subscribers)
+
+    async def _poll(self):
+        # driver_locations publishes through this hub, so it can only be imported once both exist
+        from app.driver_locations import driver_locations
+
+        while True:
+            await asyncio.sleep(TRACKING_POLL_SECONDS)
+            driver_ids = list(self._subscribers)
+            if not driver_ids:
+                continue
+            started = time.time()
+            local = driver_locations.unflushed()
+            try:
+                async with async_session_factory()() as db:
+                    rows = (
+                        await db.execute(
+                            select(Driver.id, Driver.latitude, Driver.longitude, Driver.location).where(
+                                Driver.id.in_(driver_ids)
+                            )
+                        )
+                    ).all()
+            except Exception as e:
+                logger.error(f"Tracking poll failed: {str(e)}")
+                continue
+            local |= driver_locations.unflushed()
+            for driver_id, latitude, longitude, location in rows:
+                if latitude is None or longitude is None:
+                    continue
+                # The row may predate a position this process already published
+                received = driver_locations.position(driver_id)
+                if driver_id in local or (received is not None and received.at >= started):
+                    continue
+                if self._last.get(driver_id) != (latitude, longitude, location):
+                    self.publish(driver_id, latitude, longitude, location)
+
+    def stats(self) -> Dict:
+        return {
+            "subscribers": self._count,
+            "max_subscribers": self.max_subscribers,
+            "drivers_watched": len(self._subscribers),
+            "published": self.published,
+            "delivered": self.delivered,
+            "dropped": self.dropped + sum(
+                s.dropped for subscribers in list(self._subscribers.values()) for s in list(subscribers)
+            ),
+            "polling": self._task is not None,
+        }
+
+
+async def sse_events(driver_id: str, first: Optional[str]) -> AsyncIterator[str]:
+    """Server-sent events for one viewer of the driver.
+
+    The subscription is taken once the response starts streaming and
+    released in the same try/finally, so a client that leaves before then
+    never holds a slot.
+    """
+    deadline = time.monotonic() + TRACKING_MAX_SECONDS
+    subscription = None
+    try:
+        try:
+            subscription = tracking_hub.subscribe(driver_id)
+        except TrackingFull as e:
+            # Filled up since the route checked; headers are already sent, so say so in the stream
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+            return
+        if first is not None:
+            yield f"data: {first}\n\n"
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                payload = await asyncio.wait_for(
+                    subscription.queue.get(), timeout=min(TRACKING_KEEPALIVE_SECONDS, remaining)
+                )
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield f"data: {payload}\n\n"
+    finally:
+        if subscription is not None:
+            tracking_hub.unsubscribe(subscription)
+
+
+async def websocket_events(websocket: WebSocket, driver_id: str, first: Optional[str]):
+    """Accept the WebSocket and push the driver's positions until either side closes it."""
+    deadline = time.monotonic() + TRACKING_MAX_SECONDS
+    subscription = None
+    receiver = None
+    try:
+        try:
+            subscription = tracking_hub.subscribe(driver_id)
+        except TrackingFull as e:
+            await websocket.close(code=4503, reason=str(e))
+            return
+        await websocket.accept()
+        # Reading at the same time is how a client that went away without sending anything is noticed
+        receiver = asyncio.create_task(websocket.receive())
+        if first is not None:
+            await websocket.send_text(first)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                await websocket.close()
+                return
+            getter = asyncio.create_task(subscription.queue.get())
+            done, _ = await asyncio.wait(
+                {receiver, getter}, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+            )
+            if getter in done:
+                await websocket.send_text(getter.result())
+            else:
+                getter.cancel()
+            if receiver in done:
+                if receiver.result()["type"] == "websocket.disconnect":
+                    return
+                # Anything the client sends is ignored
+                receiver = asyncio.create_task(websocket.receive())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if receiver is not None:
+            receiver.cancel()
+        if subscription is not None:
+            tracking_hub.unsubscribe(subscription)
+
+
+tracking_hub = TrackingHub()
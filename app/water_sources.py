@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import threading
+import time
+from math import cos, radians, sqrt
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.cache import TTLCache
+from app.geo import haversine_km
+from app.models import WaterSource
+
+logger = logging.getLogger(__name__)
+
+# Extra sources that are not in the database, e.g.
+# [{"address": "Borehole 1", "latitude": 6.5, "longitude": 3.3}]
+WATER_SOURCES = json.loads(os.getenv("WATER_SOURCES", "[]"))
+# Grid cell edge in degrees (0.02 ~ 2.2km of latitude)
+WATER_SOURCE_CELL_DEG = float(os.getenv("WATER_SOURCE_CELL_DEG", "0.02"))
+# Reload from the database this often, to pick up sources added by other workers
+WATER_SOURCE_REFRESH_SECONDS = float(os.getenv("WATER_SOURCE_REFRESH_SECONDS", "300"))
+# Great-circle nearest sources that get a road-distance check
+WATER_SOURCE_ROAD_CHECKS = int(os.getenv("WATER_SOURCE_ROAD_CHECKS", "2"))
+WATER_SOURCE_CELL_CACHE_SIZE = int(os.getenv("WATER_SOURCE_CELL_CACHE_SIZE", "20000"))
+
+KM_PER_DEG_LAT = 111.32
+
+Cell = Tuple[int, int]
+
+
+class Source(NamedTuple):
+    id: str
+    address: str
+    latitude: float
+    longitude: float
+
+
+def _env_sources() -> List[Source]:
+    sources = []
+    for i, entry in enumerate(WATER_SOURCES):
+        try:
+            sources.append(Source(
+                id=str(entry.get("id") or f"env-{i}"),
+                address=entry.get("address") or entry.get("name") or "",
+                latitude=float(entry["latitude"]),
+                longitude=float(entry["longitude"]),
+            ))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            logger.warning(f"Skipping WATER_SOURCES entry {i} without usable coordinates: {entry}")
+    return sources
+
+
+class WaterSourceRegistry:
+    """In-memory water sources with a per-grid-cell candidate list.
+
+    For each grid cell, the candidates are every source that could be the
+    great-circle nearest for some point in that cell: within the nearest
+    source's distance from the cell centre plus the cell diagonal. The list
+    is computed on first use and memoized, so a lookup only ranks a handful
+    of sources and only the closest WATER_SOURCE_ROAD_CHECKS of them get a
+    road-distance call.
+    """
+
+    def __init__(
+        self,
+        cell_deg: float = WATER_SOURCE_CELL_DEG,
+        refresh_seconds: float = WATER_SOURCE_REFRESH_SECONDS,
+    ):
+        self.cell_deg = cell_deg
+        self.refresh_seconds = refresh_seconds
+        self._sources: Dict[str, Source] = {}
+        self._candidates = TTLCache(maxsize=WATER_SOURCE_CELL_CACHE_SIZE, ttl=refresh_seconds)
+        self._lock = threading.Lock()
+        self._loaded_at: Optional[float] = None
+        # Bumped whenever the set of sources changes, so derived caches know to drop their entries
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self._sources)
+
+    def _cell(self, lat: float, lng: float) -> Cell:
+        return int(lat // self.cell_deg), int(lng // self.cell_deg)
+
+    def is_stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_seconds
+
+    @staticmethod
+    def _sources_query():
+        return select(WaterSource.id, WaterSource.address, WaterSource.latitude, WaterSource.longitude).where(
+            WaterSource.latitude.isnot(None),
+            WaterSource.longitude.isnot(None),
+        )
+
+    def load(self, db: Session):
+        self._replace(db.execute(self._sources_query()).all())
+
+    async def aload(self, db: AsyncSession):
+        self._replace((await db.execute(self._sources_query())).all())
+
+    def _replace(self, rows):
+        sources = {source.id: source for source in _env_sources()}
+        for row in rows:
+            sources[row.id] = Source(row.id, row.address, row.latitude, row.longitude)
+        with self._lock:
+            if sources != self._sources:
+                self._sources = sources
+                self._candidates.clear()
+                self.version += 1
+            self._loaded_at = time.monotonic()
+
+    def ensure_loaded(self, db: Session):
+        if self.is_stale():
+            self.load(db)
+
+    async def aensure_loaded(self, db: AsyncSession):
+        if self.is_stale():
+            await self.aload(db)
+
+    def add(self, source):
+        """Register a newly created source; any object with id, address, latitude and longitude."""
+        if source.latitude is None or source.longitude is None:
+            return
+        entry = Source(source.id, source.address, source.latitude, source.longitude)
+        with self._lock:
+            if self._sources.get(entry.id) == entry:
+                return
+            self._sources[entry.id] = entry
+            self._candidates.clear()
+            self.version += 1
+
+    def _cell_candidates(self, cell: Cell) -> List[Source]:
+        candidates = self._candidates.get(cell)
+        if candidates is not None:
+            return candidates
+        center_lat = (cell[0] + 0.5) * self.cell_deg
+        center_lng = (cell[1] + 0.5) * self.cell_deg
+        # Half the cell diagonal, measured at the cell edge nearest the equator where it is widest
+        half_lat_km = self.cell_deg * KM_PER_DEG_LAT / 2
+        half_lng_km = half_lat_km * cos(radians(max(min(abs(cell[0]), abs(cell[0] + 1)) * self.cell_deg, 0.0)))
+        radius_km = sqrt(half_lat_km ** 2 + half_lng_km ** 2)
+        with self._lock:
+            distances = sorted(
+                (haversine_km(center_lat, center_lng, source.latitude, source.longitude), source)
+                for source in self._sources.values()
+            )
+        if distances:
+            limit = distances[0][0] + 2 * radius_km
+            candidates = [source for distance, source in distances if distance <= limit]
+        else:
+            candidates = []
+        self._candidates.set(cell, candidates)
+        return candidates
+
+    def nearest(self, lat: float, lng: float, k: int = WATER_SOURCE_ROAD_CHECKS) -> List[Source]:
+        """Up to k sources nearest to the point by great-circle distance."""
+        candidates = self._cell_candidates(self._cell(lat, lng))
+        return sorted(candidates, key=lambda s: haversine_km(lat, lng, s.latitude, s.longitude))[:k]
+
+    def stats(self) -> Dict:
+        return {"sources": len(self._sources), "version": self.version, "cells": self._candidates.stats()}
+
+
+water_source_registry = WaterSourceRegistry()
@@ -0,0 +1,509 @@
+import asyncio
+import logging
+import os
+import re
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.async_crud import async_crud
+from app.cache import TTLCache
+from app.database.setup import async_session_factory
+from app.identity import Identity, identity_resolver
+from app.metrics import span, trace, webhook_messages
+from app.outbound import deadline
+from app.models import InboundMessage, MessageStatus, WebhookEvent, utcnow
+from app.order_service import PlacedOrder, order_service
+from app.schema import CustomerCreate
+from app.whatsapp import outbox_worker, stage_whatsapp_message
+
+logger = logging.getLogger(__name__)
+
+# Number of worker tasks; messages from one phone always go to the same worker
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+# "local" processes messages in this process; "external" leaves them to `python -m app.worker`
+WEBHOOK_PROCESSING = os.getenv("WEBHOOK_PROCESSING", "local")
+WEBHOOK_LEASE_SECONDS = float(os.getenv("WEBHOOK_LEASE_SECONDS", "120"))
+WEBHOOK_SWEEP_SECONDS = float(os.getenv("WEBHOOK_SWEEP_SECONDS", "30"))
+# Time budget for processing one message, shared by all its outbound calls
+WEBHOOK_MESSAGE_DEADLINE_SECONDS = float(os.getenv("WEBHOOK_MESSAGE_DEADLINE_SECONDS", "10"))
+# Most queued messages a worker takes (and resolves identities for) at once
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "20"))
+# Recently stored WhatsApp message ids, checked before the database on redelivery
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", "100000"))
+WEBHOOK_DEDUP_TTL_SECONDS = float(os.getenv("WEBHOOK_DEDUP_TTL_SECONDS", "86400"))
+
+recent_message_ids = TTLCache(maxsize=WEBHOOK_DEDUP_SIZE, ttl=WEBHOOK_DEDUP_TTL_SECONDS)
+
+ORDER_PATTERN = r"(\d+)\s*(litre|litres|liter|liters|gallon|gallons)\b"
+
+
+def iter_messages(payload: Dict):
+    """Every message in a delivery, across all entries and changes."""
+    for entry in payload.get("entry") or []:
+        for change in entry.get("changes") or []:
+            for message in (change.get("value") or {}).get("messages") or []:
+                yield message
+
+
+async def _stored_message_ids(db: AsyncSession, wa_message_ids: List[str]) -> set:
+    if not wa_message_ids:
+        return set()
+    rows = await db.scalars(
+        select(InboundMessage.wa_message_id).where(InboundMessage.wa_message_id.in_(wa_message_ids))
+    )
+    return set(rows.all())
+
+
+async def store_event(db: AsyncSession, payload: Dict) -> List[Tuple[Dict, Optional[InboundMessage]]]:
+    """Persist the raw delivery and one row per new message, in one commit.
+
+    Returns each message paired with its stored row, or None when it is a
+    redelivery of a message id we already have. Duplicates are caught by the
+    in-memory recent id set first, then by one IN query, and finally by the
+    unique wa_message_id column when another worker stores the same id
+    concurrently.
+    """
+    incoming = [
+        (position, message)
+        for position, message in enumerate(iter_messages(payload))
+        if message.get("from")
+    ]
+    fresh = [
+        (position, message)
+        for position, message in incoming
+        if not message.get("id") or recent_message_ids.get(message["id"]) is None
+    ]
+
+    stored: Dict[int, InboundMessage] = {}
+    for attempt in range(3):
+        known = await _stored_message_ids(db, [message["id"] for _, message in fresh if message.get("id")])
+        fresh = [(position, message) for position, message in fresh if message.get("id") not in known]
+        if not fresh:
+            break
+
+        received_at = utcnow()
+        event = WebhookEvent(payload=payload, received_at=received_at, message_count=len(fresh))
+        db.add(event)
+        stored = {
+            position: InboundMessage(
+                event=event,
+                position=position,
+                wa_message_id=message.get("id"),
+                phone=message["from"],
+                type=message.get("type"),
+                payload=message,
+                received_at=received_at,
+            )
+            for position, message in fresh
+        }
+        db.add_all(stored.values())
+        try:
+            await db.commit()
+            break
+        except IntegrityError:
+            # Another worker stored one of these ids in the meantime; drop it and retry
+            await db.rollback()
+            stored = {}
+            if attempt == 2:
+                raise
+
+    for message in stored.values():
+        if message.wa_message_id:
+            recent_message_ids.set(message.wa_message_id, True)
+    return [(message, stored.get(position)) for position, message in incoming]
+
+
+def _order_result(placed: PlacedOrder) -> Dict:
+    return {"status": "order processed", "order_id": placed.order_id, "driver": placed.driver_id}
+
+
+async def handle_message(
+    db: AsyncSession,
+    message: Dict,
+    identities: Dict[str, Identity],
+    message_id: Optional[str] = None,
+    lease: Optional[datetime] = None,
+) -> Dict:
+    """Process one message; identities maps sender phones resolved up front and is kept current.
+
+    Whatever a message changes, its reply and, given the stored message's
+    id and lease, its outcome are committed in one transaction, which
+    raises LeaseLost if the lease has expired: a reclaimed message can then
+    neither place an order nor send a reply twice.
+    """
+    from_phone = message["from"]  # e.g., '1234567890'
+    identity = identities.get(from_phone) or Identity(phone=from_phone)
+
+    async def finish(result: Dict, text: Optional[str] = None):
+        if text is not None:
+            stage_whatsapp_message(db, from_phone, text)
+        if message_id is not None:
+            await stage_finish(db, message_id, lease, status=MessageStatus.PROCESSED, result=result)
+
+    async def reply(result: Dict, text: Optional[str] = None) -> Dict:
+        await finish(result, text)
+        await db.commit()
+        if text is not None:
+            outbox_worker.notify()
+        return result
+
+    # Handle location message
+    if message["type"] == "location":
+        location = message["location"]
+        latitude = location["latitude"]
+        longitude = location["longitude"]
+        address = location.get("address", "Unknown")
+
+        # Check if sender is customer or driver
+        if identity.is_customer:
+            result = {"status": "customer location updated"}
+            identities[from_phone] = await async_crud.set_customer_location(
+                db, identity, latitude, longitude, address,
+                before_commit=lambda: finish(
+                    result, "Location updated! Send order in this format: 'I want <quantity> litres of water'"
+                ),
+            )
+            outbox_worker.notify()
+            return result
+
+        if identity.is_driver:
+            identities[from_phone] = await async_crud.set_driver_location(
+                db, identity, latitude, longitude, address
+            )
+            return await reply({"status": "driver location updated"}, "Your location updated. Ready for assignments!")
+
+        # New user
+        result = {"status": "new customer created"}
+        customer_create = CustomerCreate(
+            phone=from_phone, location=address, latitude=latitude, longitude=longitude
+        )
+        identities[from_phone] = await async_crud.create_customer(
+            db, customer_create,
+            before_commit=lambda: finish(
+                result, "Location saved! \n Send your order in this format: 'I want <quantity> litres of water'"
+            ),
+        )
+        outbox_worker.notify()
+        return result
+
+    # Handle text message (order)
+    if message["type"] == "text":
+        body = message["text"]["body"].strip().lower()
+
+        match = re.search(ORDER_PATTERN, body)
+        if not match:
+            return await reply(
+                {"status": "invalid format"},
+                "Invalid format. Share location, then: 'I want <quantity> litres of water'",
+            )
+
+        quantity_str, unit = match.groups()
+        quantity = int(quantity_str)
+
+        # Check customer and location
+        if not identity.is_customer:
+            result = {"status": "location required"}
+            customer_create = CustomerCreate(phone=from_phone, location="Unknown")
+            identities[from_phone] = await async_crud.create_customer(
+                db, customer_create,
+                before_commit=lambda: finish(result, "Please share your location first (attachment > Location)."),
+            )
+            outbox_worker.notify()
+            return result
+
+        if not identity.latitude:
+            return await reply(
+                {"status": "location required"}, "Please share your location first (attachment > Location)."
+            )
+
+        placed = await order_service.aplace_order(
+            db, identity, quantity, before_commit=lambda placed: finish(_order_result(placed))
+        )
+        return _order_result(placed)
+
+    return await reply({"status": "ignored"})
+
+
+class LeaseLost(Exception):
+    """Our lease on a message expired and another worker may have reclaimed it."""
+
+
+async def claim_message(db: AsyncSession, message_id: str) -> Optional[datetime]:
+    """Move a message to PROCESSING unless another worker holds a live lease on it.
+
+    Returns the new lease expiry, which identifies this claim, or None.
+    """
+    now = utcnow()
+    lease = now + timedelta(seconds=WEBHOOK_LEASE_SECONDS)
+    result = await db.execute(
+        update(InboundMessage)
+        .where(
+            InboundMessage.id == message_id,
+            or_(
+                InboundMessage.status == MessageStatus.RECEIVED,
+                and_(
+                    InboundMessage.status == MessageStatus.PROCESSING,
+                    InboundMessage.claimed_until < now,
+                ),
+            ),
+        )
+        .values(status=MessageStatus.PROCESSING, claimed_until=lease)
+    )
+    return lease if result.rowcount == 1 else None
+
+
+async def stage_finish(db: AsyncSession, message_id: str, lease: datetime, **values):
+    """Record the message's outcome in the current transaction, provided we still hold the lease."""
+    result = await db.execute(
+        update(InboundMessage)
+        .where(InboundMessage.id == message_id, InboundMessage.claimed_until == lease)
+        .values(processed_at=utcnow(), **values)
+    )
+    if result.rowcount != 1:
+        raise LeaseLost(f"Lease on inbound message {message_id} was lost")
+
+
+async def _finish_message(db: AsyncSession, message_id: str, lease: datetime, **values) -> bool:
+    try:
+        await stage_finish(db, message_id, lease, **values)
+    except LeaseLost:
+        await db.rollback()
+        return False
+    await db.commit()
+    return True
+
+
+async def process_messages(message_ids: List[str], session_factory=None):
+    """Process a batch of stored messages in the given order.
+
+    Senders are resolved through the identity cache, with at most one
+    query for the whole batch. Each message is claimed just before it is
+    handled, so a lease only has to cover one message, and whatever the
+    message changes is committed together with its reply and outcome: if
+    the lease was lost in the meantime all of it is rolled back instead of
+    applied twice.
+    """
+    session_factory = session_factory or async_session_factory()
+    async with session_factory() as db:
+        unfinished = [MessageStatus.RECEIVED, MessageStatus.PROCESSING]
+        rows = {
+            row.id: row
+            for row in (
+                await db.scalars(
+                    select(InboundMessage).where(
+                        InboundMessage.id.in_(message_ids), InboundMessage.status.in_(unfinished)
+                    )
+                )
+            ).all()
+        }
+        batch = [(message_id, rows[message_id].payload) for message_id in message_ids if message_id in rows]
+        await db.commit()
+        if not batch:
+            return
+        with span("identity_lookup"):
+            identities = await identity_resolver.aresolve(db, [payload["from"] for _, payload in batch])
+
+        for message_id, payload in batch:
+            lease = await claim_message(db, message_id)
+            await db.commit()
+            if lease is None:
+                continue
+            message_type = payload.get("type", "unknown")
+            with trace(f"message {message_id} ({message_type})"), deadline(WEBHOOK_MESSAGE_DEADLINE_SECONDS):
+                try:
+                    with span("message"):
+                        await handle_message(db, payload, identities, message_id, lease)
+                except LeaseLost:
+                    await db.rollback()
+                    logger.warning(f"Inbound message {message_id} was reclaimed while in progress; dropped")
+                    webhook_messages.inc(message_type, "lease_lost")
+                    continue
+                except Exception as e:
+                    await db.rollback()
+                    logger.error(f"Inbound message {message_id} failed: {str(e)}")
+                    outcome = "failed"
+                    if not await _finish_message(db, message_id, lease, status=MessageStatus.FAILED, error=str(e)[:500]):
+                        outcome = "lease_lost"
+                    webhook_messages.inc(message_type, outcome)
+                    continue
+            webhook_messages.inc(message_type, "processed")
+
+
+async def pending_messages(db: AsyncSession, min_age_seconds: float = 0, limit: int = 500) -> List[tuple]:
+    """(id, phone) of messages nobody is working on, oldest first.
+
+    These were never claimed, or were claimed under an expired lease.
+    min_age_seconds skips freshly received messages that are likely still
+    queued in some worker's memory.
+    """
+    now = utcnow()
+    received_before = now - timedelta(seconds=min_age_seconds)
+    result = await db.execute(
+        select(InboundMessage.id, InboundMessage.phone)
+        .where(
+            or_(
+                and_(
+                    InboundMessage.status == MessageStatus.RECEIVED,
+                    InboundMessage.received_at <= received_before,
+                ),
+                and_(
+                    InboundMessage.status == MessageStatus.PROCESSING,
+                    InboundMessage.claimed_until < now,
+                ),
+            )
+        )
+        .order_by(InboundMessage.received_at, InboundMessage.position)
+        .limit(limit)
+    )
+    return result.all()
+
+
+async def deferred_messages(db: AsyncSession, phones: List[str]) -> List[tuple]:
+    """(id, phone) of every RECEIVED message from the given phones, oldest first."""
+    if not phones:
+        return []
+    result = await db.execute(
+        select(InboundMessage.id, InboundMessage.phone)
+        .where(InboundMessage.status == MessageStatus.RECEIVED, InboundMessage.phone.in_(phones))
+        .order_by(InboundMessage.received_at, InboundMessage.position)
+    )
+    return result.all()
+
+
+class WebhookWorkerPool:
+    """Bounded pool of asyncio workers for stored inbound messages.
+
+    Each worker owns one queue and messages are routed by sender phone, so a
+    customer's messages are handled in arrival order while different
+    customers are processed concurrently. When a phone's queue is full its
+    message is deferred, and so is every later message from that phone,
+    until the sweep has re-queued all of them in order.
+    """
+
+    def __init__(
+        self,
+        workers: int = WEBHOOK_WORKERS,
+        queue_size: int = WEBHOOK_QUEUE_SIZE,
+        session_factory=None,
+    ):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.session_factory = session_factory
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._queued = set()
+        # Phone -> ids of its messages that were turned away since it was deferred
+        self._deferred: Dict[str, set] = {}
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    @property
+    def depth(self) -> int:
+        """Messages queued or being processed by this process."""
+        return len(self._queued)
+
+    def start(self, sweep: bool = True):
+        if self._tasks:
+            return
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._work(queue)) for queue in self._queues]
+        if sweep:
+            self._tasks.append(asyncio.create_task(self._sweep()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queues = []
+        self._queued.clear()
+        self._deferred.clear()
+
+    def _shard(self, phone: Optional[str]) -> asyncio.Queue:
+        return self._queues[zlib.crc32((phone or "").encode()) % len(self._queues)]
+
+    def submit(self, message_id: str, phone: Optional[str]) -> bool:
+        """Queue a message; False if the pool is not running, that worker is full or the phone is deferred.
+
+        Messages that are not queued stay RECEIVED and are picked up by the sweep.
+        """
+        if not self._queues or message_id in self._queued:
+            return False
+        phone = phone or ""
+        if phone in self._deferred:
+            # An earlier message from this phone is waiting for the sweep; keep this one behind it
+            self._deferred[phone].add(message_id)
+            return False
+        try:
+            self._shard(phone).put_nowait(message_id)
+        except asyncio.QueueFull:
+            logger.warning(f"Webhook queue full, deferring messages from {phone} to the sweep")
+            self._deferred[phone] = {message_id}
+            return False
+        self._queued.add(message_id)
+        return True
+
+    async def _release_deferred(self, db: AsyncSession) -> int:
+        """Re-queue deferred phones' messages in arrival order; returns how many were queued.
+
+        A phone is released only if no message was turned away for it while
+        the query ran, so the result holds every message it is waiting on.
+        """
+        snapshot = {phone: set(message_ids) for phone, message_ids in self._deferred.items()}
+        pending = await deferred_messages(db, list(snapshot))
+        by_phone: Dict[str, List[str]] = {}
+        for message_id, phone in pending:
+            by_phone.setdefault(phone or "", []).append(message_id)
+        queued = 0
+        for phone, message_ids in snapshot.items():
+            if self._deferred.get(phone) != message_ids:
+                continue
+            del self._deferred[phone]
+            for message_id in by_phone.get(phone, []):
+                if self.submit(message_id, phone):
+                    queued += 1
+        return queued
+
+    async def _work(self, queue: asyncio.Queue):
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < WEBHOOK_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+            try:
+                await process_messages(batch, self.session_factory)
+            except Exception as e:
+                logger.error(f"Webhook worker error on messages {batch}: {str(e)}")
+            finally:
+                for message_id in batch:
+                    self._queued.discard(message_id)
+                    queue.task_done()
+
+    async def sweep_once(self, min_age_seconds: float = WEBHOOK_SWEEP_SECONDS) -> int:
+        session_factory = self.session_factory or async_session_factory()
+        async with session_factory() as db:
+            queued = await self._release_deferred(db) if self._deferred else 0
+            pending = await pending_messages(db, min_age_seconds=min_age_seconds)
+        for message_id, phone in pending:
+            if self.submit(message_id, phone):
+                queued += 1
+        return queued
+
+    async def _sweep(self):
+        """Re-queue messages that were deferred, left by a crashed worker, or stored while down."""
+        while True:
+            try:
+                await self.sweep_once()
+            except Exception as e:
+                logger.error(f"Webhook sweep error: {str(e)}")
+            await asyncio.sleep(WEBHOOK_SWEEP_SECONDS)
+
+
+webhook_pool = WebhookWorkerPool()
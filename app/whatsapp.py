@@ -0,0 +1,295 @@
+import asyncio
+import logging
+import os
+import random
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import httpx
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.database.setup import SessionLocal
+from app.metrics import span, whatsapp_sends
+from app.outbound import Upstream, UpstreamUnavailable
+from app.models import OutboxMessage, OutboxStatus, utcnow
+
+logger = logging.getLogger(__name__)
+
+# WhatsApp Business API config
+WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
+WHATSAPP_ACCESS_TOKEN = os.getenv("WHATSAPP_ACCESS_TOKEN")
+WHATSAPP_VERIFY_TOKEN = os.getenv("WHATSAPP_VERIFY_TOKEN")
+# Overridable so load tests can point at benchmarks.stubs instead of Meta
+WHATSAPP_API_URL = os.getenv(
+    "WHATSAPP_API_URL", f"https://graph.facebook.com/v20.0/{WHATSAPP_PHONE_NUMBER_ID}/messages"
+)
+
+WHATSAPP_TIMEOUT_SECONDS = float(os.getenv("WHATSAPP_TIMEOUT_SECONDS", "10"))
+WHATSAPP_MAX_CONNECTIONS = int(os.getenv("WHATSAPP_MAX_CONNECTIONS", "20"))
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_BACKOFF_BASE_SECONDS = float(os.getenv("OUTBOX_BACKOFF_BASE_SECONDS", "2"))
+OUTBOX_BACKOFF_MAX_SECONDS = float(os.getenv("OUTBOX_BACKOFF_MAX_SECONDS", "300"))
+# How long a claimed message stays reserved before another worker may retry it
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+
+
+class PermanentSendError(Exception):
+    """Meta rejected the message; retrying will not help."""
+
+
+class SendSkipped(Exception):
+    """Not attempted: an earlier message to the same recipient failed in this batch."""
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class WhatsAppSender:
+    """Sends WhatsApp text messages over one pooled, keep-alive HTTP client."""
+
+    def __init__(self):
+        self.upstream = Upstream(
+            "whatsapp",
+            timeout=WHATSAPP_TIMEOUT_SECONDS,
+            max_connections=WHATSAPP_MAX_CONNECTIONS,
+            headers={"Authorization": f"Bearer {WHATSAPP_ACCESS_TOKEN}"},
+            http2=_http2_available(),
+        )
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self.upstream.client
+
+    async def send(self, to_phone: str, text: str):
+        payload = {
+            "messaging_product": "whatsapp",
+            "to": to_phone,
+            "type": "text",
+            "text": {"body": text},
+        }
+        # Not hedged: a duplicate POST would send the customer the message twice
+        response = await self.upstream.request("POST", WHATSAPP_API_URL, json=payload)
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            raise PermanentSendError(f"{response.status_code}: {response.text}")
+        response.raise_for_status()
+
+    async def close(self):
+        await self.upstream.aclose()
+
+
+def stage_whatsapp_message(db: Session, to_phone: str, text: str) -> OutboxMessage:
+    """Add an outbound message to the caller's transaction; call outbox_worker.notify() after commit."""
+    message = OutboxMessage(to_phone=to_phone, body=text)
+    db.add(message)
+    return message
+
+
+def enqueue_whatsapp_message(db: Session, to_phone: str, text: str) -> OutboxMessage:
+    """Persist an outbound message; the outbox worker delivers it."""
+    message = stage_whatsapp_message(db, to_phone, text)
+    db.commit()
+    outbox_worker.notify()
+    return message
+
+
+async def aenqueue_whatsapp_message(db: AsyncSession, to_phone: str, text: str) -> OutboxMessage:
+    """enqueue_whatsapp_message for async callers."""
+    message = stage_whatsapp_message(db, to_phone, text)
+    await db.commit()
+    outbox_worker.notify()
+    return message
+
+
+def _backoff_seconds(attempts: int) -> float:
+    delay = min(OUTBOX_BACKOFF_BASE_SECONDS * (2 ** (attempts - 1)), OUTBOX_BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.5, 1.0)
+
+
+class OutboxWorker:
+    """Background task that drains whatsapp_outbox with retries and exponential backoff.
+
+    Messages are claimed with a conditional UPDATE and a lease, so several
+    workers (or gunicorn processes) can drain the same table without sending
+    a message twice. Within a batch, each recipient's messages are sent one
+    after another in the order they were created, and only different
+    recipients are sent to concurrently.
+    """
+
+    def __init__(self, sender: WhatsAppSender, session_factory=SessionLocal):
+        self.sender = sender
+        self.session_factory = session_factory
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self):
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.sender.close()
+
+    def notify(self):
+        """Wake the worker early; safe to call from any thread."""
+        if self._loop is None or self._wakeup is None or self._loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._wakeup.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _claim_batch(self, limit: int = OUTBOX_BATCH_SIZE) -> List[OutboxMessage]:
+        with self.session_factory() as db:
+            now = utcnow()
+            candidates = (
+                db.query(OutboxMessage.id)
+                .filter(
+                    OutboxMessage.status.in_([OutboxStatus.PENDING, OutboxStatus.SENDING]),
+                    OutboxMessage.next_attempt_at <= now,
+                )
+                .order_by(OutboxMessage.next_attempt_at, OutboxMessage.created_at, OutboxMessage.id)
+                .limit(limit)
+                .all()
+            )
+            lease_until = now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+            claimed = []
+            for (message_id,) in candidates:
+                result = db.execute(
+                    update(OutboxMessage)
+                    .where(
+                        OutboxMessage.id == message_id,
+                        OutboxMessage.status.in_([OutboxStatus.PENDING, OutboxStatus.SENDING]),
+                        OutboxMessage.next_attempt_at <= now,
+                    )
+                    .values(
+                        status=OutboxStatus.SENDING,
+                        next_attempt_at=lease_until,
+                        attempts=OutboxMessage.attempts + 1,
+                    )
+                )
+                if result.rowcount == 1:
+                    claimed.append(message_id)
+            db.commit()
+            if not claimed:
+                return []
+            messages = db.query(OutboxMessage).filter(OutboxMessage.id.in_(claimed)).all()
+            db.expunge_all()
+            return messages
+
+    def _record_results(self, results):
+        """Store each send's outcome; results must list a recipient's messages in send order."""
+        with self.session_factory() as db:
+            now = utcnow()
+            # When each recipient's failed message is retried; its skipped followers go right after it
+            retry_at: Dict[str, datetime] = {}
+            for message, error in results:
+                if error is None:
+                    values = {"status": OutboxStatus.SENT, "sent_at": now, "last_error": None}
+                elif isinstance(error, SendSkipped):
+                    values = {
+                        "status": OutboxStatus.PENDING,
+                        "attempts": OutboxMessage.attempts - 1,
+                        "next_attempt_at": retry_at.get(message.to_phone, now),
+                    }
+                elif isinstance(error, UpstreamUnavailable):
+                    # Never reached Meta, so the attempt doesn't count towards giving up
+                    values = {
+                        "status": OutboxStatus.PENDING,
+                        "attempts": OutboxMessage.attempts - 1,
+                        "next_attempt_at": now + timedelta(seconds=OUTBOX_BACKOFF_BASE_SECONDS),
+                        "last_error": str(error)[:500],
+                    }
+                elif isinstance(error, PermanentSendError) or message.attempts >= OUTBOX_MAX_ATTEMPTS:
+                    values = {"status": OutboxStatus.FAILED, "last_error": str(error)[:500]}
+                    logger.error(f"Giving up on WhatsApp message {message.id} to {message.to_phone}: {error}")
+                else:
+                    values = {
+                        "status": OutboxStatus.PENDING,
+                        "next_attempt_at": now + timedelta(seconds=_backoff_seconds(message.attempts)),
+                        "last_error": str(error)[:500],
+                    }
+                if error is not None and not isinstance(error, SendSkipped):
+                    retry_at[message.to_phone] = values.get("next_attempt_at", now)
+                db.execute(update(OutboxMessage).where(OutboxMessage.id == message.id).values(**values))
+            db.commit()
+
+    async def _send(self, message: OutboxMessage):
+        try:
+            with span("whatsapp_send"):
+                await self.sender.send(message.to_phone, message.body)
+            whatsapp_sends.inc("sent")
+            return message, None
+        except Exception as e:
+            whatsapp_sends.inc("failed")
+            logger.warning(f"WhatsApp send to {message.to_phone} failed (attempt {message.attempts}): {e}")
+            return message, e
+
+    async def _send_in_order(self, messages: List[OutboxMessage]):
+        """Send one recipient's messages one by one; after a failure the rest wait for its retry."""
+        results = []
+        for message in messages:
+            if results and results[-1][1] is not None:
+                results.append((message, SendSkipped(f"Waiting on an earlier message to {message.to_phone}")))
+                continue
+            results.append(await self._send(message))
+        return results
+
+    async def drain_once(self) -> int:
+        breaker = self.sender.upstream.breaker
+        if not breaker.allows():
+            return 0
+        # While Meta is recovering, probe with a single message rather than a full batch
+        limit = OUTBOX_BATCH_SIZE if breaker.state == "closed" else 1
+        messages = await asyncio.to_thread(self._claim_batch, limit)
+        if not messages:
+            return 0
+        by_recipient: Dict[str, List[OutboxMessage]] = {}
+        for message in sorted(messages, key=lambda m: (m.created_at, m.id)):
+            by_recipient.setdefault(message.to_phone, []).append(message)
+        groups = await asyncio.gather(*(self._send_in_order(group) for group in by_recipient.values()))
+        await asyncio.to_thread(self._record_results, [result for group in groups for result in group])
+        return len(messages)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                sent = await self.drain_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox worker error: {str(e)}")
+                sent = 0
+            if sent >= OUTBOX_BATCH_SIZE:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+
+whatsapp_sender = WhatsAppSender()
+outbox_worker = OutboxWorker(whatsapp_sender)
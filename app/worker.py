@@ -0,0 +1,62 @@
+"""Standalone webhook worker: `python -m app.worker`.
+
+Run with WEBHOOK_PROCESSING=external on the web processes so they only store
+and acknowledge deliveries; this process claims the stored messages and
+processes them with the same code the web process would use. With
+DISPATCH_MODE=batch it also runs the batch dispatcher.
+"""
+import asyncio
+import logging
+import os
+
+from app.settings import load_settings
+
+if __name__ == "__main__":
+    # Run as a script: load .env before the modules below read their settings
+    load_settings()
+
+from app.outbound import close_upstreams
+from app.database.setup import dispose_engines
+from app.driver_locations import driver_locations
+from app.order_service import DISPATCH_MODE
+from app.webhook import webhook_pool
+from app.whatsapp import outbox_worker
+
+logger = logging.getLogger(__name__)
+
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "0.5"))
+
+
+async def run():
+    outbox_worker.start()
+    driver_locations.start()
+    webhook_pool.start(sweep=False)
+    batch_dispatcher = None
+    if DISPATCH_MODE == "batch":
+        # Imported only when used: the solver pulls in NumPy
+        from app.dispatcher import batch_dispatcher
+
+        batch_dispatcher.start()
+    logger.info(f"Webhook worker started with {webhook_pool.workers} workers")
+    try:
+        while True:
+            try:
+                queued = await webhook_pool.sweep_once(min_age_seconds=0)
+            except Exception as e:
+                logger.error(f"Webhook worker poll error: {str(e)}")
+                queued = 0
+            if not queued:
+                await asyncio.sleep(WORKER_POLL_SECONDS)
+    finally:
+        if batch_dispatcher is not None:
+            await batch_dispatcher.stop()
+        await webhook_pool.stop()
+        await driver_locations.stop()
+        await outbox_worker.stop()
+        await close_upstreams()
+        await dispose_engines()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run())
@@ -0,0 +1,118 @@
+"""Worker boot time: importing app.main, building the app and running its startup.
+
+Run from the repository root:
+
+    python -m benchmarks.cold_start [--runs 10] [--modules 15]
+
+Each run is a fresh interpreter, as a new gunicorn worker would be. It
+times `import app.main`, `create_app()`, the lifespan startup and the
+first request, and checks that the import left the database alone. The
+schema is created once up front with app.database.migrate, since the app
+no longer does that itself. --modules lists the slowest imports from
+`python -X importtime`.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+CHILD = r"""
+import asyncio, json, time
+started = time.perf_counter()
+import app.main
+imported = time.perf_counter()
+
+from app.database import setup
+engine_at_import = setup._engine is not None or setup._async_engine is not None
+
+app_ = app.main.create_app()
+created = time.perf_counter()
+
+import httpx
+
+async def boot():
+    async with app_.router.lifespan_context(app_):
+        ready = time.perf_counter()
+        transport = httpx.ASGITransport(app=app_)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+            response = await client.get("/orders/", params={"limit": 1})
+        served = time.perf_counter()
+        assert response.status_code == 200, response.text
+    return ready, served
+
+ready, served = asyncio.run(boot())
+print(json.dumps({
+    "import": imported - started,
+    "create_app": created - imported,
+    "startup": ready - created,
+    "first request": served - ready,
+    "total": served - started,
+    "engine at import": engine_at_import,
+}))
+"""
+
+STAGES = ("import", "create_app", "startup", "first request", "total")
+
+
+def child_env(database_url: str) -> dict:
+    env = dict(os.environ)
+    env["DATABASE_URL"] = database_url
+    env.pop("ASYNC_DATABASE_URL", None)
+    env["LOG_LEVEL"] = "WARNING"
+    return env
+
+
+def slowest_imports(env: dict, count: int):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        env=env, capture_output=True, text=True, check=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue  # Header line
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        # app.main and what it imports directly, so nested modules are not counted twice
+        if depth <= 1:
+            rows.append((int(cumulative_us), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--modules", type=int, default=15)
+    args = parser.parse_args()
+
+    database_url = os.environ.get("DATABASE_URL") or f"sqlite:///{tempfile.mkdtemp()}/cold_start.db"
+    env = child_env(database_url)
+    subprocess.run([sys.executable, "-m", "app.database.migrate"], env=env, check=True, capture_output=True)
+
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, "-c", CHILD], env=env, capture_output=True, text=True, check=True
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{args.runs} cold starts, {database_url.split(':')[0]} (ms)")
+    print(f"{'stage':<15} {'median':>9} {'min':>9} {'max':>9}")
+    for stage in STAGES:
+        values = [run[stage] * 1000 for run in runs]
+        print(f"{stage:<15} {statistics.median(values):>9.1f} {min(values):>9.1f} {max(values):>9.1f}")
+    print(f"engine created at import: {any(run['engine at import'] for run in runs)}")
+
+    if args.modules:
+        print("\nslowest imports (cumulative ms)")
+        for cumulative, name in slowest_imports(env, args.modules):
+            print(f"{name:<40} {cumulative / 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Concurrent orders against a small driver pool: checks that no driver is double-booked.
+
+Run from the repository root:
+
+    python -m benchmarks.driver_claims [--orders 200] [--drivers 20] [--concurrency 16] [--async]
+
+Every customer sits next to the same drivers, so all orders compete for
+the same few nearest rows. By default this runs on a throwaway SQLite
+database, which serializes writers, so it checks correctness but not
+contention. With --postgres it runs on DATABASE_URL instead (and
+ASYNC_DATABASE_URL for --async, else DATABASE_URL with asyncpg), where
+concurrent claims race for real and the FOR UPDATE SKIP LOCKED claim is
+the one taken:
+
+    DATABASE_URL=postgresql://postgres@localhost/driver_claims \\
+        python -m benchmarks.driver_claims --postgres [--async]
+
+Every table in that database is dropped and recreated, so point it at a
+scratch database. The Distance Matrix is replaced with a great-circle
+estimate. Claims lost to a concurrent order are reported; exits
+non-zero if any driver ends up with more than one assignment.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CENTER = (6.5, 3.35)
+
+
+def configure(args):
+    """Environment for the app under test; must run before any app module is imported."""
+    # Great-circle estimates instead of the Distance Matrix
+    os.environ["DISTANCE_RANKING_PROVIDER"] = os.environ["DISTANCE_BILLING_PROVIDER"] = "offline"
+    if args.postgres:
+        url = os.environ.get("DATABASE_URL", "")
+        if not url.startswith("postgresql"):
+            sys.exit("--postgres needs DATABASE_URL set to a PostgreSQL database")
+    else:
+        os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/driver_claims.db"
+        os.environ.pop("ASYNC_DATABASE_URL", None)
+    # One connection per concurrent order, so orders contend on driver rows rather than on the pool
+    os.environ.setdefault("DB_POOL_SIZE", str(args.concurrency))
+
+
+def _near(rng):
+    return CENTER[0] + rng.uniform(-0.01, 0.01), CENTER[1] + rng.uniform(-0.01, 0.01)
+
+
+def seed(engine, drivers: int, customers: int) -> list:
+    from app.database.setup import Base, SessionLocal
+    from app.models import Customer, Driver, WaterSource
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    rng = random.Random(11)
+    with SessionLocal() as db:
+        db.add(WaterSource(address="Borehole", latitude=CENTER[0], longitude=CENTER[1]))
+        for i in range(drivers):
+            lat, lng = _near(rng)
+            db.add(Driver(
+                name=f"Driver {i}", phone=f"23480{i:08d}", vehicle_number=f"TRK-{i}",
+                location="Depot", latitude=lat, longitude=lng,
+            ))
+        for i in range(customers):
+            lat, lng = _near(rng)
+            db.add(Customer(phone=f"23490{i:08d}", location="Home", latitude=lat, longitude=lng))
+        db.commit()
+        customers = db.query(Customer).all()
+        db.expunge_all()
+    return customers
+
+
+def place(customer) -> str:
+    from app.database.setup import SessionLocal
+    from app.order_service import order_service
+
+    with SessionLocal() as db:
+        try:
+            placed = order_service.place_order(db, customer, 20)
+        except Exception as e:
+            return f"error: {type(e).__name__}"
+    return "assigned" if placed.driver_id else "no driver"
+
+
+async def aplace(customer, limit: asyncio.Semaphore) -> str:
+    from app.database.setup import async_session_factory
+    from app.order_service import order_service
+
+    async with limit, async_session_factory()() as db:
+        try:
+            placed = await order_service.aplace_order(db, customer, 20)
+        except Exception as e:
+            return f"error: {type(e).__name__}"
+    return "assigned" if placed.driver_id else "no driver"
+
+
+async def run_async(customers, concurrency: int) -> list:
+    from app.database.setup import dispose_engines
+
+    limit = asyncio.Semaphore(concurrency)
+    try:
+        return await asyncio.gather(*(aplace(customer, limit) for customer in customers))
+    finally:
+        await dispose_engines()
+
+
+def claim_sql(engine) -> str:
+    """The driver claim as compiled for this database."""
+    from app.crud import CRUD
+    from app.database.setup import SessionLocal
+
+    with SessionLocal() as db:
+        statement = CRUD._claim_driver_statement(db, "driver")
+        return " ".join(str(statement.compile(dialect=engine.dialect)).split())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--drivers", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use aplace_order on AsyncSessions")
+    parser.add_argument("--postgres", action="store_true", help="run on DATABASE_URL, which must be PostgreSQL")
+    args = parser.parse_args()
+    configure(args)
+
+    from sqlalchemy import func, select
+
+    from app.database.setup import SessionLocal, get_engine
+    from app.metrics import driver_claims
+    from app.models import Driver, OrderAssignment
+
+    engine = get_engine()
+    customers = seed(engine, args.drivers, args.orders)
+
+    started = time.perf_counter()
+    if args.use_async:
+        outcomes = asyncio.run(run_async(customers, args.concurrency))
+    else:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            outcomes = list(pool.map(place, customers))
+    elapsed = time.perf_counter() - started
+
+    with SessionLocal() as db:
+        assignments = db.scalar(select(func.count()).select_from(OrderAssignment))
+        double_booked = db.execute(
+            select(OrderAssignment.driver_id, func.count())
+            .group_by(OrderAssignment.driver_id)
+            .having(func.count() > 1)
+        ).all()
+        still_free = db.scalar(select(func.count()).select_from(Driver).where(Driver.is_available == True))
+
+    mode = "async" if args.use_async else "threads"
+    print(f"{args.orders} orders, {args.drivers} drivers, {args.concurrency} {mode}, {engine.url.get_backend_name()}")
+    print(f"claim: {claim_sql(engine)}")
+    for outcome in sorted(set(outcomes)):
+        print(f"  {outcome:<28} {outcomes.count(outcome):>6}")
+    print(f"  {'assignments':<28} {assignments:>6}")
+    print(f"  {'drivers left available':<28} {still_free:>6}")
+    print(f"  {'claims lost to another order':<28} {driver_claims.value('lost'):>6.0f}")
+    print(f"  {'elapsed':<28} {elapsed:>6.2f}s")
+
+    if engine.dialect.name != "postgresql":
+        print("note: concurrent claims were serialized by the database; use --postgres to test SKIP LOCKED")
+    if double_booked:
+        print(f"FAIL: {len(double_booked)} drivers assigned more than once: {double_booked[:5]}")
+        sys.exit(1)
+    if assignments + still_free != args.drivers:
+        print("FAIL: assignments and available drivers do not add up")
+        sys.exit(1)
+    print("OK: no driver was assigned twice")
+
+
+if __name__ == "__main__":
+    main()
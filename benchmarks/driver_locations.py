@@ -0,0 +1,116 @@
+"""Database cost of live driver locations: a commit per update vs the write-behind buffer.
+
+Run from the repository root:
+
+    python -m benchmarks.driver_locations [--drivers 500] [--updates 20]
+
+Every driver sends --updates positions. The old path loads the driver and
+commits each update; the new path records them in driver_locations and
+flushes on its interval, as the webhook now does. Both run on an
+AsyncSession against a throwaway SQLite file.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+if "DATABASE_URL" not in os.environ:
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/driver_locations.db"
+
+from sqlalchemy import event, insert, select
+
+from app.database.setup import Base, async_session_factory, get_async_engine, get_engine
+from app.driver_locations import driver_locations
+from app.models import Driver, generate_ulid
+
+engine = get_engine()
+
+
+def seed(count: int):
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    drivers = [generate_ulid() for _ in range(count)]
+    with engine.begin() as connection:
+        connection.execute(insert(Driver), [
+            {"id": d, "name": f"Driver {i}", "phone": f"235{i:010d}", "vehicle_number": f"TRK-{i}",
+             "location": "Depot", "latitude": 6.5, "longitude": 3.3, "is_available": True}
+            for i, d in enumerate(drivers)
+        ])
+    return drivers
+
+
+def updates(drivers, per_driver: int, rng):
+    # Interleaved like live traffic: every driver moves a little, then again
+    for _ in range(per_driver):
+        for driver_id in drivers:
+            yield driver_id, 6.5 + rng.uniform(-0.1, 0.1), 3.3 + rng.uniform(-0.1, 0.1)
+
+
+async def per_update(stream):
+    async with async_session_factory()() as db:
+        for driver_id, lat, lng in stream:
+            driver = await db.get(Driver, driver_id)
+            driver.latitude = lat
+            driver.longitude = lng
+            driver.location = "Live"
+            await db.commit()
+
+
+async def write_behind(stream):
+    # Compressed clock: a flush every 1000 updates stands in for one every DRIVER_LOCATION_FLUSH_SECONDS
+    for count, (driver_id, lat, lng) in enumerate(stream, 1):
+        driver_locations.record(driver_id, lat, lng, "Live")
+        if count % 1000 == 0:
+            await driver_locations.flush()
+    await driver_locations.flush()
+
+
+async def run(mode: str, drivers, per_driver: int) -> dict:
+    statements = {"count": 0}
+
+    def count(*_):
+        statements["count"] += 1
+
+    sync_engine = get_async_engine().sync_engine
+    event.listen(sync_engine, "before_cursor_execute", count)
+    rng = random.Random(3)
+    started = time.perf_counter()
+    if mode == "per-update":
+        await per_update(updates(drivers, per_driver, rng))
+    else:
+        await write_behind(updates(drivers, per_driver, rng))
+    elapsed = time.perf_counter() - started
+    event.remove(sync_engine, "before_cursor_execute", count)
+
+    async with async_session_factory()() as db:
+        moved = (await db.scalars(select(Driver.id).where(Driver.location == "Live"))).all()
+    return {"seconds": elapsed, "statements": statements["count"], "drivers updated": len(moved)}
+
+
+async def amain(args):
+    results = {}
+    for mode in ("per-update", "write-behind"):
+        drivers = seed(args.drivers)
+        results[mode] = await run(mode, drivers, args.updates)
+    total = args.drivers * args.updates
+    print(f"{total} location updates from {args.drivers} drivers, sqlite")
+    print(f"{'':<14} {'seconds':>9} {'statements':>11} {'updates/s':>10} {'drivers updated':>16}")
+    for mode, r in results.items():
+        print(
+            f"{mode:<14} {r['seconds']:>9.3f} {r['statements']:>11} "
+            f"{total / r['seconds']:>10.0f} {r['drivers updated']:>16}"
+        )
+    await get_async_engine().dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--drivers", type=int, default=500)
+    parser.add_argument("--updates", type=int, default=20)
+    asyncio.run(amain(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
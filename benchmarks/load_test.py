@@ -0,0 +1,224 @@
+"""End-to-end webhook load test against local Distance Matrix and WhatsApp stubs.
+
+Run from the repository root; no network access is needed:
+
+    python -m benchmarks.load_test [--scenario mixed] [--messages 2000] [--concurrency 20]
+        [--batch-size 1] [--distance-latency-ms 80] [--whatsapp-error-rate 0.05]
+
+The stubs from benchmarks.stubs are started on 127.0.0.1 and the app is
+pointed at them through DISTANCE_MATRIX_URL and WHATSAPP_API_URL before it
+is imported. The database is a throwaway SQLite file unless DATABASE_URL
+(and ASYNC_DATABASE_URL) name another one, e.g. a local Postgres; it is
+dropped and seeded with --sources water sources, --drivers drivers and
+--customers customers. Deliveries from benchmarks.payloads are then posted
+to /whatsapp by --concurrency clients through the app's lifespan, the
+same way uvicorn would run it, and the run ends once every message is
+processed and the outbox has drained (or --drain-seconds pass).
+
+Reported: webhook ack latency, message processing latency (received_at
+to processed_at), orders/sec, and upstream calls per order.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from typing import Dict, List
+
+from benchmarks.payloads import SCENARIOS, PayloadGenerator, random_point
+from benchmarks.stubs import StubServers, behaviour_args, behaviours
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def configure(stubs: StubServers):
+    """Environment for the app under test; must run before any app module is imported."""
+    os.environ.update(stubs.environ())
+    if "DATABASE_URL" not in os.environ:
+        os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/load_test.db"
+    # Water sources come from the seeded table only
+    os.environ["WATER_SOURCES"] = "[]"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # Retry failed sends within the run instead of minutes later
+    os.environ.setdefault("OUTBOX_BACKOFF_BASE_SECONDS", "0.2")
+    os.environ.setdefault("OUTBOX_BACKOFF_MAX_SECONDS", "2")
+    os.environ.setdefault("OUTBOX_POLL_SECONDS", "0.2")
+
+
+def seed(engine, sources: int, drivers: int, customers: int, rng) -> Dict[str, List[str]]:
+    from sqlalchemy import insert
+
+    from app.database.setup import Base
+    from app.models import Customer, Driver, WaterSource, generate_ulid
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    phones = {
+        "drivers": [f"23480{i:08d}" for i in range(drivers)],
+        "customers": [f"23490{i:08d}" for i in range(customers)],
+    }
+    with engine.begin() as connection:
+        connection.execute(insert(WaterSource), [
+            dict(zip(("latitude", "longitude"), random_point(rng)), id=generate_ulid(), address=f"Source {i}")
+            for i in range(sources)
+        ])
+        connection.execute(insert(Driver), [
+            dict(zip(("latitude", "longitude"), random_point(rng)), id=generate_ulid(), name=f"Driver {i}",
+                 phone=phone, vehicle_number=f"TRK-{i}", location="Depot", is_available=True)
+            for i, phone in enumerate(phones["drivers"])
+        ])
+        connection.execute(insert(Customer), [
+            dict(zip(("latitude", "longitude"), random_point(rng)), id=generate_ulid(), phone=phone, location="Home")
+            for phone in phones["customers"]
+        ])
+    return phones
+
+
+async def post_all(client, deliveries, concurrency: int) -> List[float]:
+    queue: asyncio.Queue = asyncio.Queue()
+    for payload in deliveries:
+        queue.put_nowait(payload)
+    acks: List[float] = []
+
+    async def sender():
+        while not queue.empty():
+            payload = queue.get_nowait()
+            started = time.perf_counter()
+            response = await client.post("/whatsapp", json=payload)
+            acks.append(time.perf_counter() - started)
+            response.raise_for_status()
+
+    await asyncio.gather(*(sender() for _ in range(concurrency)))
+    return acks
+
+
+async def wait_for(condition, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if await condition():
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+
+async def run(args, stubs: StubServers):
+    import random
+
+    import httpx
+    from sqlalchemy import func, select
+
+    from app.database.setup import async_session_factory, get_engine
+    from app.main import create_app
+    from app.metrics import distance_lookups
+    from app.models import InboundMessage, MessageStatus, Order, OrderAssignment, OutboxMessage, OutboxStatus
+
+    engine = get_engine()
+    rng = random.Random(args.seed)
+    phones = seed(engine, args.sources, args.drivers, args.customers, rng)
+    generator = PayloadGenerator(phones["customers"], phones["drivers"], seed=args.seed)
+    deliveries = list(generator.deliveries(args.scenario, args.messages, args.batch_size))
+
+    async def count(model, *where) -> int:
+        async with async_session_factory()() as db:
+            return await db.scalar(select(func.count()).select_from(model).where(*where))
+
+    async def processed() -> bool:
+        unfinished = [MessageStatus.RECEIVED, MessageStatus.PROCESSING]
+        return await count(InboundMessage, InboundMessage.status.in_(unfinished)) == 0
+
+    async def drained() -> bool:
+        unsent = [OutboxStatus.PENDING, OutboxStatus.SENDING]
+        return await count(OutboxMessage, OutboxMessage.status.in_(unsent)) == 0
+
+    app = create_app()
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+            started = time.perf_counter()
+            acks = await post_all(client, deliveries, args.concurrency)
+            posted = time.perf_counter() - started
+        finished = await wait_for(processed, args.timeout)
+        processing = time.perf_counter() - started
+        outbox_drained = await wait_for(drained, args.drain_seconds)
+
+        async with async_session_factory()() as db:
+            rows = (await db.execute(
+                select(InboundMessage.status, InboundMessage.result, InboundMessage.received_at,
+                       InboundMessage.processed_at)
+            )).all()
+            orders = await db.scalar(select(func.count()).select_from(Order))
+            assigned = await db.scalar(select(func.count()).select_from(OrderAssignment))
+            failed_sends = await count(OutboxMessage, OutboxMessage.status == OutboxStatus.FAILED)
+
+    latencies = [(processed_at - received_at).total_seconds() for _, _, received_at, processed_at in rows if processed_at]
+    order_latencies = [
+        (processed_at - received_at).total_seconds()
+        for _, result, received_at, processed_at in rows
+        if processed_at and result and result.get("status") == "order processed"
+    ]
+    failed = sum(1 for status, *_ in rows if status == MessageStatus.FAILED)
+    distance, whatsapp = stubs.distance.calls, stubs.whatsapp.calls
+
+    def per_order(calls: int) -> str:
+        return f"{calls / orders:.2f}" if orders else "-"
+
+    print(
+        f"{args.scenario}: {len(rows)} messages in {len(deliveries)} deliveries, {args.concurrency} clients, "
+        f"{engine.url.get_backend_name()}"
+    )
+    if not finished:
+        print(f"WARNING: messages still unprocessed after {args.timeout:.0f}s")
+    if not outbox_drained:
+        print(f"WARNING: outbox not drained after {args.drain_seconds:.0f}s")
+    print(f"{'':<22} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, values in (("webhook ack", acks), ("message processing", latencies), ("order processing", order_latencies)):
+        values = [v * 1000 for v in values]
+        print(f"{name:<22} {percentile(values, 0.5):>9.1f} {percentile(values, 0.99):>9.1f} {max(values, default=0):>9.1f}")
+    print()
+    print(f"{'acks/sec':<28} {len(rows) / posted:>10.1f}")
+    print(f"{'messages/sec':<28} {len(rows) / processing:>10.1f}")
+    print(f"{'orders/sec':<28} {orders / processing:>10.1f}")
+    print(f"{'orders (with driver)':<28} {orders:>10} ({assigned})")
+    print(f"{'failed messages':<28} {failed:>10}")
+    print()
+    print(f"{'upstream':<28} {'calls':>10} {'errors':>8} {'per order':>10}")
+    print(f"{'distance matrix requests':<28} {distance.requests:>10} {distance.errors:>8} {per_order(distance.requests):>10}")
+    print(f"{'distance matrix elements':<28} {distance.elements:>10} {'':>8} {per_order(distance.elements):>10}")
+    print(f"{'whatsapp sends':<28} {whatsapp.requests:>10} {whatsapp.errors:>8} {per_order(whatsapp.requests):>10}")
+    print(
+        f"distance lookups: {distance_lookups.value('cache'):.0f} from cache, {distance_lookups.value('api'):.0f} "
+        f"from the API; {failed_sends} outbox messages given up on"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=SCENARIOS, default="mixed")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=1, help="messages per webhook delivery")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--sources", type=int, default=20)
+    parser.add_argument("--drivers", type=int, default=500)
+    parser.add_argument("--customers", type=int, default=2000)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--drain-seconds", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    behaviour_args(parser)
+    args = parser.parse_args()
+
+    stubs = StubServers(**behaviours(args), seed=args.seed)
+    stubs.start()
+    try:
+        configure(stubs)
+        asyncio.run(run(args, stubs))
+    finally:
+        stubs.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Statements and commits per WhatsApp order: legacy per-step CRUD vs OrderService.
+
+Run from the repository root:
+
+    python -m benchmarks.order_pipeline [--orders 200] [--drivers 300]
+
+Uses a throwaway SQLite database unless DATABASE_URL is set, and replaces
+the Distance Matrix call with a local great-circle estimate so only
+database work is measured.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+# Great-circle estimates instead of the Distance Matrix
+os.environ["DISTANCE_RANKING_PROVIDER"] = os.environ["DISTANCE_BILLING_PROVIDER"] = "offline"
+if "DATABASE_URL" not in os.environ:
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/order_pipeline.db"
+
+from sqlalchemy import event, update
+
+from app.crud import crud
+from app.database.setup import Base, SessionLocal, get_engine
+from app.models import Customer, Driver, WaterSource
+from app.order_service import DEFAULT_TARIFF, order_service
+from app.schema import OrderAssignmentCreate, OrderCreate, PriceCreate
+from app.whatsapp import enqueue_whatsapp_message
+
+engine = get_engine()
+
+
+class Counter:
+    def __init__(self):
+        self.statements = 0
+        self.commits = 0
+        event.listen(engine, "before_cursor_execute", self._statement)
+        event.listen(engine, "commit", self._commit)
+
+    def _statement(self, *args):
+        self.statements += 1
+
+    def _commit(self, *args):
+        self.commits += 1
+
+    def reset(self):
+        self.statements = 0
+        self.commits = 0
+
+
+def seed(drivers: int, customers: int):
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    rng = random.Random(7)
+    with SessionLocal() as db:
+        for i in range(5):
+            db.add(WaterSource(address=f"Source {i}", latitude=6.4 + rng.random() * 0.3, longitude=3.3 + rng.random() * 0.3))
+        for i in range(drivers):
+            db.add(Driver(
+                name=f"Driver {i}", phone=f"23480{i:08d}", vehicle_number=f"TRK-{i}",
+                location="Depot", latitude=6.4 + rng.random() * 0.3, longitude=3.3 + rng.random() * 0.3,
+            ))
+        for i in range(customers):
+            db.add(Customer(
+                phone=f"23490{i:08d}", location="Home",
+                latitude=6.4 + rng.random() * 0.3, longitude=3.3 + rng.random() * 0.3,
+            ))
+        db.commit()
+
+
+def reset_drivers():
+    with SessionLocal() as db:
+        db.execute(update(Driver).values(is_available=True))
+        db.commit()
+
+
+def legacy_order(db, customer, quantity):
+    """The per-step flow the webhook used before OrderService."""
+    db_order = crud.create_order(db, OrderCreate(quantity=quantity, customer_id=customer.id))
+    price_create = PriceCreate(
+        order_id=db_order.id,
+        base_price=DEFAULT_TARIFF.base_price,
+        price_per_km=DEFAULT_TARIFF.price_per_km,
+        tax=DEFAULT_TARIFF.tax,
+    )
+    total_price = crud.calculate_order_price(db, price_create)
+    db_order.total_price = total_price
+    db.commit()
+    db.refresh(db_order)
+    db_driver = crud.get_available_driver(db, db_order.id)
+    crud.create_order_assignment(db, OrderAssignmentCreate(order_id=db_order.id, driver_id=db_driver.id))
+    tracking_link = crud.generate_tracking_link(
+        customer.latitude, customer.longitude, db_driver.latitude, db_driver.longitude
+    )
+    enqueue_whatsapp_message(db, customer.phone, f"Order confirmed! {quantity} litres for N{total_price}. Track driver: {tracking_link}")
+    enqueue_whatsapp_message(db, db_driver.phone, f"New order: {quantity} litres to {customer.location}.")
+
+
+def service_order(db, customer, quantity):
+    order_service.place_order(db, customer, quantity)
+
+
+def run(name, place, orders, counter):
+    reset_drivers()
+    with SessionLocal() as db:
+        customers = db.query(Customer).limit(orders).all()
+        counter.reset()
+        started = time.perf_counter()
+        for customer in customers:
+            place(db, customer, 20)
+        elapsed = time.perf_counter() - started
+    n = len(customers)
+    print(
+        f"{name:<14} {counter.statements / n:>12.1f} {counter.commits / n:>10.1f} "
+        f"{elapsed / n * 1000:>10.2f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--drivers", type=int, default=300)
+    args = parser.parse_args()
+
+    seed(args.drivers, args.orders)
+    counter = Counter()
+
+    print(f"{args.orders} orders, {args.drivers} drivers, {engine.url.get_backend_name()}")
+    print(f"{'pipeline':<14} {'stmts/order':>12} {'commits':>10} {'ms/order':>10}")
+    run("legacy", legacy_order, args.orders, counter)
+    run("order_service", service_order, args.orders, counter)
+
+
+if __name__ == "__main__":
+    main()
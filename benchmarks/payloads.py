@@ -0,0 +1,113 @@
+"""Synthetic WhatsApp webhook deliveries for load tests.
+
+Deliveries have the shape Meta posts to /whatsapp: one
+whatsapp_business_account event whose messages are spread over entries.
+Three traffic mixes are generated:
+
+- location: new customers sharing a location, plus driver position pings
+- text: known customers ordering water, with the odd malformed message
+- mixed: location, order and driver traffic interleaved, as in production
+"""
+import itertools
+import random
+import time
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+SCENARIOS = ("location", "text", "mixed")
+
+# Customers and drivers are scattered over this box (central Lagos)
+AREA = ((6.40, 3.25), (6.70, 3.55))
+
+_ids = itertools.count(1)
+
+
+def random_point(rng: random.Random) -> Tuple[float, float]:
+    (south, west), (north, east) = AREA
+    return round(rng.uniform(south, north), 6), round(rng.uniform(west, east), 6)
+
+
+def message_id() -> str:
+    return f"wamid.load{next(_ids):010d}"
+
+
+def location_message(phone: str, latitude: float, longitude: float, address: str = "Load test") -> Dict:
+    return {
+        "from": phone,
+        "id": message_id(),
+        "timestamp": str(int(time.time())),
+        "type": "location",
+        "location": {"latitude": latitude, "longitude": longitude, "address": address},
+    }
+
+
+def text_message(phone: str, body: str) -> Dict:
+    return {
+        "from": phone,
+        "id": message_id(),
+        "timestamp": str(int(time.time())),
+        "type": "text",
+        "text": {"body": body},
+    }
+
+
+def delivery(messages: Sequence[Dict], per_entry: int = 10) -> Dict:
+    """Wrap messages in a webhook event, at most per_entry to an entry."""
+    entries = [
+        {"id": "load-test", "changes": [{"field": "messages", "value": {
+            "messaging_product": "whatsapp",
+            "metadata": {"phone_number_id": "stub"},
+            "messages": list(messages[i:i + per_entry]),
+        }}]}
+        for i in range(0, len(messages), per_entry)
+    ]
+    return {"object": "whatsapp_business_account", "entry": entries}
+
+
+class PayloadGenerator:
+    """Deterministic message streams for a seeded population of phones.
+
+    customer_phones and driver_phones must already exist (with
+    coordinates) for orders and driver pings to take the full path; new
+    customers get fresh phone numbers.
+    """
+
+    def __init__(self, customer_phones: List[str], driver_phones: List[str], seed: int = 1):
+        self.customer_phones = customer_phones
+        self.driver_phones = driver_phones
+        self.rng = random.Random(seed)
+        self._new_customers = itertools.count(1)
+
+    def new_customer_location(self) -> Dict:
+        phone = f"23470{next(self._new_customers):08d}"
+        return location_message(phone, *random_point(self.rng))
+
+    def driver_ping(self) -> Dict:
+        return location_message(self.rng.choice(self.driver_phones), *random_point(self.rng), address="On the road")
+
+    def order(self) -> Dict:
+        phone = self.rng.choice(self.customer_phones)
+        if self.rng.random() < 0.05:
+            return text_message(phone, "hello, how does this work?")
+        quantity = self.rng.choice((10, 20, 25, 50, 100))
+        return text_message(phone, f"I want {quantity} litres of water")
+
+    def message(self, scenario: str) -> Dict:
+        roll = self.rng.random()
+        if scenario == "location":
+            return self.new_customer_location() if roll < 0.3 else self.driver_ping()
+        if scenario == "text":
+            return self.order()
+        if scenario == "mixed":
+            if roll < 0.4:
+                return self.order()
+            if roll < 0.5:
+                return self.new_customer_location()
+            return self.driver_ping()
+        raise ValueError(f"Unknown scenario {scenario!r}; expected one of {SCENARIOS}")
+
+    def deliveries(self, scenario: str, messages: int, batch_size: int = 1) -> Iterator[Dict]:
+        """messages messages of the scenario, batch_size to a delivery."""
+        while messages > 0:
+            count = min(batch_size, messages)
+            yield delivery([self.message(scenario) for _ in range(count)])
+            messages -= count
@@ -0,0 +1,128 @@
+"""Insert and lookup cost with the old index layout vs the current one.
+
+Run from the repository root:
+
+    python -m benchmarks.schema_indexes [--orders 10000] [--drivers 2000] [--lookups 500]
+
+Builds the same tables twice in throwaway SQLite files: once with the old
+layout (a redundant unique index on every primary key and no lookup
+indexes) and once as the models define them now. It then times bulk
+inserts and the lookups the hot paths run.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+if "DATABASE_URL" not in os.environ:
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/schema_indexes.db"
+
+from sqlalchemy import create_engine, func, insert, select, text
+
+from app.database.setup import Base
+from app.models import Customer, Driver, Order, OrderAssignment, OrderStatus, Price, generate_ulid
+
+
+def build(path: str, legacy: bool):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    if legacy:
+        with engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    connection.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+                if "id" in table.c:
+                    connection.execute(text(f"CREATE UNIQUE INDEX ix_{table.name}_id ON {table.name} (id)"))
+    return engine
+
+
+def timed(fn) -> float:
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+def seed(engine, customers, drivers, orders, rng):
+    with engine.begin() as connection:
+        connection.execute(insert(Customer), [
+            {"id": c, "phone": f"234{i:010d}", "location": "Home", "latitude": 6.5, "longitude": 3.3}
+            for i, c in enumerate(customers)
+        ])
+        connection.execute(insert(Driver), [
+            {"id": d, "name": f"Driver {i}", "phone": f"235{i:010d}", "vehicle_number": f"TRK-{i}",
+             "location": "Depot", "latitude": 6.5, "longitude": 3.3, "is_available": rng.random() < 0.1}
+            for i, d in enumerate(drivers)
+        ])
+
+    rows = [
+        (generate_ulid(), rng.choice(customers), rng.choice(drivers), rng.random() < 0.05)
+        for _ in range(orders)
+    ]
+
+    def insert_orders():
+        # One transaction per order, like the order path
+        for order_id, customer_id, driver_id, pending in rows:
+            with engine.begin() as connection:
+                connection.execute(insert(Order).values(
+                    id=order_id, quantity=20, customer_id=customer_id, total_price=42.0,
+                    status=OrderStatus.PENDING if pending else OrderStatus.CONFIRMED,
+                ))
+                connection.execute(insert(Price).values(
+                    id=generate_ulid(), order_id=order_id, base_price=20, tax=2,
+                    price_per_km=0.5, distance_km=1, total_price=42.0,
+                ))
+                if not pending:
+                    connection.execute(insert(OrderAssignment).values(
+                        id=generate_ulid(), order_id=order_id, driver_id=driver_id,
+                    ))
+
+    return timed(insert_orders) / orders
+
+
+def lookups(engine, customers, drivers, count, rng) -> dict:
+    queries = {
+        "orders by customer": lambda: select(Order.id).where(Order.customer_id == rng.choice(customers)),
+        "pending orders": lambda: select(Order.id).where(Order.status == OrderStatus.PENDING).order_by(Order.id).limit(200),
+        "assignments by driver": lambda: select(func.count()).where(OrderAssignment.driver_id == rng.choice(drivers)),
+        "available drivers": lambda: select(Driver.id, Driver.latitude, Driver.longitude).where(
+            Driver.is_available == True, Driver.latitude.is_not(None), Driver.longitude.is_not(None)
+        ),
+    }
+    results = {}
+    with engine.connect() as connection:
+        for name, query in queries.items():
+            results[name] = timed(lambda: [connection.execute(query()).all() for _ in range(count)]) / count
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--customers", type=int, default=5000)
+    parser.add_argument("--drivers", type=int, default=2000)
+    parser.add_argument("--lookups", type=int, default=500)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    results = {}
+    for layout, legacy in (("old", True), ("new", False)):
+        rng = random.Random(5)
+        customers = [generate_ulid() for _ in range(args.customers)]
+        drivers = [generate_ulid() for _ in range(args.drivers)]
+        engine = build(os.path.join(directory, f"{layout}.db"), legacy)
+        insert_ms = seed(engine, customers, drivers, args.orders, rng) * 1000
+        results[layout] = {"insert per order": insert_ms}
+        results[layout].update({
+            name: seconds * 1000 for name, seconds in lookups(engine, customers, drivers, args.lookups, rng).items()
+        })
+        engine.dispose()
+
+    print(f"{args.orders} orders, {args.customers} customers, {args.drivers} drivers, sqlite (ms)")
+    print(f"{'operation':<24} {'old':>10} {'new':>10}")
+    for name in results["old"]:
+        print(f"{name:<24} {results['old'][name]:>10.3f} {results['new'][name]:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
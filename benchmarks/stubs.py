@@ -0,0 +1,206 @@
+"""Local stand-ins for the Google Distance Matrix and WhatsApp Graph APIs.
+
+Run from the repository root to serve both until interrupted:
+
+    python -m benchmarks.stubs [--port 8900] [--distance-latency-ms 80] [--whatsapp-error-rate 0.05]
+
+then start the API with the printed DISTANCE_MATRIX_URL and WHATSAPP_API_URL
+exported. benchmarks.load_test starts them in-process instead. Distances are
+great-circle km times a circuity factor, so answers are plausible and
+deterministic; every response waits latency ± jitter, and a share of
+requests fails with a 500 (Distance Matrix) or a 429/500 (WhatsApp).
+Nothing here touches the network beyond 127.0.0.1.
+"""
+import argparse
+import asyncio
+import random
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from app.geo import haversine_km
+
+# Roads are longer than the straight line; ~1.3 is typical for a city grid
+CIRCUITY_FACTOR = 1.3
+
+
+@dataclass
+class Behaviour:
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+
+
+@dataclass
+class Calls:
+    requests: int = 0
+    errors: int = 0
+    elements: int = 0  # Distance Matrix destinations, WhatsApp messages delivered
+
+
+class Upstream:
+    def __init__(self, behaviour: Behaviour, seed: int):
+        self.behaviour = behaviour
+        self.calls = Calls()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    async def delay(self) -> bool:
+        """Sleep for the configured latency; True when this request should fail."""
+        b = self.behaviour
+        with self._lock:
+            self.calls.requests += 1
+            wait = max(0.0, b.latency_ms + self._rng.uniform(-b.jitter_ms, b.jitter_ms)) / 1000
+            failed = self._rng.random() < b.error_rate
+            if failed:
+                self.calls.errors += 1
+        if wait:
+            await asyncio.sleep(wait)
+        return failed
+
+
+def _point(text: str):
+    lat, lng = text.split(",")
+    return float(lat), float(lng)
+
+
+def build_app(distance: Upstream, whatsapp: Upstream) -> Starlette:
+    async def distance_matrix(request: Request):
+        failed = await distance.delay()
+        if failed:
+            return JSONResponse({"status": "UNKNOWN_ERROR", "rows": []}, status_code=500)
+        origin = _point(request.query_params["origins"])
+        destinations = [_point(d) for d in request.query_params["destinations"].split("|")]
+        distance.calls.elements += len(destinations)
+        elements = []
+        for lat, lng in destinations:
+            metres = round(haversine_km(origin[0], origin[1], lat, lng) * CIRCUITY_FACTOR * 1000)
+            elements.append({
+                "status": "OK",
+                "distance": {"value": metres, "text": f"{metres / 1000:.1f} km"},
+                "duration": {"value": round(metres / 8.3), "text": ""},  # ~30 km/h
+            })
+        return JSONResponse({"status": "OK", "rows": [{"elements": elements}]})
+
+    async def messages(request: Request):
+        failed = await whatsapp.delay()
+        payload = await request.json()
+        if failed:
+            # Meta answers overload with 429 as often as with a 5xx; both are retried
+            status = 429 if whatsapp.calls.errors % 2 else 500
+            return JSONResponse({"error": {"message": "stub failure", "code": status}}, status_code=status)
+        whatsapp.calls.elements += 1
+        to = payload.get("to", "")
+        return JSONResponse({
+            "messaging_product": "whatsapp",
+            "contacts": [{"input": to, "wa_id": to}],
+            "messages": [{"id": f"wamid.stub{whatsapp.calls.elements}"}],
+        })
+
+    return Starlette(routes=[
+        Route("/maps/api/distancematrix/json", distance_matrix),
+        Route("/{version}/{phone_number_id}/messages", messages, methods=["POST"]),
+    ])
+
+
+class StubServers:
+    """Both stubs on one 127.0.0.1 port, served by uvicorn on a background thread.
+
+    Running on their own thread and event loop keeps stub latency from
+    stalling the API under test when it shares the process.
+    """
+
+    def __init__(self, distance: Behaviour, whatsapp: Behaviour, port: int = 0, seed: int = 1):
+        self.distance = Upstream(distance, seed)
+        self.whatsapp = Upstream(whatsapp, seed + 1)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(("127.0.0.1", port))
+        self.port = self._socket.getsockname()[1]
+        self._server = uvicorn.Server(uvicorn.Config(
+            build_app(self.distance, self.whatsapp), log_level="warning", access_log=False,
+            backlog=4096, limit_concurrency=None,
+        ))
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def distance_matrix_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/maps/api/distancematrix/json"
+
+    @property
+    def whatsapp_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v20.0/stub/messages"
+
+    def environ(self) -> Dict[str, str]:
+        """Settings that point the app at these stubs."""
+        return {
+            "DISTANCE_MATRIX_URL": self.distance_matrix_url,
+            "WHATSAPP_API_URL": self.whatsapp_url,
+            "GOOGLE_MAPS_API_KEY": "stub",
+            "WHATSAPP_ACCESS_TOKEN": "stub",
+        }
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.run, kwargs={"sockets": [self._socket]}, daemon=True
+        )
+        self._thread.start()
+        deadline = time.monotonic() + 10
+        while not self._server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Stub servers did not start")
+            time.sleep(0.01)
+
+    def stop(self):
+        self._server.should_exit = True
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+
+def behaviour_args(parser: argparse.ArgumentParser):
+    for name, latency in (("distance", 80), ("whatsapp", 150)):
+        parser.add_argument(f"--{name}-latency-ms", type=float, default=latency)
+        parser.add_argument(f"--{name}-jitter-ms", type=float, default=latency / 2)
+        parser.add_argument(f"--{name}-error-rate", type=float, default=0.0)
+
+
+def behaviours(args) -> Dict[str, Behaviour]:
+    return {
+        name: Behaviour(
+            getattr(args, f"{name}_latency_ms"), getattr(args, f"{name}_jitter_ms"), getattr(args, f"{name}_error_rate")
+        )
+        for name in ("distance", "whatsapp")
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8900)
+    behaviour_args(parser)
+    args = parser.parse_args()
+
+    stubs = StubServers(**behaviours(args), port=args.port)
+    stubs.start()
+    for key, value in stubs.environ().items():
+        print(f"export {key}={value}")
+    try:
+        while True:
+            time.sleep(5)
+            print(
+                f"distance matrix: {stubs.distance.calls.requests} requests, {stubs.distance.calls.errors} errors; "
+                f"whatsapp: {stubs.whatsapp.calls.requests} requests, {stubs.whatsapp.calls.errors} errors"
+            )
+    except KeyboardInterrupt:
+        stubs.stop()
+
+
+if __name__ == "__main__":
+    main()